@@ -0,0 +1,361 @@
+"""
+A content-addressed store for uploaded build artifacts.
+
+Every artifact is stored once, as a blob named by its SHA-1 checksum under
+<path>/.blobs. Human-readable names in <path> are hard links to the blobs,
+so the directory can still be served as an easy_install find-links page,
+and uploading a byte-identical sdist under a new name costs no space. A
+blob's link count says how many names still use it, so it's removed along
+with its last name.
+
+The manifest at <path>/.manifest records the checksum and upload time of
+every name, so lookups and rotation never need to hash the directory.
+Several masters may share a directory: every change is made under an
+flock on <path>/.lock, after re-reading the manifest. Changes can wait on
+another master's lock, so steps make them from a thread, never from the
+reactor. Files put in the directory by other means are picked up without a
+checksum when the manifest changes, and can be moved into the store with
+adopt_existing.
+"""
+import fcntl
+import fnmatch
+import os
+import shutil
+import time
+
+from metrics import registry
+from util import get_file_checksum
+
+
+BLOB_DIR = ".blobs"
+MANIFEST_FILENAME = ".manifest"
+LOCK_FILENAME = ".lock"
+
+
+class ArtifactEntry(object):
+    def __init__(self, name, checksum, mtime):
+        self.name = name
+        self.checksum = checksum
+        self.mtime = mtime
+
+
+class ArtifactStore(object):
+    """
+    A directory of artifacts backed by content-addressed blobs.
+
+    Entries for files that weren't added through the store have a checksum
+    of None.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.blob_path = os.path.join(self.path, BLOB_DIR)
+        self.manifest_path = os.path.join(self.path, MANIFEST_FILENAME)
+        self.lock_path = os.path.join(self.path, LOCK_FILENAME)
+        self.entries = {}
+
+        if not os.path.exists(self.blob_path):
+            os.makedirs(self.blob_path)
+
+        self.manifest_key = self._get_manifest_key()
+        self.load()
+
+    def refresh(self):
+        """
+        Re-reads the manifest and the directory if another process has
+        changed the manifest.
+
+        This only stats the manifest when nothing has changed, so it's
+        cheap enough to call on every lookup.
+        """
+        manifest_key = self._get_manifest_key()
+
+        if manifest_key != self.manifest_key:
+            self.manifest_key = manifest_key
+            self.load()
+
+    def load(self):
+        """
+        Reads the manifest, and adds entries without a checksum for the
+        other files in the directory.
+        """
+        entries = {}
+
+        try:
+            f = open(self.manifest_path, "r")
+        except IOError:
+            f = None
+
+        if f is not None:
+            try:
+                for line in f:
+                    checksum, mtime, name = line.rstrip("\n").split(" ", 2)
+                    entries[name] = ArtifactEntry(name, checksum,
+                                                  float(mtime))
+            finally:
+                f.close()
+
+        names = set([name for name in os.listdir(self.path)
+                     if not name.startswith(".")])
+
+        for name in entries.keys():
+            if name not in names:
+                del entries[name]
+
+        for name in names:
+            if name not in entries:
+                filename = self.get_path(name)
+
+                if os.path.isfile(filename):
+                    entries[name] = ArtifactEntry(
+                        name, None, os.path.getmtime(filename))
+
+        # Lookups from the reactor thread may read the entries while a
+        # change is made from another thread, so they're replaced whole.
+        self.entries = entries
+
+    def save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        f = open(tmp_path, "w")
+
+        try:
+            for name in sorted(self.entries.keys()):
+                entry = self.entries[name]
+
+                if entry.checksum is not None:
+                    f.write("%s %f %s\n" % (entry.checksum, entry.mtime,
+                                            name))
+        finally:
+            f.close()
+
+        os.rename(tmp_path, self.manifest_path)
+        self.manifest_key = self._get_manifest_key()
+
+    def lock(self):
+        """
+        Takes the store's lock, re-reading the manifest once it's held.
+        Returns the lock file, to pass to unlock.
+        """
+        lock_file = open(self.lock_path, "a")
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        self.refresh()
+
+        return lock_file
+
+    def unlock(self, lock_file):
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+    def adopt_existing(self):
+        """
+        Moves the files in the directory that have no checksum into the
+        store, keeping their modification times.
+
+        This hashes every such file, so it's meant to be run once, offline,
+        when converting an existing directory, not from the master.
+        """
+        lock_file = self.lock()
+
+        try:
+            self.load()
+
+            for entry in self.entries.values():
+                if entry.checksum is None:
+                    entry.checksum = self._store_blob(
+                        self.get_path(entry.name), link_back=True)
+
+            self.save()
+        finally:
+            self.unlock(lock_file)
+
+    def get_path(self, name):
+        return os.path.join(self.path, name)
+
+    def get_blob_path(self, checksum):
+        return os.path.join(self.blob_path, checksum[:2], checksum)
+
+    def has_blob(self, checksum):
+        found = os.path.exists(self.get_blob_path(checksum))
+        self._count_lookup("blob", found)
+
+        return found
+
+    def get(self, name):
+        self.refresh()
+
+        return self.entries.get(name)
+
+    def add(self, filename, name, checksum=None):
+        """
+        Adds a file to the store under a name, replacing anything that
+        already has the name.
+
+        The file is moved into the store, or removed if the store already
+        has a blob with the same contents.
+        """
+        lock_file = self.lock()
+
+        try:
+            checksum = self._store_blob(filename, checksum)
+            self._link(checksum, name)
+        finally:
+            self.unlock(lock_file)
+
+        return checksum
+
+    def link(self, checksum, name):
+        """
+        Gives a name to a blob that's already in the store.
+        """
+        lock_file = self.lock()
+
+        try:
+            self._link(checksum, name)
+        finally:
+            self.unlock(lock_file)
+
+    def remove(self, name):
+        lock_file = self.lock()
+
+        try:
+            entry = self.entries.pop(name, None)
+
+            if entry is None:
+                return
+
+            if os.path.exists(self.get_path(name)):
+                os.unlink(self.get_path(name))
+
+            self.save()
+
+            if entry.checksum is not None:
+                self._release_blob(entry.checksum)
+        finally:
+            self.unlock(lock_file)
+
+    def find(self, pattern):
+        """
+        Returns the entries whose names match a shell-style pattern, newest
+        first.
+        """
+        self.refresh()
+        entries = [entry for entry in self.entries.values()
+                   if fnmatch.fnmatch(entry.name, pattern)]
+        entries.sort(key=lambda entry: entry.mtime, reverse=True)
+
+        return entries
+
+    def get_latest(self, basename, extension):
+        """
+        Returns the newest entry whose name starts with basename and ends
+        with the extension, or None.
+        """
+        entries = self.find("%s*.%s" % (basename, extension))
+        self._count_lookup("latest", bool(entries))
+
+        if entries:
+            return entries[0]
+
+        return None
+
+    def rotate(self, patterns, max_files):
+        """
+        Removes all but the newest max_files entries matching each pattern,
+        returning the removed names.
+        """
+        removed = []
+
+        for pattern in patterns:
+            for entry in self.find(pattern)[max_files:]:
+                self.remove(entry.name)
+                removed.append(entry.name)
+
+        return removed
+
+    def _get_manifest_key(self):
+        try:
+            st = os.stat(self.manifest_path)
+        except OSError:
+            return None
+
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _count_lookup(self, kind, found):
+        if found:
+            result = "hit"
+        else:
+            result = "miss"
+
+        registry.counter(
+            "buildbatter_artifact_lookups_total",
+            "Artifact store lookups by kind and result.").inc(
+                kind=kind, result=result)
+
+    def _store_blob(self, filename, checksum=None, link_back=False):
+        if checksum is None:
+            checksum = get_file_checksum(filename)
+
+        blob_path = self.get_blob_path(checksum)
+
+        if os.path.exists(blob_path):
+            os.unlink(filename)
+        else:
+            if not os.path.exists(os.path.dirname(blob_path)):
+                os.makedirs(os.path.dirname(blob_path))
+
+            os.rename(filename, blob_path)
+
+        if link_back:
+            self._link_file(blob_path, filename)
+
+        return checksum
+
+    def _link(self, checksum, name):
+        old_entry = self.entries.get(name)
+        tmp_path = self.get_path(".%s.tmp" % name)
+
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+        self._link_file(self.get_blob_path(checksum), tmp_path)
+        os.rename(tmp_path, self.get_path(name))
+
+        self.entries[name] = ArtifactEntry(name, checksum, time.time())
+        self.save()
+
+        if (old_entry and old_entry.checksum is not None and
+            old_entry.checksum != checksum):
+            self._release_blob(old_entry.checksum)
+
+    def _release_blob(self, checksum):
+        # Every name is a hard link to its blob, so a blob with one link
+        # left is unused. Where names are copies instead, this only loses
+        # the dedupe for later uploads.
+        blob_path = self.get_blob_path(checksum)
+
+        try:
+            if os.stat(blob_path).st_nlink <= 1:
+                os.unlink(blob_path)
+        except OSError:
+            pass
+
+    def _link_file(self, src, dest):
+        try:
+            os.link(src, dest)
+        except (AttributeError, OSError):
+            # No hard links here, so fall back on a copy.
+            shutil.copy2(src, dest)
+
+
+_stores = {}
+
+
+def get_artifact_store(path):
+    """
+    Returns the shared ArtifactStore for a directory.
+    """
+    path = os.path.abspath(path)
+
+    if path not in _stores:
+        _stores[path] = ArtifactStore(path)
+
+    return _stores[path]
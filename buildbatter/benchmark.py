@@ -0,0 +1,222 @@
+"""
+Benchmarks BuildManager config generation against synthetic build matrices.
+
+This runs offline. Targets point at throwaway local SVN and Git
+repositories (when svnadmin and git are available) and slaves are stubs,
+so nothing is contacted over the network. Run it with:
+
+    python -m buildbatter.benchmark --targets 200 --combinations 24
+"""
+import gc
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from build import BuildManager, BuildTarget, GitBranch, SVNBranch, \
+                  PythonModuleBuildRules
+from steps import NoseTests
+
+
+class BenchmarkBuildRules(PythonModuleBuildRules):
+    def addTestSteps(self, f):
+        f.addStep(NoseTests,
+                  command=["nosetests", "-v"],
+                  workdir=self.workdir,
+                  env=self.env)
+
+
+def create_local_repos(basedir):
+    """
+    Creates empty local SVN and Git repositories, returning their URLs.
+
+    If a tool isn't installed, a URL to a nonexistent repository is
+    returned instead, since config generation never accesses it.
+    """
+    svn_path = os.path.join(basedir, "svn")
+    git_path = os.path.join(basedir, "git")
+
+    for command in (["svnadmin", "create", svn_path],
+                    ["git", "init", "-q", "--bare", git_path]):
+        try:
+            subprocess.call(command, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+        except OSError:
+            pass
+
+    return "file://" + svn_path, "file://" + git_path
+
+
+def create_manager(num_targets, num_branches, num_combinations, num_pyvers,
+                   svn_url, git_url, **kwargs):
+    """
+    Creates a BuildManager for a synthetic matrix.
+
+    Targets alternate between SVN and Git branches. Every fifth target is
+    a nightly, and each other target triggers the one after it.
+    """
+    pyvers = ["2.%d" % i for i in range(4, 4 + num_pyvers)]
+    slave_info = {}
+
+    for pyver in pyvers:
+        slave_info[pyver] = ["slave-py%s" % pyver]
+
+    combinations = [("dependency%d" % (i / 2), "branch%d" % (i % 2))
+                    for i in range(num_combinations)]
+
+    manager = BuildManager(slave_info, combinations, pyvers, **kwargs)
+    targets = []
+
+    for i in range(num_targets):
+        name = "target%d" % i
+        branches = []
+
+        for j in range(num_branches):
+            if j == 0:
+                branch_name = "trunk"
+                upstream_branch = "master"
+            else:
+                branch_name = "release-%d" % j
+                upstream_branch = branch_name
+
+            if i % 2:
+                branches.append(GitBranch(
+                    upstream_branch,
+                    name=branch_name,
+                    url="%s#%s" % (git_url, name)))
+            else:
+                branches.append(SVNBranch(
+                    name=branch_name,
+                    url="%s/%s/%s" % (svn_url, name, branch_name)))
+
+        if i % 2 == 0 and i + 1 < num_targets:
+            triggers = ["target%d" % (i + 1)]
+        else:
+            triggers = []
+
+        targets.append(BuildTarget(
+            name, branches,
+            build_rules=BenchmarkBuildRules(
+                upload_path="/tmp/uploads",
+                upload_url="http://localhost/uploads",
+                egg_deps=["dependency%d" % (i % 5)]),
+            allow_sandbox=(i % 3 == 0),
+            nightly=(i % 5 == 4),
+            nightly_stagger_interval=10,
+            triggers=triggers))
+
+    manager.add(targets)
+
+    return manager
+
+
+def get_max_rss():
+    """
+    Returns the peak resident memory of this process, in kilobytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == "darwin":
+        rss /= 1024
+
+    return rss
+
+
+def time_call(func, repeat):
+    """
+    Calls a function several times, returning the best wall time and the
+    last result.
+    """
+    best = None
+
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, result
+
+
+def run_benchmark(num_targets, num_branches, num_combinations, num_pyvers,
+                  repeat=3, **kwargs):
+    """
+    Benchmarks config generation for one matrix size, returning a
+    dictionary of results.
+    """
+    basedir = tempfile.mkdtemp(prefix="buildbatter-bench-")
+
+    try:
+        svn_url, git_url = create_local_repos(basedir)
+        rss_before = get_max_rss()
+
+        setup_time, manager = time_call(
+            lambda: create_manager(num_targets, num_branches,
+                                   num_combinations, num_pyvers,
+                                   svn_url, git_url, **kwargs),
+            repeat)
+        pollers_time, pollers = time_call(manager.get_pollers, repeat)
+        schedulers_time, schedulers = time_call(manager.get_schedulers, repeat)
+        builders_time, builders = time_call(manager.get_builders, repeat)
+
+        return {
+            "targets": num_targets,
+            "branches": num_branches,
+            "combinations": num_combinations,
+            "pyvers": num_pyvers,
+            "setup_time": setup_time,
+            "pollers_time": pollers_time,
+            "schedulers_time": schedulers_time,
+            "builders_time": builders_time,
+            "pollers": len(pollers),
+            "schedulers": len(schedulers),
+            "builders": len(builders),
+            "steps": sum([len(builder['factory'].steps)
+                          for builder in builders]),
+            "rss_growth_kb": get_max_rss() - rss_before,
+        }
+    finally:
+        shutil.rmtree(basedir, ignore_errors=True)
+
+
+def format_results(results):
+    return ("%(targets)4d targets x %(branches)d branches x "
+            "%(combinations)3d combinations x %(pyvers)d pyvers: "
+            "%(builders)6d builders, %(schedulers)6d schedulers, "
+            "%(pollers)4d pollers, %(steps)7d steps | "
+            "builders %(builders_time).3fs, "
+            "schedulers %(schedulers_time).3fs, "
+            "pollers %(pollers_time).3fs, "
+            "peak RSS +%(rss_growth_kb)dKB" % results)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--targets", type="int", action="append",
+                      help="number of targets (may be given more than once)")
+    parser.add_option("--branches", type="int", default=2,
+                      help="number of branches per target")
+    parser.add_option("--combinations", type="int", default=12,
+                      help="number of dependency combinations")
+    parser.add_option("--pyvers", type="int", default=3,
+                      help="number of Python versions")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="number of runs to take the best time from")
+    options, args = parser.parse_args()
+
+    for num_targets in options.targets or [10, 50, 100, 200]:
+        results = run_benchmark(num_targets, options.branches,
+                                options.combinations, options.pyvers,
+                                options.repeat)
+        print(format_results(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,21 @@
+import sys
+import time
+
+from buildbot import locks
 from buildbot.process import factory
 from buildbot.process.properties import WithProperties
 from buildbot.scheduler import Try_Jobdir, Triggerable, Nightly
 from buildbot.steps.shell import ShellCommand, Test, SetProperty
 from buildbot.steps.trigger import Trigger
 
-from multirepo import Git, RepoChangeScheduler, SVN, SVNPoller
-from steps import BuildEgg, BuildSDist, VirtualEnv, EasyInstall
+from multirepo import Git, GitMirror, RepoChangeScheduler, SVN, SVNMirror, \
+                      SVNPoller, get_mirror_name
+from steps import BuildDists, BuildEgg, BuildEggs, BuildSDist, CleanSlave, \
+                  EasyInstall, MarkBuilddir, ParallelCommands, UploadDist, \
+                  VirtualEnv
+from reconfig import ConfigDiff, config_cache, describe
+from util import SlaveRegistry, get_lock, get_lock_generation, get_shard, \
+                 sha1
 
 
 def get_trigger_name(target_name, combination, pyver, branch):
@@ -17,13 +27,115 @@ class BuildManager(object):
     """
     Manages several BuildTarget and BuildDependency instances, setting up
     polling, dependencies, and slaves.
+
+    slave_info is either a dictionary mapping Python versions to slave
+    names, or a util.SlaveRegistry.
+
+    If mirror_dir is set, it must be an absolute path on the slaves. Each
+    repository is then mirrored once per slave under that directory and
+    shared by every builder on the slave.
+
+    slave_capacity limits the number of builds running at once on each
+    slave, and slave_capacities overrides it for specific slaves.
+
+    resource_classes and master_resource_classes map a step's
+    resource_class (such as "test-heavy" or "io-heavy") to the number of
+    such steps allowed to run at once on each slave or across the master,
+    respectively.
+
+    matrix_filter is an optional matrix.MatrixFilter that prunes the
+    target, combination and pyver matrix.
+
+    build_queue is an optional priority.BuildRequestQueue. If set, every
+    generated builder is registered with it, and master.cfg should set
+    c['prioritizeBuilders'] to its prioritizeBuilders.
+
+    shard and num_shards split the targets across several masters. Each
+    master's config creates the same manager with its own shard index
+    (from 0 to num_shards - 1), and only gets the pollers, schedulers and
+    builders for its shard. Targets connected by triggers always share a
+    shard, so triggers and the changes that start them stay on one master.
+    shard_map pins targets to shards by name. Other targets are placed by
+    consistent hashing, so changing num_shards only moves the targets
+    that land on a different shard.
+
+    A slave connects to a single master, so the slaves are split across
+    the shards too: slave_shard_map pins slaves to shards by name, and
+    other slaves are placed by consistent hashing. Each shard's builders
+    only use its own slaves, and its master should only list those, such
+    as with registry.get_build_slaves(manager.get_slave_names()). A shard
+    needs a slave for each Python version its targets build with.
+
+    Each master only polls the repositories of its own shard's targets.
+    Changes that don't come from a poller, such as those from commit hooks
+    (the only source for Git repositories) or "buildbot sendchange", must
+    be sent to every master. Each master's schedulers only pick up changes
+    to their own targets' repositories, and ignore the rest.
+
+    If gc_budget is set, each slave gets a maintenance builder, run nightly
+    at gc_hour:gc_minute by its shard's master. It marks the builddirs of
+    the shard's builders (including excluded ones), and removes marked
+    builddirs no builder uses any more once they're gc_orphan_age seconds
+    old. It then removes stale virtualenvs and build outputs until the
+    slave's base directory takes up at most gc_budget bytes. Unmarked
+    directories, the mirror directory, the slave's info directory and the
+    absolute paths in gc_protect are left alone. Builds on a slave wait
+    while its maintenance builder runs. Every build also marks its own
+    builddir first, so builders that come and go between maintenance runs
+    are cleaned up too.
+
+    Builddirs made before builders marked them are left alone as well,
+    unless gc_adopt is set. Then unmarked directories named like generated
+    builders ("*_py<version>" or "*_packaging") are treated as marked.
+    gc_adopt may also be a list of shell-style patterns to use instead.
     """
-    def __init__(self, slave_info, combinations, pyvers=["2.4", "2.5", "2.6"]):
+    def __init__(self, slave_info, combinations, pyvers=["2.4", "2.5", "2.6"],
+                 mirror_dir=None, slave_capacity=None, slave_capacities={},
+                 resource_classes={}, master_resource_classes={},
+                 matrix_filter=None, build_queue=None, shard=0, num_shards=1,
+                 shard_map={}, slave_shard_map={}, gc_budget=None,
+                 gc_orphan_age=24*60*60, gc_hour=4, gc_minute=0,
+                 gc_protect=[], gc_adopt=False):
         self.targets = {}
         self.target_list = []
         self.pyvers = pyvers
-        self.slave_info = slave_info
-        self.combinations = combinations
+        # Combinations are used as keys, so lists become tuples.
+        self.combinations = [tuple(combination)
+                             for combination in combinations]
+        self.mirror_dir = mirror_dir
+        self.slave_capacity = slave_capacity
+        self.slave_capacities = slave_capacities
+        self.resource_classes = resource_classes
+        self.master_resource_classes = master_resource_classes
+        self.matrix_filter = matrix_filter
+        self.build_queue = build_queue
+        self.registered_builders = []
+        self.shard = shard
+        self.num_shards = num_shards
+        self.shard_map = shard_map
+        self.slave_shard_map = slave_shard_map
+        self.gc_budget = gc_budget
+        self.gc_orphan_age = gc_orphan_age
+        self.gc_hour = gc_hour
+        self.gc_minute = gc_minute
+        self.gc_protect = gc_protect
+        self.gc_adopt = gc_adopt
+
+        if isinstance(slave_info, SlaveRegistry):
+            self.slave_registry = slave_info
+            self.slave_info = slave_info.get_pyver_map()
+        else:
+            self.slave_registry = None
+            self.slave_info = slave_info
+
+        if self.num_shards > 1:
+            shard_info = {}
+
+            for pyver, names in self.slave_info.items():
+                shard_info[pyver] = [name for name in names
+                                     if self.get_slave_shard(name) == shard]
+
+            self.slave_info = shard_info
 
     def add(self, targets):
         self.target_list = targets
@@ -32,51 +144,488 @@ class BuildManager(object):
             self.targets[target.name] = target
             target.manager = self
 
+    def get_slave_name(self, pyver, key=None):
+        """
+        Returns the name of the slave to use for a Python version, or None
+        if no slave provides it.
+
+        With a util.SlaveRegistry and a key (normally the builder name),
+        keys are spread over the slaves by their weights and capacities.
+        Otherwise, this is the preferred slave.
+        """
+        names = self.slave_info.get(pyver)
+
+        if not names:
+            return None
+
+        if key is not None and self.slave_registry is not None:
+            return self.slave_registry.pick_slave(names, key)
+
+        return names[0]
+
+    def get_shared_slave_name(self):
+        """
+        Returns the name of the preferred slave providing every Python
+        version, or None if no slave provides them all.
+        """
+        if not self.pyvers:
+            return None
+
+        for name in self.slave_info.get(self.pyvers[0], []):
+            for pyver in self.pyvers[1:]:
+                if name not in self.slave_info.get(pyver, []):
+                    break
+            else:
+                return name
+
+        return None
+
+    def get_slave_shard(self, slavename):
+        """
+        Returns the shard a slave belongs to.
+        """
+        if slavename in self.slave_shard_map:
+            return self.slave_shard_map[slavename]
+
+        return get_shard(slavename, self.num_shards)
+
+    def get_shard_assignments(self):
+        """
+        Returns a dictionary mapping each target name to its shard.
+        """
+        groups = {}
+
+        for target in self.target_list:
+            groups[target.name] = target.name
+
+        def find(name):
+            while groups[name] != name:
+                groups[name] = groups[groups[name]]
+                name = groups[name]
+
+            return name
+
+        for target in self.target_list:
+            for trigger in target.triggers:
+                if trigger in groups:
+                    a = find(target.name)
+                    b = find(trigger)
+
+                    if a != b:
+                        groups[max(a, b)] = min(a, b)
+
+        members = {}
+
+        for name in groups.keys():
+            members.setdefault(find(name), []).append(name)
+
+        assignments = {}
+
+        for group, names in members.items():
+            names.sort()
+            shard = None
+
+            for name in names:
+                if name in self.shard_map:
+                    shard = self.shard_map[name]
+                    break
+
+            if shard is None:
+                shard = get_shard(group, self.num_shards)
+
+            for name in names:
+                assignments[name] = shard
+
+        return assignments
+
+    def get_shard_targets(self):
+        """
+        Returns the targets in this manager's shard, in order.
+        """
+        if self.num_shards <= 1:
+            return self.target_list
+
+        assignments = self.get_shard_assignments()
+
+        return [target for target in self.target_list
+                if assignments[target.name] == self.shard]
+
     def get_pollers(self):
         pollers = []
 
-        for target in self.target_list:
+        for target in self.get_shard_targets():
             pollers.extend(target.get_pollers())
 
         return pollers
 
     def get_schedulers(self, exclude=[]):
+        exclude = set(exclude)
         schedulers = []
+        targets = self.get_shard_targets()
 
-        for target in self.target_list:
+        for target in targets:
             schedulers.extend(target.get_nightly_schedulers(exclude=exclude))
 
-        for target in self.target_list:
+        for target in targets:
             schedulers.extend(target.get_schedulers(exclude=exclude))
 
-        for target in self.target_list:
+        for target in targets:
             schedulers.extend(target.get_sandbox_schedulers(exclude=exclude))
 
+        schedulers.extend(self.get_maintenance_schedulers())
+
         return schedulers
 
     def get_builders(self, exclude=[]):
+        exclude = set(exclude)
+        builders = self.get_target_builders(self.get_shard_targets(), exclude)
+
+        if self.gc_budget is not None:
+            builders = builders + self.get_maintenance_builders()
+
+        for builder in builders:
+            self.apply_locks(builder)
+
+        return builders
+
+    def get_target_builders(self, targets, exclude=[]):
+        """
+        Returns the builders for a list of targets, without locks applied.
+        """
         builders = []
         sandbox_builders = []
 
-        rev_target_list = self.target_list
+        rev_target_list = list(targets)
         rev_target_list.reverse()
 
         for target in rev_target_list:
-            for combination in self.combinations:
-                for pyver in self.pyvers:
-                    python = "python%s" % pyver
-                    env={}
-
-                    builders.extend(
-                        target.get_builders(combination, python, pyver, env,
-                                            exclude=exclude))
-                    sandbox_builders.extend(
-                        target.get_sandbox_builders(combination, python,
-                                                    pyver, env,
-                                                    exclude=exclude))
+            target_builders, target_sandbox_builders = \
+                self.get_builders_for_target(target, exclude)
+            builders.extend(target_builders)
+            sandbox_builders.extend(target_sandbox_builders)
 
         return builders + sandbox_builders
 
+    def get_builders_for_target(self, target, exclude=[]):
+        """
+        Returns a target's builders and its sandbox builders, without locks
+        applied.
+        """
+        builders = []
+        sandbox_builders = []
+
+        for combination in self.combinations:
+            for pyver in self.pyvers:
+                python = "python%s" % pyver
+                env={}
+
+                builders.extend(
+                    target.get_builders(combination, python, pyver, env,
+                                        exclude=exclude))
+                sandbox_builders.extend(
+                    target.get_sandbox_builders(combination, python,
+                                                pyver, env,
+                                                exclude=exclude))
+
+            builders.extend(
+                target.get_packaging_builders(combination,
+                                              exclude=exclude))
+
+        if self.gc_budget is not None:
+            for builder in builders + sandbox_builders:
+                builder['factory'].steps.insert(0, (MarkBuilddir, {}))
+
+        return builders, sandbox_builders
+
+    def get_target_fingerprint(self, target, exclude=[]):
+        """
+        Returns a fingerprint of everything a target's builders are
+        generated from: the target with its branches and build rules, and
+        this manager's settings.
+
+        This has to be taken before the target's builders are generated,
+        since generating them sets up its build rules.
+        """
+        # References back to the manager and the target don't need to be
+        # followed.
+        seen = set([id(self), id(target)])
+        target_state = dict([(key, value)
+                             for key, value in target.__dict__.items()
+                             if key not in ("manager", "build_rules")])
+        rules = target.build_rules
+        rules_state = None
+
+        if rules is not None:
+            rules_state = (rules.__class__, dict([
+                (key, value) for key, value in rules.__dict__.items()
+                if key not in BuildRules.setup_attrs
+            ]))
+
+        manager_state = dict([(key, value)
+                              for key, value in self.__dict__.items()
+                              if key not in ("targets", "target_list",
+                                             "build_queue",
+                                             "registered_builders")])
+
+        return sha1(describe((target.__class__, target_state, rules_state,
+                              manager_state, sorted(exclude)),
+                             seen)).hexdigest()
+
+    def register_builder(self, name, sandbox=False, is_head=True):
+        """
+        Registers a generated builder with the build queue, if there is one.
+        """
+        if self.build_queue:
+            self.build_queue.add_builder(name, sandbox, is_head)
+            self.registered_builders.append((name, sandbox, is_head))
+
+    def get_slave_names(self):
+        """
+        Returns the names of all slaves in this manager's shard, sorted.
+        """
+        names = set()
+
+        for slavenames in self.slave_info.values():
+            names.update(slavenames)
+
+        return sorted(names)
+
+    def get_maintenance_builder_name(self, slavename):
+        return "maintenance_%s" % slavename
+
+    def get_builddirs(self):
+        """
+        Returns a dictionary mapping each slave's name to the builddirs of
+        the builders this manager's shard places on it, including excluded
+        builders, without generating the builders.
+        """
+        builddirs = {}
+
+        for target in self.get_shard_targets():
+            for slavename, builddir in target.get_builddirs():
+                builddirs.setdefault(slavename, []).append(builddir)
+
+        return builddirs
+
+    def get_maintenance_builders(self):
+        """
+        Returns a maintenance builder for each slave, which frees disk space
+        by removing whatever this shard's builders no longer need.
+        """
+        builddirs = self.get_builddirs()
+
+        protect = list(self.gc_protect)
+
+        if self.mirror_dir:
+            protect.append(self.mirror_dir)
+
+        if self.gc_adopt is True:
+            adopt = ["*_py[0-9]*", "*_packaging"]
+        else:
+            adopt = list(self.gc_adopt or [])
+
+        maintenance_builders = []
+
+        for slavename in self.get_slave_names():
+            name = self.get_maintenance_builder_name(slavename)
+
+            f = factory.BuildFactory()
+            f.addStep(CleanSlave,
+                      builddirs=builddirs.get(slavename, []) + [name],
+                      budget=self.gc_budget,
+                      orphan_age=self.gc_orphan_age,
+                      protect=protect,
+                      adopt=adopt)
+
+            maintenance_builders.append({
+                'name': name,
+                'slavename': slavename,
+                'builddir': name,
+                'factory': f,
+                'category': "maintenance",
+            })
+
+        return maintenance_builders
+
+    def get_maintenance_schedulers(self):
+        if self.gc_budget is None or not self.get_slave_names():
+            return []
+
+        return [Nightly(
+            name="maintenance",
+            branch=None,
+            builderNames=[self.get_maintenance_builder_name(slavename)
+                          for slavename in self.get_slave_names()],
+            hour=self.gc_hour,
+            minute=self.gc_minute
+        )]
+
+    def get_reconfig(self, exclude=[], cache=None):
+        """
+        Returns the pollers, schedulers and builders for this manager, and
+        a reconfig.ConfigDiff against the last call.
+
+        Pieces whose descriptions haven't changed since the last call are
+        returned as the same objects, so buildbot's reconfig leaves them
+        and their running builds alone. The builders of targets whose
+        fingerprints haven't changed aren't generated again.
+        """
+        if cache is None:
+            cache = config_cache
+
+        if cache.lock_generation != get_lock_generation():
+            # Builders made before reset_locks() hold the old lock
+            # objects. Locks compare equal by name and settings, so they
+            # would be reused, and buildbot rejects a config mixing them
+            # with new locks of the same name.
+            cache.invalidate("targets")
+            cache.invalidate("builders")
+            cache.lock_generation = get_lock_generation()
+
+        exclude = set(exclude)
+        targets = list(self.get_shard_targets())
+        targets.reverse()
+        fingerprints = [self.get_target_fingerprint(target, exclude)
+                        for target in targets]
+
+        diff = ConfigDiff()
+        pollers = cache.update("pollers", self.get_pollers(),
+                               lambda poller: None, diff)
+        schedulers = cache.update("schedulers",
+                                  self.get_schedulers(exclude=exclude),
+                                  lambda scheduler: scheduler.name, diff)
+
+        builders = []
+        sandbox_builders = []
+
+        for target, fingerprint in zip(targets, fingerprints):
+            target_builders, target_sandbox_builders, registered = \
+                cache.memoize("targets", target.name, fingerprint,
+                              lambda: self._generate_target_builders(target,
+                                                                     exclude),
+                              self._replay_registrations)
+            builders.extend(target_builders)
+            sandbox_builders.extend(target_sandbox_builders)
+
+        cache.prune_memos("targets", [target.name for target in targets])
+        builders += sandbox_builders
+
+        if self.gc_budget is not None:
+            maintenance_builders = self.get_maintenance_builders()
+
+            for builder in maintenance_builders:
+                self.apply_locks(builder)
+
+            builders += maintenance_builders
+
+        builders = cache.update("builders", builders,
+                                lambda builder: builder['name'], diff)
+
+        return pollers, schedulers, builders, diff
+
+    def _generate_target_builders(self, target, exclude):
+        start = len(self.registered_builders)
+        builders, sandbox_builders = self.get_builders_for_target(target,
+                                                                  exclude)
+
+        for builder in builders + sandbox_builders:
+            self.apply_locks(builder)
+
+        return (builders, sandbox_builders,
+                self.registered_builders[start:])
+
+    def _replay_registrations(self, memo):
+        for name, sandbox, is_head in memo[2]:
+            self.register_builder(name, sandbox, is_head)
+
+    def get_capacity_lock(self):
+        """
+        Returns the slave lock limiting the number of concurrent builds on
+        each slave, or None if slaves have unlimited capacity.
+        """
+        if not self.slave_capacity and not self.slave_capacities:
+            return None
+
+        return get_lock(locks.SlaveLock, "slave_capacity",
+                        maxCount=self.slave_capacity or sys.maxint,
+                        maxCountForSlave=self.slave_capacities)
+
+    def get_resource_locks(self, resource_class):
+        """
+        Returns the lock accesses a step of the given resource class must
+        hold while running.
+        """
+        lock_accesses = []
+
+        if resource_class in self.resource_classes:
+            lock = get_lock(locks.SlaveLock, "resource_%s" % resource_class,
+                            maxCount=self.resource_classes[resource_class])
+            lock_accesses.append(lock.access("counting"))
+
+        if resource_class in self.master_resource_classes:
+            lock = get_lock(locks.MasterLock,
+                            "master_resource_%s" % resource_class,
+                            maxCount=self.master_resource_classes[resource_class])
+            lock_accesses.append(lock.access("counting"))
+
+        return lock_accesses
+
+    def get_maintenance_lock(self):
+        """
+        Returns the slave lock that keeps builds off a slave while its
+        maintenance builder runs, or None if there are no maintenance
+        builders.
+        """
+        if self.gc_budget is None:
+            return None
+
+        return get_lock(locks.SlaveLock, "slave_maintenance",
+                        maxCount=sys.maxint)
+
+    def apply_locks(self, builder):
+        """
+        Applies the slave capacity and maintenance locks to a builder and
+        the resource class locks to each of its steps.
+
+        A ParallelCommands step also holds the locks of its members'
+        resource classes, one access per class, for as long as the group
+        runs.
+        """
+        capacity_lock = self.get_capacity_lock()
+        maintenance_lock = self.get_maintenance_lock()
+
+        if capacity_lock:
+            builder['locks'] = (builder.get('locks', []) +
+                                [capacity_lock.access("counting")])
+
+        if maintenance_lock:
+            if builder['category'] == "maintenance":
+                access = maintenance_lock.access("exclusive")
+            else:
+                access = maintenance_lock.access("counting")
+
+            builder['locks'] = builder.get('locks', []) + [access]
+
+        f = builder['factory']
+
+        for i, (step_class, kwargs) in enumerate(f.steps):
+            resource_classes = [getattr(step_class, "resource_class", None)]
+
+            if issubclass(step_class, ParallelCommands):
+                for member in kwargs.get("commands", []):
+                    if len(member) > 2 and member[2] not in resource_classes:
+                        resource_classes.append(member[2])
+
+            lock_accesses = []
+
+            for resource_class in resource_classes:
+                lock_accesses += self.get_resource_locks(resource_class)
+
+            if lock_accesses:
+                kwargs = dict(kwargs)
+                kwargs['locks'] = list(kwargs.get('locks', [])) + lock_accesses
+                f.steps[i] = (step_class, kwargs)
+
 
 class Branch(object):
     """
@@ -102,9 +651,34 @@ class Branch(object):
         return self.poll_class("%s_%s" % (self.target.name, self.name),
                                self.url, self.poll_frequency)
 
-    def add_checkout_step(self, f, workdir):
+    def get_mirror_path(self):
+        """
+        Returns the path to the slave's shared mirror of this branch's
+        repository, or None if mirroring is disabled.
+        """
+        manager = self.target.manager
+
+        if not manager or not manager.mirror_dir or not self.url:
+            return None
+
+        return "%s/%s" % (manager.mirror_dir.rstrip("/"),
+                          get_mirror_name(self.url))
+
+    def add_checkout_step(self, f, workdir, mode="update"):
         assert False
 
+    def get_checkout_dir(self, workdir, mode):
+        """
+        Returns the directory the source step keeps its checkout in.
+
+        In "copy" mode, the slave keeps a pristine checkout in "source"
+        and copies it to the workdir for each build.
+        """
+        if mode == "copy":
+            return "source"
+
+        return workdir
+
 
 class GitBranch(Branch):
     """
@@ -118,10 +692,29 @@ class GitBranch(Branch):
     def is_head(self):
         return self.upstream_branch == "master"
 
-    def add_checkout_step(self, f, workdir):
+    def get_mirror_path(self):
+        # A bare mirror holds every branch, so it's shared across branches.
+        path = Branch.get_mirror_path(self)
+
+        if path:
+            path += ".git"
+
+        return path
+
+    def add_checkout_step(self, f, workdir, mode="update"):
+        repourl = self.url
+        mirror_path = self.get_mirror_path()
+
+        if mirror_path:
+            f.addStep(GitMirror,
+                      url=self.url,
+                      mirror_path=mirror_path,
+                      workdir=self.get_checkout_dir(workdir, mode))
+            repourl = mirror_path
+
         f.addStep(Git, reponame="%s_%s" % (self.target.name, self.name),
-                  repourl=self.url,
-                  mode="update",
+                  repourl=repourl,
+                  mode=mode,
                   alwaysUseLatest=True,
                   branch=self.upstream_branch,
                   workdir=workdir)
@@ -138,30 +731,60 @@ class SVNBranch(Branch):
     def is_head(self):
         return self.name == "trunk"
 
-    def add_checkout_step(self, f, workdir):
+    def add_checkout_step(self, f, workdir, mode="update"):
+        mirror_path = self.get_mirror_path()
+
+        if mirror_path:
+            f.addStep(SVNMirror,
+                      url=self.url,
+                      mirror_path=mirror_path,
+                      workdir=self.get_checkout_dir(workdir, mode))
+
         f.addStep(SVN, reponame="%s_%s" % (self.target.name, self.name),
                   svnurl=self.url,
-                  mode="update",
+                  mode=mode,
                   alwaysUseLatest=True,
                   workdir=workdir)
 
 
 class BuildTarget(object):
+    """
+    A target to build, such as a Python module, across all branches,
+    combinations and Python versions.
+
+    If sandbox_fast is set, sandbox builds only apply the patch to a warm
+    copy of the source and run the tests, stopping at the first failure.
+    The sandbox builders for every Python version are placed on one slave,
+    if any slave provides all of them, so they run side by side.
+
+    If combined_packaging is set and a slave provides every Python
+    version, one packaging builder per combination and branch builds the
+    dists for all the Python versions in the build matrix from a single
+    checkout, each version in its own virtualenv, building the eggs in
+    parallel. It uploads them together and then triggers the per-version
+    builders, in place of the commit or nightly scheduler. Those only run
+    the tests, and trigger the builds depending on their version once the
+    tests pass.
+    """
     def __init__(self, name, branches, build_rules=None, dependencies=[],
                  allow_sandbox=False, nightly=False, nightly_hour=0,
                  nightly_minute=0, nightly_stagger_interval=0, triggers=[],
                  trigger_excludes=[], wait_for_triggers=False,
-                 trigger_properties={}, exclude_from=[]):
+                 trigger_properties={}, exclude_from=[], sandbox_fast=False,
+                 combined_packaging=False):
         self.manager = None
         self.name = name
         self.branches = branches
         self.dependencies = dependencies
         self.allow_sandbox = allow_sandbox
+        self.sandbox_fast = sandbox_fast
+        self.combined_packaging = combined_packaging
         self.triggers = triggers
         self.trigger_excludes = trigger_excludes
         self.wait_for_triggers = wait_for_triggers
         self.trigger_properties = trigger_properties
-        self.exclude_from = exclude_from
+        self.exclude_from = set([tuple(combination)
+                                 for combination in exclude_from])
         self.build_rules = build_rules
         self.nightly = nightly
         self.nightly_hour = nightly_hour
@@ -171,6 +794,10 @@ class BuildTarget(object):
         for branch in self.branches:
             branch.target = self
 
+    def uses_combined_packaging(self):
+        return (self.combined_packaging and
+                self.manager.get_shared_slave_name() is not None)
+
     def get_pollers(self):
         pollers = []
 
@@ -189,23 +816,25 @@ class BuildTarget(object):
         schedulers = []
 
         for branch in self.branches:
-            builderNames = []
-
-            for pyver in self.manager.pyvers:
-                for combination in self.manager.combinations:
-                    if combination in self.exclude_from:
-                        continue
-
-                    name = self.get_builder_name(combination, pyver, branch)
-
-                    if name and name not in exclude:
-                        builderNames.append(name)
-
-                        schedulers.append(Triggerable(
-                            name=get_trigger_name(self.name, combination,
-                                                  pyver, branch),
-                            builderNames=[name]
-                        ))
+            cell_names = self.get_cell_builder_names(branch, exclude)
+            cells = self.get_cells(branch, exclude)
+            schedulers.extend(self.get_trigger_schedulers(branch, exclude))
+
+            if self.uses_combined_packaging():
+                # The packaging builders trigger the rest.
+                builderNames = []
+            else:
+                builderNames = [cell_names[cell]
+                                for cell in self.get_commit_cells(cells)]
+
+            for combination in self.manager.combinations:
+                name = self.get_packaging_builder_name(combination, branch,
+                                                       exclude)
+
+                if name and self.get_packaging_trigger_names(combination,
+                                                             branch,
+                                                             exclude):
+                    builderNames.append(name)
 
             repo_name = "%s_%s" % (self.name, branch.name)
 
@@ -218,6 +847,80 @@ class BuildTarget(object):
 
         return schedulers
 
+    def get_cell_builder_names(self, branch, exclude=[]):
+        """
+        Returns a dictionary mapping each (combination, pyver) cell of the
+        build matrix a branch is built in to its builder's name.
+        """
+        cell_names = {}
+
+        for pyver in self.manager.pyvers:
+            for combination in self.manager.combinations:
+                name = self.get_matrix_builder_name(combination, pyver,
+                                                    branch, exclude=exclude)
+
+                if name:
+                    cell_names[(combination, pyver)] = name
+
+        return cell_names
+
+    def get_cells(self, branch, exclude=[]):
+        """
+        Returns the (combination, pyver) cells of the build matrix a branch
+        is built in, in order.
+        """
+        cell_names = self.get_cell_builder_names(branch, exclude)
+
+        return [(combination, pyver)
+                for pyver in self.manager.pyvers
+                for combination in self.manager.combinations
+                if (combination, pyver) in cell_names]
+
+    def get_commit_cells(self, cells):
+        """
+        Returns the cells of a branch to build on each commit.
+        """
+        if self.manager.matrix_filter:
+            return self.manager.matrix_filter.get_commit_cells(cells)
+
+        return cells
+
+    def get_trigger_schedulers(self, branch, exclude=[]):
+        """
+        Returns a Triggerable scheduler for each cell a branch is built in.
+        """
+        cell_names = self.get_cell_builder_names(branch, exclude)
+
+        return [Triggerable(name=get_trigger_name(self.name, combination,
+                                                  pyver, branch),
+                            builderNames=[cell_names[(combination, pyver)]])
+                for combination, pyver in self.get_cells(branch, exclude)]
+
+    def get_packaging_pyvers(self, combination, branch, exclude=[]):
+        """
+        Returns the Python versions a combination of a branch is built for,
+        which its packaging builder builds dists for.
+        """
+        return [pyver for cell_combination, pyver
+                in self.get_cells(branch, exclude)
+                if cell_combination == combination]
+
+    def get_packaging_trigger_names(self, combination, branch, exclude=[]):
+        """
+        Returns the names of the schedulers a packaging builder triggers
+        once its dists are uploaded: those of every cell of its
+        combination for a nightly target, and those of the commit cells
+        otherwise.
+        """
+        cells = self.get_cells(branch, exclude)
+
+        if not self.nightly:
+            cells = self.get_commit_cells(cells)
+
+        return [get_trigger_name(self.name, combination, pyver, branch)
+                for cell_combination, pyver in cells
+                if cell_combination == combination]
+
     def get_nightly_schedulers(self, exclude=[]):
         if not self.nightly:
             return []
@@ -226,30 +929,45 @@ class BuildTarget(object):
 
         hour = self.nightly_hour
         minute = self.nightly_minute
+        offset = 0
 
-        for combination in self.manager.combinations:
-            if combination in self.exclude_from:
-                continue
+        if self.uses_combined_packaging():
+            # The packaging builders trigger the per-version builders.
+            for branch in self.branches:
+                schedulers.extend(self.get_trigger_schedulers(branch,
+                                                              exclude))
 
+        for combination in self.manager.combinations:
             builderNames = []
 
-            for pyver in self.manager.pyvers:
-                for branch in self.branches:
-                    name = self.get_builder_name(combination, pyver, branch)
+            if not self.uses_combined_packaging():
+                for pyver in self.manager.pyvers:
+                    for branch in self.branches:
+                        name = self.get_matrix_builder_name(combination,
+                                                            pyver, branch,
+                                                            exclude=exclude)
+
+                        if name:
+                            builderNames.append(name)
 
-                    if name not in exclude:
-                        builderNames.append(
-                            self.get_builder_name(combination, pyver, branch))
+            for branch in self.branches:
+                name = self.get_packaging_builder_name(combination, branch,
+                                                       exclude)
+
+                if name:
+                    builderNames.append(name)
 
             if builderNames:
-                schedulers.append(Nightly(
+                schedulers.append(SnapshotNightly(
                     name='%s-%s' % (self.name, combination),
                     branch=None,
                     builderNames=builderNames,
                     hour=hour,
-                    minute=minute
+                    minute=minute,
+                    snapshot_offset=offset
                 ))
 
+                offset += self.nightly_stagger_interval * 60
                 hour += self.nightly_stagger_interval / 60
                 minute += self.nightly_stagger_interval % 60
 
@@ -265,14 +983,12 @@ class BuildTarget(object):
 
             for pyver in self.manager.pyvers:
                 for combination in self.manager.combinations:
-                    if combination in self.exclude_from:
-                        continue
-
                     for branch in self.branches:
-                        name = self.get_builder_name(combination, pyver,
-                                                     branch, True)
+                        name = self.get_matrix_builder_name(combination, pyver,
+                                                            branch, True,
+                                                            exclude)
 
-                        if name and name not in exclude:
+                        if name:
                             builder_names.append(name)
 
             return [Try_Jobdir(
@@ -284,38 +1000,141 @@ class BuildTarget(object):
 
     def get_builders(self, combination, python, pyver, env, category="builds",
                      sandbox=False, exclude=[]):
-        if self.build_rules is None or combination in self.exclude_from:
+        if (self.build_rules is None or
+            tuple(combination) in self.exclude_from):
             return []
 
         builders = []
 
-        for branch in self.branches:
-            if pyver not in self.manager.slave_info:
-                continue
+        if self.manager.get_slave_name(pyver) is None:
+            return []
 
-            name = self.get_builder_name(combination, pyver, branch, sandbox)
+        for branch in self.branches:
+            name = self.get_matrix_builder_name(combination, pyver, branch,
+                                                sandbox, exclude)
 
-            if not name or name in exclude:
+            if not name:
                 continue
 
+            slavename = self.get_builder_slave_name(name, pyver, sandbox)
             workdir = self.name
-            slavename = self.manager.slave_info[pyver][0]
 
             f = factory.BuildFactory()
             self.build_rules.setup(self, branch, python, pyver, workdir, env,
                                    combination, sandbox)
             self.build_rules.addSteps(f)
 
-            builders.append({
+            builder = {
                 'name': name,
                 'slavename': slavename,
                 'builddir': name,
                 'factory': f,
                 'category': category,
-            })
+            }
+
+            self.manager.register_builder(name, sandbox, branch.is_head())
+
+            builders.append(builder)
+
+        return builders
+
+    def get_packaging_builders(self, combination, exclude=[]):
+        """
+        Returns the combined packaging builders for a combination, if the
+        target uses combined packaging.
+        """
+        if self.build_rules is None or not self.uses_combined_packaging():
+            return []
+
+        builders = []
+        slavename = self.manager.get_shared_slave_name()
+
+        for branch in self.branches:
+            name = self.get_packaging_builder_name(combination, branch,
+                                                   exclude)
+
+            if not name:
+                continue
+
+            workdir = self.name
+
+            f = factory.BuildFactory()
+            self.build_rules.setup(self, branch, None, None, workdir, {},
+                                   combination, False)
+            self.build_rules.addPackagingBuilderSteps(
+                f,
+                self.get_packaging_pyvers(combination, branch, exclude),
+                self.get_packaging_trigger_names(combination, branch,
+                                                 exclude))
+
+            builder = {
+                'name': name,
+                'slavename': slavename,
+                'builddir': name,
+                'factory': f,
+                'category': "builds",
+            }
+
+            self.manager.register_builder(name, False, branch.is_head())
+
+            builders.append(builder)
 
         return builders
 
+    def get_builder_slave_name(self, name, pyver, sandbox=False):
+        """
+        Returns the name of the slave a builder for a Python version runs
+        on.
+        """
+        slavename = self.manager.get_slave_name(pyver, name)
+
+        if sandbox and self.sandbox_fast:
+            slavename = self.manager.get_shared_slave_name() or slavename
+
+        return slavename
+
+    def get_builddirs(self):
+        """
+        Returns a (slavename, builddir) pair for each of this target's
+        builders, whether or not they're excluded, without generating them.
+        """
+        if self.build_rules is None:
+            return []
+
+        builddirs = []
+        sandboxes = [False]
+
+        if self.allow_sandbox:
+            sandboxes.append(True)
+
+        for combination in self.manager.combinations:
+            if tuple(combination) in self.exclude_from:
+                continue
+
+            for branch in self.branches:
+                for pyver in self.manager.pyvers:
+                    if self.manager.get_slave_name(pyver) is None:
+                        continue
+
+                    for sandbox in sandboxes:
+                        name = self.get_matrix_builder_name(combination,
+                                                            pyver, branch,
+                                                            sandbox)
+
+                        if name:
+                            builddirs.append((
+                                self.get_builder_slave_name(name, pyver,
+                                                            sandbox),
+                                name))
+
+                name = self.get_packaging_builder_name(combination, branch)
+
+                if name:
+                    builddirs.append((self.manager.get_shared_slave_name(),
+                                      name))
+
+        return builddirs
+
     def get_sandbox_builders(self, combination, python, pyver, env,
                              exclude=[]):
         if self.allow_sandbox:
@@ -324,9 +1143,57 @@ class BuildTarget(object):
 
         return []
 
+    def get_matrix_builder_name(self, combination, pyver, branch,
+                                sandbox=False, exclude=[]):
+        """
+        Returns the name of the builder for a cell of the build matrix, or
+        None if the cell has been pruned.
+        """
+        if tuple(combination) in self.exclude_from:
+            return None
+
+        matrix_filter = self.manager.matrix_filter
+
+        if (matrix_filter and
+            not matrix_filter.allows(self.name, branch.name, combination,
+                                     pyver, sandbox)):
+            return None
+
+        name = self.get_builder_name(combination, pyver, branch, sandbox)
+
+        if name in exclude:
+            return None
+
+        return name
+
+    def get_packaging_builder_name(self, combination, branch, exclude=[]):
+        """
+        Returns the name of the combined packaging builder for a
+        combination and branch, or None if there isn't one.
+        """
+        if (not self.uses_combined_packaging() or
+            tuple(combination) in self.exclude_from):
+            return None
+
+        prefix = self.get_builder_prefix(combination, branch)
+
+        if (prefix is None or prefix + "packaging" in exclude or
+            not self.get_packaging_pyvers(combination, branch, exclude)):
+            return None
+
+        return prefix + "packaging"
+
     def get_builder_name(self, combination, pyver, branch, sandbox=False):
-        assert combination not in self.exclude_from
+        assert tuple(combination) not in self.exclude_from
+
+        prefix = self.get_builder_prefix(combination, branch, sandbox)
 
+        if prefix is None:
+            return None
+
+        return "%spy%s" % (prefix, pyver)
+
+    def get_builder_prefix(self, combination, branch, sandbox=False):
         if self.name == combination[0]:
             if branch and branch.name != combination[1]:
                 return None
@@ -343,7 +1210,7 @@ class BuildTarget(object):
         if branch and not branch.is_head() and len(self.branches) > 1:
             name += "_" + branch.name
 
-        return "%s_%spy%s" % (name, suffix, pyver)
+        return "%s_%s" % (name, suffix)
 
 
 class BuildDependency(object):
@@ -351,6 +1218,10 @@ class BuildDependency(object):
 
 
 class BuildRules(object):
+    # The attributes setup() sets for each builder.
+    setup_attrs = ("target", "branch", "python", "pyver", "workdir", "env",
+                   "combination", "sandbox")
+
     def __init__(self):
         pass
 
@@ -367,41 +1238,107 @@ class BuildRules(object):
 
     def addSteps(self, f):
         self.addCheckoutSteps(f)
+        self.addWorkdirPropertyStep(f)
 
-        nightly = WithProperties("%(nightly:-" +
-                                 str(self.target.nightly) +
-                                 ")s")
+        if self.is_fast_sandbox():
+            first_test_step = len(f.steps)
+            self.addTestSteps(f)
 
-        workdir_key = "%s_workdir" % self.target.name
+            # Stop at the first failing test step.
+            for i in range(first_test_step, len(f.steps)):
+                step_class, kwargs = f.steps[i]
+                f.steps[i] = (step_class, dict(kwargs, haltOnFailure=True))
+
+            return
+
+        self.addTestSteps(f)
+
+        if self.sandbox or not self.target.uses_combined_packaging():
+            self.addBuildSteps(f)
+            self.addUploadSteps(f)
+
+        self.addTriggerSteps(f, [self.pyver])
+
+    def addPackagingBuilderSteps(self, f, pyvers, trigger_names):
+        """
+        Adds the steps for a target's combined packaging builder, which
+        builds and uploads the dists for several Python versions from one
+        checkout, and then triggers the target's own per-version builders
+        through trigger_names.
+        """
+        self.addCheckoutSteps(f)
+        self.addPackagingSteps(f, pyvers)
+
+        if trigger_names:
+            f.addStep(CustomTrigger,
+                      schedulerNames=trigger_names,
+                      waitForFinish=self.getTriggerWaitForFinish(),
+                      updateSourceStamp=False,
+                      set_properties=self.getTriggerProperties())
+
+    def addWorkdirPropertyStep(self, f):
         f.addStep(SetProperty,
                   command=["pwd"],
-                  property=workdir_key,
+                  property="%s_workdir" % self.target.name,
                   workdir=self.workdir)
 
-        self.addTestSteps(f)
-        self.addBuildSteps(f)
-        self.addUploadSteps(f)
+    def getTriggerWaitForFinish(self):
+        return self.target.wait_for_triggers or self.getNightlyProperty()
+
+    def getNightlyProperty(self):
+        return WithProperties("%(nightly:-" + str(self.target.nightly) + ")s")
+
+    def getTriggerProperties(self):
+        """
+        Returns the properties passed on to triggered builds.
+        """
+        return {
+            "nightly": self.getNightlyProperty(),
+            "snapshot": WithProperties("%(snapshot:-)s"),
+            "triggered_by": WithProperties("%(buildername)s"),
+            "upload_path": WithProperties("%(upload_path:-)s")
+        }
+
+    def addTriggerSteps(self, f, pyvers):
+        workdir_key = "%s_workdir" % self.target.name
 
         for trigger in self.target.triggers:
-            trigger_name = get_trigger_name(trigger, self.combination,
-                                            self.pyver, self.branch)
+            trigger_names = []
+
+            for pyver in pyvers:
+                trigger_name = get_trigger_name(trigger, self.combination,
+                                                pyver, self.branch)
+
+                if trigger_name not in self.target.trigger_excludes:
+                    trigger_names.append(trigger_name)
 
-            if trigger_name in self.target.trigger_excludes:
+            if not trigger_names:
                 continue
 
+            set_properties = self.getTriggerProperties()
+            set_properties[workdir_key] = \
+                WithProperties("%(" + workdir_key + ")s")
+            set_properties.update(self.target.trigger_properties)
+
             f.addStep(CustomTrigger,
-                      schedulerNames=[trigger_name],
-                      waitForFinish=self.target.wait_for_triggers or nightly,
+                      schedulerNames=trigger_names,
+                      waitForFinish=self.getTriggerWaitForFinish(),
                       updateSourceStamp=False,
-                      set_properties=dict({
-                          workdir_key: WithProperties("%(" + workdir_key + ")s"),
-                          "nightly": nightly,
-                          "upload_path": WithProperties("%(upload_path:-)s")
-                      }, **self.target.trigger_properties))
+                      set_properties=set_properties)
+
+    def is_fast_sandbox(self):
+        return self.sandbox and self.target.sandbox_fast
 
     def addCheckoutSteps(self, f):
         if self.branch:
-            self.branch.add_checkout_step(f, self.workdir)
+            if self.is_fast_sandbox():
+                # Keep a pristine checkout around and patch a copy of it,
+                # so a patched build never forces a fresh checkout.
+                mode = "copy"
+            else:
+                mode = "update"
+
+            self.branch.add_checkout_step(f, self.workdir, mode)
 
     def addTestSteps(self, f):
         pass
@@ -412,16 +1349,34 @@ class BuildRules(object):
     def addUploadSteps(self, f):
         pass
 
+    def addPackagingSteps(self, f, pyvers):
+        pass
+
+    def addParallelSteps(self, f, commands, **kwargs):
+        """
+        Adds a group of (name, command) pairs that run at the same time on
+        the slave. The build continues once all of them have finished.
+
+        A member may be a (name, command, resource_class) triple, and the
+        group then holds that resource class's locks.
+        """
+        kwargs.setdefault("workdir", self.workdir)
+        kwargs.setdefault("env", self.env)
+        f.addStep(ParallelCommands, commands=commands, **kwargs)
+
 
 class PythonModuleBuildRules(BuildRules):
     def __init__(self, upload_path=None, upload_url=None,
                  build_eggs=True, egg_deps=[], find_links=[],
+                 combine_dist_builds=False, egg_lock_dir=None,
                  *args, **kwargs):
         BuildRules.__init__(self, *args, **kwargs)
         self.upload_path = upload_path
         self.upload_url = upload_url
         self.build_eggs = build_eggs
+        self.combine_dist_builds = combine_dist_builds
         self.egg_deps = egg_deps
+        self.egg_lock_dir = egg_lock_dir
         self.find_links = find_links
 
     def addSteps(self, f):
@@ -444,6 +1399,9 @@ class PythonModuleBuildRules(BuildRules):
             f.addStep(EasyInstall,
                       packages=self.egg_deps,
                       find_links=[self.upload_url] + self.find_links,
+                      lock_dir=self.egg_lock_dir,
+                      pyver=self.pyver,
+                      combination=self.combination,
                       env=self.env)
 
     def addBuildSteps(self, f):
@@ -452,6 +1410,14 @@ class PythonModuleBuildRules(BuildRules):
         #          description="removing build directory",
         #          descriptionDone="removed build directory",
         #          workdir=self.workdir)
+        if self.combine_dist_builds:
+            f.addStep(BuildDists,
+                      workdir=self.workdir,
+                      use_egg_info=self.build_eggs,
+                      build_egg=self.build_eggs,
+                      env=self.env)
+            return
+
         f.addStep(BuildSDist,
                   workdir=self.workdir,
                   use_egg_info=self.build_eggs,
@@ -462,6 +1428,56 @@ class PythonModuleBuildRules(BuildRules):
                       workdir=self.workdir,
                       env=self.env)
 
+    def addPackagingSteps(self, f, pyvers):
+        # Each version gets a virtualenv with the egg_deps, next to the
+        # checkout, and the sdist is built with the first.
+        for pyver in pyvers:
+            venv_dir = "build-py%s" % pyver
+            python = "python%s" % pyver
+
+            f.addStep(VirtualEnv, python=python, workdir=venv_dir)
+
+            if self.egg_deps:
+                f.addStep(EasyInstall,
+                          packages=self.egg_deps,
+                          find_links=[self.upload_url] + self.find_links,
+                          lock_dir=self.egg_lock_dir,
+                          pyver=pyver,
+                          combination=self.combination,
+                          workdir=venv_dir,
+                          env={
+                              "PATH": "bin:/bin:/usr/bin",
+                              "PYTHONPATH": "lib/%s/site-packages" % python,
+                          })
+
+        self.env["PATH"] = "../build-py%s/bin:/bin:/usr/bin" % pyvers[0]
+
+        f.addStep(BuildSDist,
+                  workdir=self.workdir,
+                  use_egg_info=self.build_eggs,
+                  env=self.env)
+
+        files = [(WithProperties("dist/%(sdist_filename)s"),
+                  WithProperties("%(sdist_filename)s"))]
+
+        if self.build_eggs:
+            f.addStep(BuildEggs,
+                      pyvers=pyvers,
+                      python_format="../build-py%s/bin/python",
+                      workdir=self.workdir,
+                      env=self.env)
+
+            for pyver in pyvers:
+                prop_name = "egg_filename_py%s" % pyver.replace(".", "")
+                files.append((WithProperties("dist/%%(%s)s" % prop_name),
+                              WithProperties("%%(%s)s" % prop_name)))
+
+        if self.upload_path:
+            f.addStep(UploadDist,
+                      default_upload_path=self.upload_path,
+                      files=files,
+                      workdir=self.workdir)
+
 
 class CustomTrigger(Trigger):
     haltOnFailure = True
@@ -477,3 +1493,31 @@ class CustomTrigger(Trigger):
         Trigger.start(self)
 
         self.waitForFinish = self.myWaitForFinish
+
+
+class SnapshotNightly(Nightly):
+    """
+    A Nightly scheduler that sets the snapshot property of its builds to
+    the UTC date its target's nightly started on, so every build of one
+    nightly, and the builds they trigger, share a snapshot even if they run
+    past midnight. snapshot_offset is the number of seconds this scheduler
+    is staggered after the start of the nightly.
+    """
+    compare_attrs = Nightly.compare_attrs + ('snapshot_offset',)
+
+    def __init__(self, snapshot_offset=0, *args, **kwargs):
+        Nightly.__init__(self, *args, **kwargs)
+        self.snapshot_offset = snapshot_offset
+        self.run_time = None
+
+    def doPeriodicBuild(self):
+        self.run_time = self.nextRunTime or time.time()
+        Nightly.doPeriodicBuild(self)
+
+    def submitBuildSet(self, bs):
+        bs.properties.setProperty(
+            "snapshot",
+            time.strftime("%Y-%m-%d",
+                          time.gmtime(self.run_time - self.snapshot_offset)),
+            "Scheduler")
+        Nightly.submitBuildSet(self, bs)
@@ -0,0 +1,145 @@
+"""
+Pinned dependency sets shared between the builders of a nightly.
+
+The first nightly builder to install a set of egg_deps for a Python
+version resolves them against the package index as usual, and the exact
+versions it ended up with are stored here. Every other builder installing
+the same egg_deps from the same find_links for the same combination and
+Python version in that nightly snapshot installs those exact versions, without re-resolving, so one nightly tests
+a single consistent set of dependencies. Builders that start while the
+first is still resolving claim() the key after it, and wait until it's
+released.
+
+Each lock set is stored in its own file, <path>/<key>, with one
+"<name>==<version>" line per distribution. Lock sets older than max_age
+seconds are removed.
+"""
+import os
+import time
+
+from twisted.internet import defer
+
+from util import sha1
+
+
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+
+def get_lock_key(packages, pyver, snapshot, find_links=[],
+                 combination=None):
+    """
+    Returns the key of the lock set for installing packages under a
+    Python version, for one nightly snapshot (the snapshot property).
+
+    Different find_links (which include the upload URL of the builds
+    being tested) or combinations can resolve to different versions, so
+    they get lock sets of their own.
+    """
+    return sha1("%s\n%s\n%s\n%s\n%r" % (" ".join(sorted(set(packages))),
+                                       pyver, snapshot, " ".join(find_links),
+                                       combination)).hexdigest()
+
+
+class DependencyLockStore(object):
+    def __init__(self, path, max_age=DEFAULT_MAX_AGE):
+        self.path = os.path.abspath(path)
+        self.max_age = max_age
+        self.claims = {}
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def get_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """
+        Returns the pinned "<name>==<version>" requirements stored for a
+        key, or None.
+        """
+        try:
+            f = open(self.get_path(key), "r")
+        except IOError:
+            return None
+
+        try:
+            return [line.strip() for line in f if line.strip()]
+        finally:
+            f.close()
+
+    def claim(self, key):
+        """
+        Claims resolving the pins for a key. Returns None if the caller
+        should resolve them, and then call release(). Otherwise, returns a
+        Deferred that fires once the current claim on the key is released.
+        """
+        if key in self.claims:
+            d = defer.Deferred()
+            self.claims[key].append(d)
+            return d
+
+        self.claims[key] = []
+
+        return None
+
+    def cancel(self, key, d):
+        """
+        Stops waiting on a key with a Deferred returned by claim().
+        """
+        if d in self.claims.get(key, []):
+            self.claims[key].remove(d)
+
+    def release(self, key):
+        """
+        Releases the claim on a key, waking up everyone waiting on it.
+        """
+        for d in self.claims.pop(key, []):
+            d.callback(None)
+
+    def put(self, key, pins):
+        """
+        Stores the pinned requirements for a key, unless another builder
+        has already stored some. Returns the pins now stored for the key.
+        """
+        existing = self.get(key)
+
+        if existing is not None:
+            return existing
+
+        tmp_path = self.get_path(".%s.tmp" % key)
+        f = open(tmp_path, "w")
+
+        try:
+            for pin in sorted(pins):
+                f.write("%s\n" % pin)
+        finally:
+            f.close()
+
+        os.rename(tmp_path, self.get_path(key))
+        self.prune()
+
+        return sorted(pins)
+
+    def prune(self):
+        cutoff = time.time() - self.max_age
+
+        for name in os.listdir(self.path):
+            filename = self.get_path(name)
+
+            if os.path.getmtime(filename) < cutoff:
+                os.unlink(filename)
+
+
+_stores = {}
+
+
+def get_dependency_lock_store(path):
+    """
+    Returns the shared DependencyLockStore for a directory.
+    """
+    path = os.path.abspath(path)
+
+    if path not in _stores:
+        _stores[path] = DependencyLockStore(path)
+
+    return _stores[path]
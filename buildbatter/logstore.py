@@ -0,0 +1,329 @@
+"""
+Compressed, chunked storage for large step logs.
+
+A chunked log is a file of zlib-compressed chunks, each ending on a line
+boundary, plus an index file giving the offset, compressed size and line
+count of every chunk. Any chunk can be read without decompressing the
+ones before it, so logs can be paged through and parsed as streams
+without ever being held in memory whole.
+
+Steps using ChunkedLogMixin write their logs next to buildbot's own log
+files, as "<logfile>.chunks". Text past a size cap is never added to
+buildbot's own copy of those logs, so the master only keeps one full copy
+of a large log. Buildbot's log pages still load that capped copy whole;
+only ChunkedLogResource serves logs lazily, a page at a time. To page
+through the full logs on the web, add one to the WebStatus in master.cfg:
+
+    web = html.WebStatus(http_port=8010)
+    web.putChild("chunked-logs", ChunkedLogResource(basedir))
+    c['status'].append(web)
+
+Logs are then served at /chunked-logs/<builddir>/<logfile>?chunk=N.
+"""
+import cgi
+import os
+import zlib
+
+from buildbot.interfaces import ILogFile
+from buildbot.process.buildstep import BuildStep, LogObserver
+from buildbot.status.builder import HEADER, STDERR, STDOUT
+from twisted.web import resource
+from zope.interface import implements
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_MAX_LOG_SIZE = 256 * 1024
+
+INDEX_SUFFIX = ".index"
+
+
+class ChunkedLogWriter(object):
+    """
+    Writes text to a chunked log.
+
+    Text is buffered until at least chunk_size bytes are waiting, and then
+    written out as one compressed chunk ending on the last full line.
+    """
+    def __init__(self, filename, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        self.offset = 0
+        self.datafile = open(filename, "wb")
+        self.indexfile = open(filename + INDEX_SUFFIX, "w")
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+
+        if self.buffered >= self.chunk_size:
+            data = "".join(self.buffer)
+            i = data.rfind("\n") + 1
+
+            if i == 0:
+                i = len(data)
+
+            self.buffer = [data[i:]]
+            self.buffered = len(data) - i
+            self._writeChunk(data[:i])
+
+    def close(self):
+        if self.buffered:
+            self._writeChunk("".join(self.buffer))
+
+        self.buffer = []
+        self.buffered = 0
+        self.datafile.close()
+        self.indexfile.close()
+
+    def _writeChunk(self, data):
+        compressed = zlib.compress(data)
+
+        self.datafile.write(compressed)
+        self.datafile.flush()
+        self.indexfile.write("%d %d %d\n" % (self.offset, len(compressed),
+                                             data.count("\n")))
+        self.indexfile.flush()
+        self.offset += len(compressed)
+
+
+class ChunkedLog(object):
+    """
+    Reads a chunked log written by ChunkedLogWriter.
+
+    Chunks that are still being written are picked up by calling
+    loadIndex() again.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.loadIndex()
+
+    def loadIndex(self):
+        self.index = []
+        f = open(self.filename + INDEX_SUFFIX, "r")
+
+        try:
+            for line in f:
+                offset, length, num_lines = line.split()
+                self.index.append((int(offset), int(length), int(num_lines)))
+        finally:
+            f.close()
+
+    def getNumChunks(self):
+        return len(self.index)
+
+    def getNumLines(self):
+        return sum([num_lines for offset, length, num_lines in self.index])
+
+    def getChunk(self, i):
+        offset, length, num_lines = self.index[i]
+        f = open(self.filename, "rb")
+
+        try:
+            f.seek(offset)
+
+            return zlib.decompress(f.read(length))
+        finally:
+            f.close()
+
+    def iterChunks(self, start=0):
+        for i in range(start, len(self.index)):
+            yield self.getChunk(i)
+
+    def iterLines(self):
+        leftover = ""
+
+        for chunk in self.iterChunks():
+            lines = (leftover + chunk).split("\n")
+            leftover = lines.pop()
+
+            for line in lines:
+                yield line
+
+        if leftover:
+            yield leftover
+
+
+class ChunkedLogObserver(LogObserver):
+    """
+    Copies the stdout and stderr of a step log into a chunked log stored
+    alongside it.
+    """
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.writer = None
+
+    def setLog(self, loog):
+        self.writer = ChunkedLogWriter(loog.getFilename() + ".chunks",
+                                       self.chunk_size)
+        LogObserver.setLog(self, loog)
+        loog.waitUntilFinished().addCallback(self._logFinished)
+
+    def outReceived(self, data):
+        self.writer.write(data)
+
+    def errReceived(self, data):
+        self.writer.write(data)
+
+    def _logFinished(self, loog):
+        self.writer.close()
+
+
+class CappedLogFile:
+    """
+    Adds the text of a step log to buildbot's LogFile until about max_size
+    bytes are stored, and leaves the rest out.
+
+    Text past the cap is still passed to the step's observers of the log,
+    so they see the whole log.
+    """
+    implements(ILogFile)
+
+    def __init__(self, loog, max_size, observers):
+        self.loog = loog
+        self.max_size = max_size
+        self.observers = observers
+        self.stored = 0
+        self.capped = False
+
+    def getName(self):
+        return self.loog.getName()
+
+    def addStdout(self, text):
+        if self._store(text):
+            self.loog.addStdout(text)
+        else:
+            self._notify(STDOUT, text)
+
+    def addStderr(self, text):
+        if self._store(text):
+            self.loog.addStderr(text)
+        else:
+            self._notify(STDERR, text)
+
+    def addHeader(self, text):
+        if self._store(text):
+            self.loog.addHeader(text)
+
+    def finish(self):
+        self.loog.finish()
+
+    def _store(self, text):
+        if self.stored < self.max_size:
+            self.stored += len(text)
+            return True
+
+        if not self.capped:
+            self.capped = True
+            self.loog.addHeader("\n[log capped at %d bytes; the full log is "
+                                "in %s.chunks]\n" %
+                                (self.max_size,
+                                 os.path.basename(self.loog.getFilename())))
+
+        return False
+
+    def _notify(self, channel, text):
+        step_status = self.loog.getStep()
+
+        for observer in self.observers:
+            observer.logChunk(step_status.getBuild(), step_status, self.loog,
+                              channel, text)
+
+
+class ChunkedLogMixin:
+    """
+    Stores the logs named in chunked_logs as chunked logs. Buildbot's own
+    copies of those logs are capped at max_log_size bytes. Steps call
+    addChunkedLogObservers from their constructors.
+    """
+    chunked_logs = ("stdio",)
+    max_log_size = DEFAULT_MAX_LOG_SIZE
+    log_observers = None
+
+    def addChunkedLogObservers(self):
+        for logname in self.chunked_logs:
+            self.addLogObserver(logname, ChunkedLogObserver())
+
+    def addLogObserver(self, logname, observer):
+        BuildStep.addLogObserver(self, logname, observer)
+
+        if self.log_observers is None:
+            self.log_observers = {}
+
+        self.log_observers.setdefault(logname, []).append(observer)
+
+    def addLog(self, name):
+        loog = BuildStep.addLog(self, name)
+
+        if name in self.chunked_logs:
+            if self.log_observers is None:
+                self.log_observers = {}
+
+            return CappedLogFile(loog, self.max_log_size,
+                                 self.log_observers.setdefault(name, []))
+
+        return loog
+
+
+class ChunkedLogResource(resource.Resource):
+    """
+    Serves chunked logs one page (chunk) at a time.
+
+    Logs are looked up under the master's basedir, as
+    <builddir>/<logfile>?chunk=N.
+    """
+    isLeaf = True
+
+    def __init__(self, basedir):
+        resource.Resource.__init__(self)
+        self.basedir = os.path.abspath(basedir)
+
+    def render_GET(self, request):
+        path = [part for part in request.postpath if part]
+
+        # Path segments arrive unquoted, so they may hold slashes.
+        if (len(path) != 2 or
+            [part for part in path
+             if part.startswith(".") or "/" in part or os.sep in part]):
+            request.setResponseCode(404)
+            return "Not found"
+
+        filename = os.path.join(self.basedir, path[0], path[1] + ".chunks")
+
+        if (not os.path.realpath(filename).startswith(
+                os.path.realpath(self.basedir) + os.sep) or
+            not os.path.exists(filename + INDEX_SUFFIX)):
+            request.setResponseCode(404)
+            return "Not found"
+
+        log = ChunkedLog(filename)
+
+        try:
+            i = int(request.args.get("chunk", ["0"])[0])
+        except ValueError:
+            i = 0
+
+        i = max(0, min(i, log.getNumChunks() - 1))
+
+        if log.getNumChunks():
+            text = log.getChunk(i)
+        else:
+            text = ""
+
+        links = []
+
+        if i > 0:
+            links.append('<a href="?chunk=%d">previous</a>' % (i - 1))
+
+        if i + 1 < log.getNumChunks():
+            links.append('<a href="?chunk=%d">next</a>' % (i + 1))
+
+        request.setHeader("content-type", "text/html")
+
+        return ("<html><head><title>%s</title></head><body>"
+                "<p>page %d of %d %s</p><pre>%s</pre>"
+                "<p>%s</p></body></html>" %
+                (cgi.escape(path[1]), i + 1, log.getNumChunks(),
+                 " ".join(links), cgi.escape(text), " ".join(links)))
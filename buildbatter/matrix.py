@@ -0,0 +1,132 @@
+def is_combination(value):
+    """
+    Returns whether a value is a single (target, branch) combination,
+    rather than a list of them.
+    """
+    if isinstance(value, tuple):
+        return True
+
+    return (isinstance(value, list) and len(value) == 2 and
+            isinstance(value[0], str) and isinstance(value[1], str))
+
+
+class MatrixRule(object):
+    """
+    A predicate over one cell of the build matrix.
+
+    Each keyword names a field of the cell and gives either a single value
+    or a list of values the field must match. Fields that aren't given
+    match anything. Combinations may be given as tuples or lists. For
+    example:
+
+        MatrixRule(pyver="2.4", combination=[("djblets", "trunk")])
+    """
+    FIELDS = ("target", "branch", "combination", "pyver", "sandbox")
+
+    def __init__(self, **criteria):
+        self.criteria = []
+
+        for field, values in criteria.items():
+            if field not in self.FIELDS:
+                raise TypeError("Unknown matrix field '%s'" % field)
+
+            if field == "combination":
+                if is_combination(values):
+                    values = [values]
+
+                values = [tuple(value) for value in values]
+            elif not isinstance(values, (list, set, frozenset)):
+                values = [values]
+
+            self.criteria.append((self.FIELDS.index(field),
+                                  frozenset(values)))
+
+    def matches(self, cell):
+        for i, values in self.criteria:
+            if cell[i] not in values:
+                return False
+
+        return True
+
+
+class MatrixFilter(object):
+    """
+    Decides which cells of the build matrix get builders.
+
+    A cell is a (target, branch, combination, pyver, sandbox) tuple, where
+    target and branch are names. If include rules are given, a cell must
+    match at least one of them. It must not match any exclude rule. Rules
+    may be MatrixRule instances or dictionaries of MatrixRule arguments.
+
+    If pairwise is set, per-commit builds only run a subset of each
+    branch's combinations and pyvers. The subset still pairs every
+    dependency with every pyver and covers every dependency branch at least
+    once. The full matrix remains available to nightlies and triggered
+    builds.
+    """
+    def __init__(self, include=[], exclude=[], pairwise=False):
+        self.include = [self._make_rule(rule) for rule in include]
+        self.exclude = [self._make_rule(rule) for rule in exclude]
+        self.pairwise = pairwise
+
+    def allows(self, target, branch, combination, pyver, sandbox=False):
+        cell = (target, branch, tuple(combination), pyver, bool(sandbox))
+
+        if self.include:
+            for rule in self.include:
+                if rule.matches(cell):
+                    break
+            else:
+                return False
+
+        for rule in self.exclude:
+            if rule.matches(cell):
+                return False
+
+        return True
+
+    def get_commit_cells(self, cells):
+        """
+        Returns the (combination, pyver) cells that per-commit builds
+        should run, out of the given list of allowed cells, in the same
+        order.
+        """
+        if not self.pairwise:
+            return list(cells)
+
+        cell_pairs = []
+        uncovered = set()
+
+        for combination, pyver in cells:
+            pairs = self._get_pairs(combination, pyver)
+            cell_pairs.append(((combination, pyver), pairs))
+            uncovered.update(pairs)
+
+        selected = set()
+
+        while uncovered:
+            best_cell = None
+            best_count = 0
+
+            for cell, pairs in cell_pairs:
+                count = len(pairs & uncovered)
+
+                if count > best_count:
+                    best_cell = cell
+                    best_count = count
+                    best_pairs = pairs
+
+            selected.add(best_cell)
+            uncovered -= best_pairs
+
+        return [cell for cell in cells if cell in selected]
+
+    def _get_pairs(self, combination, pyver):
+        return frozenset([("pyver", combination[0], pyver),
+                          ("branch", combination[0], combination[1])])
+
+    def _make_rule(self, rule):
+        if isinstance(rule, MatrixRule):
+            return rule
+
+        return MatrixRule(**rule)
@@ -0,0 +1,305 @@
+import bisect
+
+from buildbot import util
+from buildbot.status.base import StatusReceiverMultiService
+from twisted.application import strports
+from twisted.web import resource, server
+
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+DEFAULT_PORT = 9100
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{%s}" % ",".join([
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\")
+                                    .replace('"', '\\"')
+                                    .replace("\n", "\\n"))
+        for key, value in labels
+    ])
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    A named metric, holding one value per set of labels.
+    """
+    metric_type = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def clear(self):
+        self.values = {}
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.metric_type),
+        ]
+
+        for labels, value in sorted(self.values.items()):
+            lines.extend(self.renderValue(labels, value))
+
+        return lines
+
+    def renderValue(self, labels, value):
+        return ["%s%s %s" % (self.name, _format_labels(labels),
+                             _format_value(value))]
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        if key not in self.values:
+            self.values[key] = ([0] * len(self.buckets), [0])
+
+        counts, total = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def renderValue(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+
+        for bucket, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (
+                self.name,
+                _format_labels(labels + (("le", _format_value(bucket)),)),
+                cumulative))
+
+        lines.append("%s_sum%s %s" % (self.name, _format_labels(labels),
+                                      _format_value(total[0])))
+        lines.append("%s_count%s %d" % (self.name, _format_labels(labels),
+                                        cumulative))
+
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    Holds all metrics, creating each one the first time it's requested.
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name, help):
+        return self._get_metric(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._get_metric(Gauge, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        if name not in self.metrics:
+            self.metrics[name] = Histogram(name, help, buckets)
+
+        return self.metrics[name]
+
+    def render(self):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        for name in sorted(self.metrics.keys()):
+            lines.extend(self.metrics[name].render())
+
+        return "\n".join(lines) + "\n"
+
+    def _get_metric(self, metric_class, name, help):
+        if name not in self.metrics:
+            self.metrics[name] = metric_class(name, help)
+
+        return self.metrics[name]
+
+
+registry = MetricsRegistry()
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, exporter):
+        resource.Resource.__init__(self)
+        self.exporter = exporter
+
+    def render_GET(self, request):
+        self.exporter.updateGauges()
+        request.setHeader("content-type", "text/plain; version=0.0.4")
+
+        return self.exporter.registry.render()
+
+
+class MetricsExporter(StatusReceiverMultiService):
+    """
+    Serves buildbatter's metrics over HTTP at /metrics.
+
+    Add this to c['status'] in master.cfg. Build, queue and slave metrics
+    are collected from the master's status. Pollers, schedulers, steps and
+    the artifact and test result stores report into the same registry as
+    they run.
+
+    If port isn't given, it's DEFAULT_PORT plus shard, so sharded masters
+    on one host each get their own port. Pass the master's shard index.
+    An integer port only listens on localhost. To let a Prometheus server
+    on another host scrape it, pass a strports string instead, such as
+    "tcp:9100".
+    """
+    compare_attrs = ["port"]
+
+    def __init__(self, port=None, registry=registry, shard=0):
+        StatusReceiverMultiService.__init__(self)
+
+        if port is None:
+            port = DEFAULT_PORT + shard
+
+        self.port = port
+        self.registry = registry
+        self.master = None
+        self.status = None
+
+        root = resource.Resource()
+        root.putChild("metrics", MetricsResource(self))
+
+        if isinstance(port, int):
+            port = "tcp:%d:interface=127.0.0.1" % port
+
+        strports.service(port, server.Site(root)).setServiceParent(self)
+
+    def setServiceParent(self, parent):
+        StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master = parent
+        self.status = parent.getStatus()
+        self.status.subscribe(self)
+
+    def disownServiceParent(self):
+        self.status.unsubscribe(self)
+
+        return StatusReceiverMultiService.disownServiceParent(self)
+
+    def builderAdded(self, builderName, builder):
+        return self
+
+    def buildStarted(self, builderName, build):
+        latency = self.registry.histogram(
+            "buildbatter_change_to_build_seconds",
+            "Time from a change being committed to its build starting.")
+        now = util.now()
+
+        for change in build.getChanges():
+            if change.when:
+                latency.observe(now - change.when, builder=builderName)
+
+    def buildFinished(self, builderName, build, results):
+        start, end = build.getTimes()
+
+        self.registry.counter(
+            "buildbatter_builds_total",
+            "Finished builds by builder and result.").inc(
+                builder=builderName, result=results)
+        self.registry.histogram(
+            "buildbatter_build_duration_seconds",
+            "Duration of finished builds.").observe(
+                end - start, builder=builderName)
+
+    def updateGauges(self):
+        """
+        Updates the gauges that are sampled from the master's status.
+        """
+        queue_depth = self.registry.gauge(
+            "buildbatter_builder_queue_depth",
+            "Build requests waiting for each builder.")
+        oldest_request = self.registry.gauge(
+            "buildbatter_builder_oldest_request_seconds",
+            "Age of the oldest waiting build request for each builder.")
+        running = self.registry.gauge(
+            "buildbatter_slave_running_builds",
+            "Builds currently running on each slave.")
+        utilization = self.registry.gauge(
+            "buildbatter_slave_utilization",
+            "Running builds as a fraction of each slave's capacity.")
+        connected = self.registry.gauge(
+            "buildbatter_slave_connected",
+            "Whether each slave is connected.")
+
+        for metric in (queue_depth, oldest_request, running, utilization,
+                       connected):
+            metric.clear()
+
+        now = util.now()
+        slave_builds = {}
+
+        for builder_name in self.status.getBuilderNames():
+            builder_status = self.status.getBuilder(builder_name)
+            pending = builder_status.getPendingBuilds()
+
+            queue_depth.set(len(pending), builder=builder_name)
+
+            if pending:
+                oldest_request.set(
+                    now - min([request.getSubmitTime()
+                               for request in pending]),
+                    builder=builder_name)
+
+            for build in builder_status.getCurrentBuilds():
+                slavename = build.getSlavename()
+                slave_builds[slavename] = slave_builds.get(slavename, 0) + 1
+
+        slaves = self.master.botmaster.slaves
+
+        for slavename in self.status.getSlaveNames():
+            num_builds = slave_builds.get(slavename, 0)
+            capacity = getattr(slaves.get(slavename), "max_builds", None)
+
+            running.set(num_builds, slave=slavename)
+            connected.set(int(self.status.getSlave(slavename).isConnected()),
+                          slave=slavename)
+
+            if capacity:
+                utilization.set(float(num_builds) / capacity, slave=slavename)
@@ -1,9 +1,16 @@
+import re
+
+from buildbot import locks, util
 from buildbot.changes import svnpoller
 from buildbot.changes.changes import Change
 from buildbot.scheduler import Scheduler
 from buildbot.steps import source
+from buildbot.steps.shell import ShellCommand
 from twisted.web import html
 
+from metrics import registry
+from util import get_lock
+
 
 def custom_get_HTML_box(self, url):
     """
@@ -25,6 +32,20 @@ def custom_get_HTML_box(self, url):
 Change.get_HTML_box = custom_get_HTML_box
 
 
+def shell_quote(s):
+    """
+    Quotes a string for safe use in a /bin/sh command line.
+    """
+    return "'%s'" % s.replace("'", "'\\''")
+
+
+def get_mirror_name(url):
+    """
+    Returns a filesystem-safe name for a mirror of the given repository URL.
+    """
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', url).strip('_')
+
+
 class SVNPoller(svnpoller.SVNPoller):
     """
     Polls an SVN repository, attaching a repository name for filtering
@@ -34,12 +55,38 @@ class SVNPoller(svnpoller.SVNPoller):
         svnpoller.SVNPoller.__init__(self, svnurl, *args, **kwargs)
         self.repo_name = repo_name
 
+    def checksvn(self):
+        started = util.now()
+
+        def _recordPollTime(res):
+            registry.histogram(
+                "buildbatter_poll_duration_seconds",
+                "Time taken to poll a repository.").observe(
+                    util.now() - started, repo=self.repo_name)
+            return res
+
+        d = svnpoller.SVNPoller.checksvn(self)
+        d.addBoth(_recordPollTime)
+        return d
+
     def create_changes(self, new_logentries):
         changes = svnpoller.SVNPoller.create_changes(self, new_logentries)
+        now = util.now()
 
         for change in changes:
             change.repo_name = self.repo_name
 
+            registry.counter(
+                "buildbatter_changes_total",
+                "Changes found by pollers.").inc(repo=self.repo_name)
+
+            if change.when:
+                registry.histogram(
+                    "buildbatter_change_detection_seconds",
+                    "Time from a change being committed to being "
+                    "found by a poller.").observe(now - change.when,
+                                                  repo=self.repo_name)
+
         return changes
 
 
@@ -53,10 +100,17 @@ class RepoChangeScheduler(Scheduler):
         self.repo_names = repo_names
 
     def addChange(self, change):
+        changes = registry.counter(
+            "buildbatter_scheduler_changes_total",
+            "Changes seen by repository schedulers.")
+
         if (not hasattr(change, "repo_name") or
             change.repo_name in self.repo_names):
+            changes.inc(scheduler=self.name, action="accepted")
             return Scheduler.addChange(self, change)
 
+        changes.inc(scheduler=self.name, action="ignored")
+
 
 # TODO: Merge this and SVN in some form so we don't have so much duplicate
 #       code.
@@ -128,3 +182,92 @@ class SVN(source.SVN):
         s.patch = backup_patch
         s.revision = backup_revision
         self.alwaysUseLatest = backup_alwaysUseLatest
+
+
+class RepositoryMirror(ShellCommand):
+    """
+    Updates a repository mirror shared by every builder on a slave.
+
+    The mirror lives outside of any builder's builddir and is guarded by a
+    slave lock, so only one builder on a slave updates it at a time. Other
+    builders waiting on the lock will find it already up-to-date.
+    """
+    name = "update-mirror"
+    haltOnFailure = True
+    description = ["updating mirror"]
+    descriptionDone = ["mirror updated"]
+
+    def __init__(self, url, mirror_path, workdir, *args, **kwargs):
+        lock = get_lock(locks.SlaveLock,
+                        "mirror_%s" % get_mirror_name(mirror_path))
+        kwargs["locks"] = kwargs.get("locks", []) + [lock.access("exclusive")]
+
+        ShellCommand.__init__(self, workdir=".", *args, **kwargs)
+        self.command = self.getMirrorCommand(url, mirror_path, workdir)
+
+    def getMirrorCommand(self, url, mirror_path, workdir):
+        assert False
+
+
+class GitMirror(RepositoryMirror):
+    """
+    Maintains a bare mirror of a Git repository on the slave.
+
+    Builders check out from the mirror instead of the upstream repository,
+    and their clones borrow the mirror's objects through git alternates
+    rather than keeping their own copies. A builder without a clone yet
+    gets one made with --reference, so even the first clone doesn't copy
+    the mirror's objects.
+    """
+    name = "git-mirror"
+
+    def getMirrorCommand(self, url, mirror_path, workdir):
+        mirror = shell_quote(mirror_path)
+        git_dir = shell_quote("%s/.git" % workdir)
+
+        return ("if [ -d %(mirror)s ]; then"
+                " git --git-dir=%(mirror)s fetch -q;"
+                " else"
+                " mkdir -p `dirname %(mirror)s` &&"
+                " git clone -q --mirror %(url)s %(mirror)s;"
+                " fi &&"
+                " if [ -d %(git_dir)s ]; then"
+                " echo %(objects)s > %(git_dir)s/objects/info/alternates;"
+                " else"
+                " git clone -q --reference %(mirror)s %(mirror)s %(workdir)s;"
+                " fi" % {
+                    "url": shell_quote(url),
+                    "mirror": mirror,
+                    "workdir": shell_quote(workdir),
+                    "git_dir": git_dir,
+                    "objects": shell_quote("%s/objects" % mirror_path),
+                })
+
+
+class SVNMirror(RepositoryMirror):
+    """
+    Maintains a shared SVN working copy on the slave.
+
+    The working copy is synced into the builder's workdir after being
+    updated, leaving the builder's own checkout step with nothing to fetch.
+    The workdir's build and dist directories are left out of the sync, so
+    build outputs survive it.
+    """
+    name = "svn-mirror"
+
+    def getMirrorCommand(self, url, mirror_path, workdir):
+        mirror = shell_quote(mirror_path)
+
+        return ("if [ -d %(mirror)s/.svn ]; then"
+                " svn update -q %(mirror)s;"
+                " else"
+                " mkdir -p `dirname %(mirror)s` &&"
+                " svn checkout -q %(url)s %(mirror)s;"
+                " fi &&"
+                " mkdir -p %(workdir)s &&"
+                " rsync -a --delete --exclude /build/ --exclude /dist/"
+                " %(mirror)s/ %(workdir)s/" % {
+                    "url": shell_quote(url),
+                    "mirror": mirror,
+                    "workdir": shell_quote(workdir),
+                })
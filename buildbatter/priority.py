@@ -0,0 +1,149 @@
+"""
+Priority ordering for build requests.
+
+Requests are ranked by their source and by whether they're for a branch
+head. Each source has a delay, and a request is ordered as if it had been
+submitted that many seconds later than it really was. A sandbox request
+with a one hour delay therefore waits behind per-commit builds submitted up
+to an hour after it, but never longer, so nothing starves.
+
+This plugs into buildbot's master-level prioritizeBuilders hook (buildbot
+0.7.12 and newer; older masters ignore it), which decides which builder
+gets a free slave first. Buildbot 0.7 has no per-builder hook for
+choosing among a builder's own requests, so those still start oldest
+first:
+
+    queue = BuildRequestQueue()
+    manager = BuildManager(..., build_queue=queue)
+    c['builders'] = manager.get_builders()
+    c['prioritizeBuilders'] = queue.prioritizeBuilders
+
+Requests started by a CustomTrigger step carry a "triggered_by" property
+naming the triggering builder, which is how trigger requests are told
+apart from per-commit ones.
+"""
+import heapq
+
+
+DEFAULT_SOURCE_DELAYS = {
+    "commit": 0,
+    "trigger": 60,
+    "nightly": 30 * 60,
+    "sandbox": 60 * 60,
+}
+
+DEFAULT_NON_HEAD_DELAY = 5 * 60
+
+
+class BuildRequestQueue(object):
+    """
+    Orders build requests by source, branch and age.
+
+    source_delays maps each source ("commit", "trigger", "nightly" or
+    "sandbox") to its delay in seconds, and non_head_delay is added for
+    builds of branches other than a target's head.
+
+    Each builder's pending requests are kept in a heap of their effective
+    submit times. Buildbot has no event for requests leaving a builder's
+    queue, so the heap is synced with the queue on each call. Builders
+    only ever append new requests, so a call that finds nothing started or
+    cancelled since the last one only looks at the new requests at the
+    end of the queue, and adds each in O(log n). Once some have gone, one
+    pass over the builder's queue finds the ones still pending, and the
+    rest are dropped lazily as they reach the top of the heap.
+    """
+    def __init__(self, source_delays=DEFAULT_SOURCE_DELAYS,
+                 non_head_delay=DEFAULT_NON_HEAD_DELAY):
+        self.source_delays = source_delays
+        self.non_head_delay = non_head_delay
+        self.builder_info = {}
+        self.heaps = {}
+        self.queued = {}
+        self.seq = 0
+
+    def add_builder(self, name, sandbox=False, is_head=True):
+        self.builder_info[name] = (sandbox, is_head)
+
+    def get_source(self, builder_name, request):
+        """
+        Returns the source of a build request: "commit", "trigger",
+        "nightly" or "sandbox".
+        """
+        sandbox, is_head = self.builder_info.get(builder_name, (False, True))
+        reason = request.reason or ""
+
+        if sandbox:
+            return "sandbox"
+        elif (str(request.properties.getProperty("nightly")) == "True" or
+              reason.startswith("The Nightly scheduler")):
+            return "nightly"
+        elif request.properties.getProperty("triggered_by"):
+            return "trigger"
+
+        return "commit"
+
+    def get_key(self, builder_name, request):
+        """
+        Returns the effective submit time of a build request.
+        """
+        sandbox, is_head = self.builder_info.get(builder_name, (False, True))
+        key = (request.getSubmitTime() +
+               self.source_delays.get(self.get_source(builder_name, request),
+                                      0))
+
+        if not is_head:
+            key += self.non_head_delay
+
+        return key
+
+    def prioritizeBuilders(self, buildmaster, builders):
+        """
+        Returns the builders ordered by the effective submit time of their
+        next request. Builders with nothing to build come last.
+        """
+        ordered = []
+
+        for builder in builders:
+            heap = self._sync(builder.name, builder.buildable)
+
+            if heap:
+                ordered.append((heap[0][0], heap[0][1], builder))
+            else:
+                ordered.append((None, None, builder))
+
+        ordered.sort(key=lambda item: (item[0] is None, item[0], item[1]))
+
+        return [builder for key, seq, builder in ordered]
+
+    def _sync(self, builder_name, requests):
+        heap = self.heaps.setdefault(builder_name, [])
+        queued = self.queued.setdefault(builder_name, set())
+        new_requests = []
+
+        for request in reversed(requests):
+            if id(request) in queued:
+                break
+
+            new_requests.append(request)
+
+        for request in reversed(new_requests):
+            queued.add(id(request))
+            self.seq += 1
+            heapq.heappush(heap, (self.get_key(builder_name, request),
+                                  self.seq, request))
+
+        if len(queued) != len(requests):
+            # Requests have been started, merged or cancelled since the
+            # last call. Entries in the heap keep their requests alive, so
+            # their ids can't be reused by new requests.
+            queued = set([id(request) for request in requests])
+            self.queued[builder_name] = queued
+
+            if len(heap) > 2 * len(queued) + 16:
+                heap[:] = [entry for entry in heap if id(entry[2]) in queued]
+                heapq.heapify(heap)
+
+        while heap and id(heap[0][2]) not in queued:
+            heapq.heappop(heap)
+
+        return heap
@@ -0,0 +1,245 @@
+"""
+Diff-based reconfiguration of the pollers, schedulers and builders
+generated by a BuildManager.
+
+Each generated piece gets a stable description, built from the same
+attributes buildbot compares on reconfig, and a fingerprint of that
+description. The ConfigCache remembers the fingerprint and object of every
+piece from the last reconfig. Pieces that haven't changed are handed back
+to buildbot as the very same objects, so its comparisons are trivial and
+it leaves those builders, and the builds running on them, alone. Only
+added, removed and modified pieces are touched.
+
+Generating every builder only to find most of them unchanged is slow with
+many targets, so the cache also memoizes each target's builders by a
+fingerprint of what they're generated from. Targets that haven't changed
+aren't regenerated, and their builders aren't described again.
+
+The cache lives at module level, which survives master.cfg being
+re-executed on reconfig:
+
+    pollers, schedulers, builders, diff = manager.get_reconfig()
+    log.msg(diff.format())
+"""
+import types
+
+from util import sha1
+
+
+def describe(obj, _seen=None):
+    """
+    Returns a stable string description of a config object.
+
+    Objects with buildbot's compare_attrs are described by those
+    attributes. Other objects are described by their class and instance
+    dictionary.
+    """
+    if _seen is None:
+        _seen = set()
+
+    if obj is None or isinstance(obj, (bool, int, long, float, str,
+                                       unicode)):
+        return repr(obj)
+    elif isinstance(obj, (list, tuple)):
+        return "%s(%s)" % (type(obj).__name__,
+                           ", ".join([describe(item, _seen) for item in obj]))
+    elif isinstance(obj, (set, frozenset)):
+        return "set(%s)" % ", ".join(sorted([describe(item, _seen)
+                                             for item in obj]))
+    elif isinstance(obj, dict):
+        return "{%s}" % ", ".join(sorted([
+            "%s: %s" % (describe(key, _seen), describe(value, _seen))
+            for key, value in obj.items()
+        ]))
+    elif isinstance(obj, (type, types.ClassType)):
+        return "%s.%s" % (obj.__module__, obj.__name__)
+    elif isinstance(obj, types.MethodType):
+        return "%s.%s" % (describe(obj.im_class, _seen), obj.__name__)
+    elif isinstance(obj, (types.FunctionType, types.BuiltinFunctionType)):
+        return "%s.%s" % (obj.__module__, obj.__name__)
+
+    if id(obj) in _seen:
+        return "<cycle>"
+
+    _seen.add(id(obj))
+
+    cls = obj.__class__
+    compare_attrs = getattr(obj, "compare_attrs", None)
+
+    if compare_attrs is not None:
+        attrs = [(name, getattr(obj, name, None)) for name in compare_attrs]
+    else:
+        attrs = sorted(getattr(obj, "__dict__", {}).items())
+
+    result = "%s.%s(%s)" % (cls.__module__, cls.__name__, ", ".join([
+        "%s=%s" % (name, describe(value, _seen)) for name, value in attrs
+    ]))
+
+    _seen.discard(id(obj))
+
+    return result
+
+
+def get_fingerprint(obj):
+    return sha1(describe(obj)).hexdigest()
+
+
+class ConfigDiff(object):
+    """
+    The names of pieces added, removed and modified by a reconfig, for each
+    kind of piece ("pollers", "schedulers" or "builders").
+    """
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+        self.modified = {}
+
+    def is_empty(self):
+        for changes in (self.added, self.removed, self.modified):
+            for names in changes.values():
+                if names:
+                    return False
+
+        return True
+
+    def format(self):
+        lines = []
+
+        for kind in sorted(set(self.added.keys() + self.removed.keys() +
+                               self.modified.keys())):
+            for label, changes in (("added", self.added),
+                                   ("removed", self.removed),
+                                   ("modified", self.modified)):
+                names = changes.get(kind, [])
+
+                if names:
+                    lines.append("%s %s: %s" % (label, kind,
+                                                ", ".join(sorted(names))))
+
+        return "\n".join(lines) or "no changes"
+
+
+class ConfigCache(object):
+    """
+    Remembers the pieces of the last config, keyed by kind and name.
+
+    lock_generation is the util.get_lock_generation() the pieces were made
+    under.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.memos = {}
+        self.lock_generation = None
+
+    def update(self, kind, objects, get_name, diff):
+        """
+        Returns the objects to hand to buildbot for one kind of piece,
+        reusing cached objects whose fingerprint hasn't changed, and
+        records the changes in diff.
+
+        get_name returns a piece's name, or None for pieces that have no
+        name. Those are keyed by fingerprint, so a change to one shows up
+        as a removal and an addition.
+        """
+        old_entries = self.entries.get(kind, {})
+        new_entries = {}
+        result = []
+        added = diff.added.setdefault(kind, [])
+        modified = diff.modified.setdefault(kind, [])
+
+        for obj in objects:
+            name = get_name(obj)
+            old_entry = old_entries.get(name)
+
+            if old_entry is not None and old_entry[1] is obj:
+                # Memoized pieces come back as the cached objects, and
+                # don't need describing again.
+                fingerprint = old_entry[0]
+            else:
+                fingerprint = get_fingerprint(obj)
+
+            if name is None:
+                name = fingerprint
+
+            if name in new_entries:
+                # Keep repeated names apart, in order, so they don't
+                # overwrite each other's entries.
+                i = 2
+
+                while "%s#%d" % (name, i) in new_entries:
+                    i += 1
+
+                name = "%s#%d" % (name, i)
+
+            old_entry = old_entries.get(name)
+
+            if old_entry is None:
+                added.append(name)
+            elif old_entry[0] == fingerprint:
+                obj = old_entry[1]
+            else:
+                modified.append(name)
+
+            new_entries[name] = (fingerprint, obj)
+            result.append(obj)
+
+        diff.removed[kind] = [name for name in old_entries.keys()
+                              if name not in new_entries]
+        self.entries[kind] = new_entries
+
+        return result
+
+    def memoize(self, kind, name, fingerprint, generate, reuse=None):
+        """
+        Returns what generate() returned the last time it was called for
+        a name with the same fingerprint, or calls it again.
+
+        If reuse is given, it's called with the remembered value when that
+        is returned instead, to redo any side effects of generating it.
+        """
+        memos = self.memos.setdefault(kind, {})
+        memo = memos.get(name)
+
+        if memo is not None and memo[0] == fingerprint:
+            if reuse is not None:
+                reuse(memo[1])
+
+            return memo[1]
+
+        value = generate()
+        memos[name] = (fingerprint, value)
+
+        return value
+
+    def prune_memos(self, kind, names):
+        """
+        Forgets the remembered values of a kind other than those for the
+        given names.
+        """
+        names = set(names)
+        memos = self.memos.get(kind, {})
+
+        for name in memos.keys():
+            if name not in names:
+                del memos[name]
+
+    def invalidate(self, kind):
+        """
+        Forgets the remembered values of a kind, and makes the next update
+        treat each of its pieces as modified, even if its description
+        hasn't changed.
+        """
+        self.memos.pop(kind, None)
+        self.entries[kind] = dict([
+            (name, (None, obj))
+            for name, (fingerprint, obj) in self.entries.get(kind,
+                                                             {}).items()
+        ])
+
+    def clear(self):
+        self.entries = {}
+        self.memos = {}
+        self.lock_generation = None
+
+
+config_cache = ConfigCache()
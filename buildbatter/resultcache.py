@@ -0,0 +1,149 @@
+"""
+A cache of passing test results, keyed by a fingerprint of their inputs.
+
+NoseTests fingerprints the source tree it tests, the distributions its
+Python can import and the Python version, on the slave. When a suite
+passes, its statistics are stored under that fingerprint, so a later run
+with byte-identical inputs (such as the same target rebuilt for a
+combination whose other side didn't change) can replay them instead of
+running the suite again.
+
+Each result is stored in its own file, <path>/<aa>/<fingerprint>, as
+"<name> <value>" lines. Reading a result touches the file, and the least
+recently used results are dropped once there are more than max_results.
+"""
+import os
+import time
+
+from metrics import registry
+
+
+DEFAULT_MAX_RESULTS = 5000
+
+
+class TestResultCache(object):
+    def __init__(self, path, max_results=DEFAULT_MAX_RESULTS):
+        self.path = os.path.abspath(path)
+        self.max_results = max_results
+        self.used = {}
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        for dirname in os.listdir(self.path):
+            dirpath = os.path.join(self.path, dirname)
+
+            if os.path.isdir(dirpath):
+                for name in os.listdir(dirpath):
+                    if not name.startswith("."):
+                        self.used[name] = \
+                            os.path.getmtime(os.path.join(dirpath, name))
+
+    def get_path(self, fingerprint):
+        return os.path.join(self.path, fingerprint[:2], fingerprint)
+
+    def get(self, fingerprint):
+        """
+        Returns the stored results for a fingerprint as a dictionary, or
+        None.
+        """
+        lookups = registry.counter(
+            "buildbatter_test_result_cache_lookups_total",
+            "Test result cache lookups by result.")
+
+        if fingerprint not in self.used:
+            lookups.inc(result="miss")
+            return None
+
+        results = {}
+        filename = self.get_path(fingerprint)
+
+        try:
+            f = open(filename, "r")
+        except IOError:
+            del self.used[fingerprint]
+            lookups.inc(result="miss")
+            return None
+
+        try:
+            for line in f:
+                parts = line.rstrip("\n").split(" ", 1)
+
+                if len(parts) != 2:
+                    # A damaged entry, which is dropped.
+                    results = None
+                    break
+
+                results[parts[0]] = parts[1]
+        finally:
+            f.close()
+
+        if not results:
+            self.remove(fingerprint)
+            lookups.inc(result="miss")
+            return None
+
+        os.utime(filename, None)
+        self.used[fingerprint] = time.time()
+        lookups.inc(result="hit")
+
+        return results
+
+    def put(self, fingerprint, results):
+        """
+        Stores the results for a fingerprint, replacing any already
+        stored.
+        """
+        filename = self.get_path(fingerprint)
+        tmp_path = os.path.join(os.path.dirname(filename),
+                                ".%s.tmp" % fingerprint)
+
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+
+        f = open(tmp_path, "w")
+
+        try:
+            for name in sorted(results.keys()):
+                f.write("%s %s\n" % (name, results[name]))
+        finally:
+            f.close()
+
+        os.rename(tmp_path, filename)
+        self.used[fingerprint] = time.time()
+
+        self.prune()
+
+    def remove(self, fingerprint):
+        """
+        Removes the stored results for a fingerprint, if there are any.
+        """
+        self.used.pop(fingerprint, None)
+
+        if os.path.exists(self.get_path(fingerprint)):
+            os.unlink(self.get_path(fingerprint))
+
+    def prune(self):
+        if len(self.used) <= self.max_results:
+            return
+
+        fingerprints = sorted(self.used.keys(),
+                              key=lambda fingerprint: self.used[fingerprint])
+
+        for fingerprint in fingerprints[:len(self.used) - self.max_results]:
+            self.remove(fingerprint)
+
+
+_caches = {}
+
+
+def get_result_cache(path):
+    """
+    Returns the shared TestResultCache for a directory.
+    """
+    path = os.path.abspath(path)
+
+    if path not in _caches:
+        _caches[path] = TestResultCache(path)
+
+    return _caches[path]
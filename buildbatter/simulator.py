@@ -0,0 +1,329 @@
+"""
+A deterministic simulator for the schedulers and builders generated by a
+BuildManager.
+
+The simulator replays a synthetic stream of commits through the
+RepoChangeScheduler, Nightly and Triggerable schedulers, runs builds on
+modelled slaves using modelled step durations, and reports queue latency,
+slave utilization and makespan. No slaves or repositories are involved,
+so placement, coalescing and nightly staggering settings can be compared
+offline:
+
+    manager = ...  # as in master.cfg
+    commits = generate_commits(manager, duration=24 * 3600)
+    print Simulator(manager, placement="least-loaded").run(commits).format()
+"""
+import heapq
+import random
+import re
+
+from buildbot.scheduler import Nightly
+
+from timing import get_percentile, get_trigger_graph
+
+
+DEFAULT_STEP_DURATIONS = {
+    "VirtualEnv": 20,
+    "EasyInstall": 90,
+    "Git": 15,
+    "SVN": 15,
+    "GitMirror": 5,
+    "SVNMirror": 5,
+    "NoseTests": 300,
+    "BuildSDist": 20,
+    "BuildEgg": 25,
+    "BuildDists": 35,
+    "BuildEggs": 30,
+    "UploadDist": 5,
+    "CleanSlave": 60,
+}
+
+DEFAULT_DURATION = 2
+
+_pyver_re = re.compile(r'py(\d+\.\d+)$')
+
+
+def generate_commits(manager, duration, mean_interval=3600, seed=0):
+    """
+    Generates a list of (time, repository name) commits for every branch
+    of every target, with exponentially distributed gaps.
+    """
+    rng = random.Random(seed)
+    commits = []
+
+    for target in manager.target_list:
+        for branch in target.branches:
+            repo_name = "%s_%s" % (target.name, branch.name)
+            t = rng.expovariate(1.0 / mean_interval)
+
+            while t < duration:
+                commits.append((t, repo_name))
+                t += rng.expovariate(1.0 / mean_interval)
+
+    commits.sort()
+
+    return commits
+
+
+class SimulationResult(object):
+    """
+    The results of a simulation run.
+    """
+    def __init__(self, queue_latencies, slave_busy_time, makespan,
+                 num_builds, num_merged, slave_slots={}):
+        self.queue_latencies = queue_latencies
+        self.slave_busy_time = slave_busy_time
+        self.slave_slots = slave_slots
+        self.makespan = makespan
+        self.num_builds = num_builds
+        self.num_merged = num_merged
+
+    def get_slave_utilization(self):
+        """
+        Returns a dictionary mapping each slave name to the fraction of its
+        build slots' time over the makespan that was spent running builds.
+
+        A slave's slots are its capacity or, for slaves without one, the
+        most builds it ran at once.
+        """
+        utilization = {}
+
+        for slavename, busy_time in self.slave_busy_time.items():
+            slots = self.slave_slots.get(slavename) or 1
+
+            if self.makespan:
+                utilization[slavename] = busy_time / (slots * self.makespan)
+            else:
+                utilization[slavename] = 0.0
+
+        return utilization
+
+    def format(self):
+        latencies = self.queue_latencies
+        lines = [
+            "builds: %d (%d requests merged)" % (self.num_builds,
+                                                 self.num_merged),
+            "makespan: %.0fs" % self.makespan,
+        ]
+
+        if latencies:
+            lines.append("queue latency: mean %.0fs, p50 %.0fs, p95 %.0fs, "
+                         "max %.0fs" % (sum(latencies) / len(latencies),
+                                        get_percentile(latencies, 50),
+                                        get_percentile(latencies, 95),
+                                        max(latencies)))
+
+        for slavename, utilization in \
+            sorted(self.get_slave_utilization().items()):
+            lines.append("  %-30s %5.1f%% busy" % (slavename,
+                                                   utilization * 100))
+
+        return "\n".join(lines)
+
+
+class Simulator(object):
+    """
+    Simulates the builds a BuildManager's configuration would run.
+
+    placement is "static" to run each builder on its configured slave, or
+    "least-loaded" to run it on the least busy slave providing its Python
+    version. If coalesce is set, a new request for a builder is merged
+    into one that is already waiting, as buildbot does for compatible
+    requests. nightly_days is the number of days of nightly builds to
+    simulate.
+
+    step_durations maps step class names to mean durations in seconds,
+    which are varied by up to jitter (a fraction) using a seeded random
+    number generator.
+    """
+    def __init__(self, manager, placement="static", coalesce=True,
+                 step_durations=DEFAULT_STEP_DURATIONS, jitter=0.2,
+                 nightly_days=1, seed=0):
+        self.manager = manager
+        self.placement = placement
+        self.coalesce = coalesce
+        self.step_durations = step_durations
+        self.jitter = jitter
+        self.nightly_days = nightly_days
+        self.seed = seed
+
+        self.builders = {}
+
+        for builder in manager.get_builders():
+            self.builders[builder['name']] = builder
+
+        self.schedulers = manager.get_schedulers()
+        self.trigger_graph = get_trigger_graph(self.builders.values(),
+                                               self.schedulers)
+
+    def run(self, commits):
+        """
+        Runs the simulation over a list of (time, repository name) commits,
+        returning a SimulationResult.
+        """
+        self.rng = random.Random(self.seed)
+        self.events = []
+        self.event_seq = 0
+        self.pending = {}
+        self.building = set()
+        self.slave_builds = {}
+        self.slave_busy_time = {}
+        self.slave_peak_builds = {}
+        self.stable_timers = {}
+        self.queue_latencies = []
+        self.num_builds = 0
+        self.num_merged = 0
+        self.makespan = 0
+
+        for t, repo_name in commits:
+            self._addEvent(t, self._commit, repo_name)
+
+        for scheduler in self.schedulers:
+            if isinstance(scheduler, Nightly):
+                for day in range(self.nightly_days):
+                    t = (day * 86400 + scheduler.hour * 3600 +
+                         scheduler.minute * 60)
+                    self._addEvent(t, self._submit, scheduler.builderNames)
+
+        while self.events:
+            self.now, seq, callback, arg = heapq.heappop(self.events)
+            callback(arg)
+
+        slave_slots = {}
+
+        for slavename, peak_builds in self.slave_peak_builds.items():
+            slave_slots[slavename] = (self.get_slave_capacity(slavename) or
+                                      peak_builds)
+
+        return SimulationResult(self.queue_latencies, self.slave_busy_time,
+                                self.makespan, self.num_builds,
+                                self.num_merged, slave_slots)
+
+    def get_build_duration(self, builder_name):
+        duration = 0
+
+        for step_class, kwargs in self.builders[builder_name]['factory'].steps:
+            mean = self.step_durations.get(step_class.__name__,
+                                           DEFAULT_DURATION)
+            duration += mean * (1 + self.rng.uniform(-self.jitter,
+                                                     self.jitter))
+
+        return duration
+
+    def get_slave_capacity(self, slavename):
+        manager = self.manager
+        capacity = manager.slave_capacities.get(slavename,
+                                                manager.slave_capacity)
+
+        if capacity is None and manager.slave_registry:
+            slave = manager.slave_registry.get(slavename)
+
+            if slave:
+                capacity = slave.capacity
+
+        return capacity
+
+    def _addEvent(self, t, callback, arg):
+        self.event_seq += 1
+        heapq.heappush(self.events, (t, self.event_seq, callback, arg))
+
+    def _commit(self, repo_name):
+        for scheduler in self.schedulers:
+            if repo_name in getattr(scheduler, "repo_names", []):
+                # Each change restarts the scheduler's tree stable timer.
+                self.stable_timers[scheduler.name] = \
+                    self.now + scheduler.treeStableTimer
+                self._addEvent(self.now + scheduler.treeStableTimer,
+                               self._stableTimerFired, scheduler)
+
+    def _stableTimerFired(self, scheduler):
+        if self.stable_timers.get(scheduler.name) == self.now:
+            del self.stable_timers[scheduler.name]
+            self._submit(scheduler.builderNames)
+
+    def _submit(self, builder_names):
+        for name in builder_names:
+            if name not in self.builders:
+                continue
+
+            requests = self.pending.setdefault(name, [])
+
+            if self.coalesce and requests:
+                self.num_merged += 1
+            else:
+                requests.append(self.now)
+
+        self._dispatch()
+
+    def _dispatch(self):
+        waiting = []
+
+        for name, requests in self.pending.items():
+            if requests and name not in self.building:
+                waiting.append((requests[0], name))
+
+        waiting.sort()
+
+        for submitted, name in waiting:
+            slavename = self._placeBuild(name)
+
+            if slavename is not None:
+                self._startBuild(name, slavename)
+
+    def _placeBuild(self, builder_name):
+        builder = self.builders[builder_name]
+
+        if self.placement == "least-loaded":
+            m = _pyver_re.search(builder_name)
+
+            if m:
+                candidates = self.manager.slave_info.get(m.group(1), [])
+            else:
+                candidates = [builder['slavename']]
+        else:
+            candidates = [builder['slavename']]
+
+        best = None
+
+        for slavename in candidates:
+            num_builds = self.slave_builds.get(slavename, 0)
+            capacity = self.get_slave_capacity(slavename)
+
+            if capacity is not None and num_builds >= capacity:
+                continue
+
+            if best is None or num_builds < self.slave_builds.get(best, 0):
+                best = slavename
+
+        return best
+
+    def _startBuild(self, builder_name, slavename):
+        submitted = self.pending[builder_name].pop(0)
+        duration = self.get_build_duration(builder_name)
+
+        self.queue_latencies.append(self.now - submitted)
+        self.num_builds += 1
+        self.building.add(builder_name)
+        self.slave_builds[slavename] = self.slave_builds.get(slavename, 0) + 1
+        self.slave_peak_builds[slavename] = max(
+            self.slave_peak_builds.get(slavename, 0),
+            self.slave_builds[slavename])
+        self.slave_busy_time[slavename] = \
+            self.slave_busy_time.get(slavename, 0) + duration
+
+        self._addEvent(self.now + duration, self._finishBuild,
+                       (builder_name, slavename))
+
+    def _finishBuild(self, arg):
+        builder_name, slavename = arg
+
+        self.makespan = self.now
+        self.building.discard(builder_name)
+        self.slave_builds[slavename] -= 1
+
+        triggered = self.trigger_graph.get(builder_name, [])
+
+        if triggered:
+            self._submit(triggered)
+        else:
+            self._dispatch()
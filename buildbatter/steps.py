@@ -1,14 +1,107 @@
+import os
 import re
-import subprocess
-
-from buildbot.process.buildstep import BuildStep, LogLineObserver
-from buildbot.process.properties import WithProperties
-from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE
+import urllib
+
+from buildbot import util
+from buildbot.interfaces import BuildSlaveTooOldError
+from buildbot.process.base import BuildRequest
+from buildbot.process.buildstep import BuildStep, LogLineObserver, \
+                                      RemoteShellCommand
+from buildbot.process.properties import Properties, WithProperties
+from buildbot.status.builder import SUCCESS, WARNINGS, FAILURE, EXCEPTION
 from buildbot.steps.shell import ShellCommand, Test
-from buildbot.steps.transfer import FileDownload, FileUpload
+from buildbot.steps.transfer import FileDownload, FileUpload, \
+                                   StatusRemoteCommand, _FileReader
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.spread import pb
+from twisted.web import resource
+
+from artifacts import get_artifact_store
+from deplock import get_dependency_lock_store, get_lock_key
+from logstore import ChunkedLogMixin
+from metrics import registry
+from resultcache import get_result_cache
+from util import SLAVE_CHECKSUM_SCRIPT, SLAVE_FINGERPRINT_SCRIPT, \
+                 SLAVE_GC_SCRIPT, SLAVE_MARK_BUILDDIR_SCRIPT, \
+                 SLAVE_PARALLEL_SCRIPT, SLAVE_RESOLVE_SCRIPT, \
+                 SLAVE_STACK_DUMP_SCRIPT, SLAVE_TEST_WATCHDOG_SCRIPT, \
+                 get_web_control, sha1
+
+
+# Blocks are sent as single PB messages, which are limited to 640KB.
+DEFAULT_UPLOAD_BLOCKSIZE = 256 * 1024
+
+
+class TimedStepMixin:
+    """
+    Records timing information for a step as step statistics.
+
+    "queue-wait" is the time spent waiting on locks, "wall-time" is the time
+    spent running, and "bytes-transferred" is the amount of data moved
+    between the slave and the master. These must come before the BuildStep
+    class in a step's base classes.
+    """
+    queued_at = None
+    started_at = None
+
+    def startStep(self, remote):
+        self.queued_at = util.now()
+        d = BuildStep.startStep(self, remote)
+        d.addCallback(self._recordTimings)
+        return d
+
+    def _startStep_2(self, res):
+        self.started_at = util.now()
+        return BuildStep._startStep_2(self, res)
+
+    def getBytesTransferred(self):
+        """
+        Returns the number of bytes moved between the slave and the master.
+
+        By default, this is the size of the step's logs.
+        """
+        return sum([getattr(log, "length", 0)
+                    for log in self.step_status.getLogs()])
+
+    def _recordTimings(self, results):
+        finished_at = util.now()
+        started_at = self.started_at or finished_at
+        queue_wait = started_at - self.queued_at
+        wall_time = finished_at - started_at
+        bytes_transferred = self.getBytesTransferred()
+
+        self.step_status.setStatistic("queue-wait", queue_wait)
+        self.step_status.setStatistic("wall-time", wall_time)
+        self.step_status.setStatistic("bytes-transferred", bytes_transferred)
+
+        registry.histogram(
+            "buildbatter_step_queue_wait_seconds",
+            "Time steps spent waiting on locks.").observe(
+                queue_wait, step=self.name)
+        registry.histogram(
+            "buildbatter_step_duration_seconds",
+            "Time steps spent running.").observe(wall_time, step=self.name)
+        registry.counter(
+            "buildbatter_step_bytes_total",
+            "Bytes moved between slaves and the master by steps.").inc(
+                bytes_transferred, step=self.name)
+
+        return results
+
+
+class StepLineObserver(LogLineObserver):
+    """
+    Passes each line of stdout and stderr to the step's outputLineReceived,
+    so output can be parsed as it arrives instead of read back in full.
+    """
+    def outLineReceived(self, line):
+        self.step.outputLineReceived(line)
 
+    def errLineReceived(self, line):
+        self.step.outputLineReceived(line)
 
-class PythonDistCommand(ShellCommand):
+
+class PythonDistCommand(TimedStepMixin, ShellCommand):
     """
     Builds a Python dist.
     """
@@ -17,11 +110,16 @@ class PythonDistCommand(ShellCommand):
     use_egg_info = False
     filename_prop = "dist_filename"
     filename_ext = "tar"
+    resource_class = "cpu-heavy"
 
     haltOnFailure = True
 
     filename = None
 
+    def __init__(self, *args, **kwargs):
+        ShellCommand.__init__(self, *args, **kwargs)
+        self.addLogObserver("stdio", StepLineObserver())
+
     def start(self):
         self.command = ["python", "setup.py"]
 
@@ -36,14 +134,16 @@ class PythonDistCommand(ShellCommand):
             else:
                 self.command.append("-Dr")
 
-        self.command.append(self.dist_command)
+        self.command.extend(self.getDistCommands())
 
         ShellCommand.start(self)
 
-    def commandComplete(self, cmd):
-        out = cmd.logs['stdio'].getText()
+    def getDistCommands(self):
+        return [self.dist_command]
+
+    def outputLineReceived(self, line):
         m = re.search(r'creating \'dist/([A-Za-z0-9_.-]+.%s)\'' %
-                      self.filename_ext, out)
+                      self.filename_ext, line)
 
         if m:
             self.setFilename(m.group(1))
@@ -95,65 +195,285 @@ class BuildSDist(PythonDistCommand):
         PythonDistCommand.__init__(self, *args, **kwargs)
         self.use_egg_info = use_egg_info
 
-    def commandComplete(self, cmd):
-        out = cmd.logs['stdio'].getText()
-        m = re.search(r'gzip -f9 dist/([A-Za-z0-9_.-]+.tar)', out)
+    def outputLineReceived(self, line):
+        m = re.search(r'gzip -f9 dist/([A-Za-z0-9_.-]+.tar)', line)
 
         if m:
             self.setFilename(m.group(1) + ".gz")
 
 
-class DownloadLatestBuild(FileDownload):
+class BuildDists(PythonDistCommand):
+    """
+    Builds a .tar.gz source distribution and, optionally, a Python egg in
+    a single setup.py run.
+
+    The interpreter and setuptools start once, and egg_info metadata is
+    only computed once, instead of once per dist. This sets the same
+    properties as BuildSDist and BuildEgg.
+    """
+    dist_type = "dists"
+
+    def __init__(self, use_egg_info=True, build_egg=True, *args, **kwargs):
+        PythonDistCommand.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(use_egg_info=use_egg_info,
+                                 build_egg=build_egg)
+        self.use_egg_info = use_egg_info
+        self.build_egg = build_egg
+        self.filenames = []
+
+    def getDistCommands(self):
+        if self.build_egg:
+            return ["sdist", "bdist_egg"]
+
+        return ["sdist"]
+
+    def outputLineReceived(self, line):
+        m = re.search(r'gzip -f9 dist/([A-Za-z0-9_.-]+.tar)', line)
+
+        if m:
+            self.setDistFilename("sdist_filename", m.group(1) + ".gz")
+            return
+
+        m = re.search(r'creating \'dist/([A-Za-z0-9_.-]+.egg)\'', line)
+
+        if m:
+            self.setDistFilename("egg_filename", m.group(1))
+
+    def setDistFilename(self, prop_name, filename):
+        self.filename = filename
+        self.filenames.append(filename)
+        self.setProperty(prop_name, filename, self.__class__.__name__)
+
+    def evaluateCommand(self, cmd):
+        if cmd.rc != 0 or len(self.filenames) < len(self.getDistCommands()):
+            return FAILURE
+
+        return SUCCESS
+
+    def getText(self, cmd, results):
+        if self.filenames:
+            return ["built"] + self.filenames
+
+        return ["no %s built" % self.dist_type]
+
+
+class ChecksumObserver(LogLineObserver):
+    """
+    Collects the "<checksum> <filename>" lines printed by
+    SLAVE_CHECKSUM_SCRIPT.
+    """
+    def __init__(self):
+        LogLineObserver.__init__(self)
+        self.checksums = {}
+
+    def outLineReceived(self, line):
+        parts = line.strip().split(" ", 1)
+
+        if len(parts) == 2:
+            self.checksums[parts[1]] = parts[0]
+
+
+class SlaveChecksumMixin:
+    """
+    Checksums files on a slave.
+    """
+    def getSlaveChecksums(self, filenames, logname="checksums"):
+        """
+        Checksums files relative to the step's workdir, returning a
+        Deferred firing with a dictionary mapping each filename that
+        exists to its checksum.
+        """
+        observer = ChecksumObserver()
+        self.addLogObserver(logname, observer)
+
+        cmd = RemoteShellCommand(self._getWorkdir(),
+                                 ["python", "-c", SLAVE_CHECKSUM_SCRIPT] +
+                                 filenames,
+                                 env=self.build.slaveEnvironment)
+        cmd.useLog(self.addLog(logname), True, "stdio")
+
+        d = self.runCommand(cmd)
+        d.addCallback(lambda res: observer.checksums)
+
+        return d
+
+
+class DownloadLatestBuild(TimedStepMixin, SlaveChecksumMixin, FileDownload):
     """
-    Downloads the latest build of a file from the master onto a slave.
+    Downloads the latest builds of one or more artifacts from the master's
+    artifact store onto a slave.
+
+    Each artifact is given as a (basename, extension, prop_name) tuple in
+    artifacts, or through the basename, extension and prop_name arguments
+    for a single artifact. The latest build of each is saved under its own
+    filename in slavedest, and prop_name is set to that path.
+
+    All artifacts are looked up in the store's manifest at once and then
+    downloaded one after another. If verify is set, files already on the
+    slave with the right checksum are skipped, and downloads are checked
+    against their checksums.
     """
     name = "download-latest-build"
+    haltOnFailure = True
+    resource_class = "transfer"
 
-    def __init__(self, build_dir, basename, extension, prop_name, **kwargs):
-        FileDownload.__init__(self, **kwargs)
+    def __init__(self, build_dir, basename=None, extension=None,
+                 prop_name=None, artifacts=[], slavedest=".", verify=True,
+                 blocksize=DEFAULT_UPLOAD_BLOCKSIZE, **kwargs):
+        FileDownload.__init__(self, mastersrc="", slavedest=slavedest,
+                              blocksize=blocksize, **kwargs)
         self.addFactoryArguments(build_dir=build_dir,
-                                 basename=prefix,
+                                 basename=basename,
                                  extension=extension,
-                                 prop_name=prop_name)
+                                 prop_name=prop_name,
+                                 artifacts=artifacts,
+                                 verify=verify)
         self.build_dir = build_dir
-        self.basename = prefix
-        self.extension = extension
-        self.prop_name = prop_name
+        self.verify = verify
+        self.artifacts = list(artifacts)
+
+        if basename is not None:
+            self.artifacts.insert(0, (basename, extension, prop_name))
+
+        self.bytes_downloaded = 0
 
     def describe(self, done=False):
-        return "finding latest build for %s" % self.basename
+        return ["finding latest build for"] + \
+               [basename for basename, extension, prop_name in self.artifacts]
 
     def start(self):
-        recent_build = None
-        recent_mtime = 0
+        if not self.slaveVersion("downloadFile"):
+            raise BuildSlaveTooOldError("slave is too old, does not know "
+                                        "about downloadFile")
 
-        for entry in os.listdir(self.build_dir):
-            full_path = os.path.abspath(os.path.join(self.build_dir, entry))
+        props = self.build.getProperties()
+        store = get_artifact_store(props.render(self.build_dir))
+        slavedest = props.render(self.slavedest)
+        self.downloads = []
+        missing = []
+
+        for basename, extension, prop_name in self.artifacts:
+            basename = props.render(basename)
+            entry = store.get_latest(basename, extension)
+
+            if entry:
+                dest = os.path.join(slavedest, entry.name)
+                self.downloads.append((store.get_path(entry.name), dest,
+                                       entry.checksum))
+                self.setProperty(prop_name, dest, "DownloadLatestBuild")
+            else:
+                missing.append(basename)
+
+        if missing:
+            self.step_status.setColor("red")
+            self.step_status.setText(["build not found"] + missing)
+            self.finished(FAILURE)
+            return
+
+        self.step_status.setText(["downloading"] +
+                                 [os.path.basename(dest)
+                                  for src, dest, checksum in self.downloads])
+        self.download_log = self.addLog("downloads")
+        self.skipped = []
+
+        if self.verify:
+            d = self.getSlaveChecksums([dest for src, dest, checksum
+                                        in self.downloads])
+        else:
+            d = defer.succeed({})
+
+        d.addCallback(self._downloadFiles)
+        d.addCallback(self._verifyDownloads)
+        d.addCallbacks(self._downloadsDone, self.failed)
+
+    def _downloadFiles(self, checksums):
+        d = defer.succeed(None)
+
+        for src, dest, checksum in self.downloads:
+            if checksum and checksums.get(dest) == checksum:
+                self.skipped.append(dest)
+                self.download_log.addStdout("%s is already up to date\n" %
+                                            dest)
+            else:
+                d.addCallback(self._downloadFile, src, dest)
 
-            if (os.path.isfile(full_path) and
-                entry.startswith(self.basename) and
-                entry.endswith("." + self.extension)):
+        return d
 
-                time = os.path.getmtime(full_path)
+    def _downloadFile(self, res, src, dest):
+        if res is not None:
+            # An earlier download failed.
+            return res
 
-                if time > recent_mtime:
-                    recent_mtime = time
-                    recent_build = full_path
+        self.download_log.addStdout("downloading %s to %s\n" % (src, dest))
+        self.bytes_downloaded += os.path.getsize(src)
 
-        if recent_build:
-            self.setProperty(self.prop_name, recent_build,
-                             "DownloadLatestBuild")
-            self.mastersrc = recent_build
-            self.slavedest = os.path.join(os.path.abspath(self.slavedest),
-                                          os.path.dirname(recent_build))
-            return FileDownload.start(self)
+        self.cmd = StatusRemoteCommand("downloadFile", {
+            'slavedest': dest,
+            'maxsize': self.maxsize,
+            'reader': _FileReader(open(src, "rb")),
+            'blocksize': self.blocksize,
+            'workdir': self._getWorkdir(),
+            'mode': self.mode,
+        })
 
-        self.step_status.setColor("red")
-        self.step_status.setText("build not found")
-        self.finished(FAILURE)
+        d = self.runCommand(self.cmd)
+        d.addCallback(self._downloadFinished, self.cmd, dest)
 
+        return d
 
-class VirtualEnv(ShellCommand):
+    def _downloadFinished(self, res, cmd, dest):
+        if cmd.rc not in (None, 0):
+            return "%s: %s" % (dest, cmd.stderr.strip() or "download failed")
+
+        return None
+
+    def _verifyDownloads(self, error):
+        if error is not None or not self.verify:
+            return error
+
+        downloaded = [(dest, checksum)
+                      for src, dest, checksum in self.downloads
+                      if dest not in self.skipped]
+
+        if not downloaded:
+            return None
+
+        d = self.getSlaveChecksums([dest for dest, checksum in downloaded],
+                                   "verify")
+        d.addCallback(self._checkDownloads, downloaded)
+
+        return d
+
+    def _checkDownloads(self, checksums, downloaded):
+        for dest, checksum in downloaded:
+            if checksum and checksums.get(dest) != checksum:
+                return "%s: checksum mismatch" % dest
+
+        return None
+
+    def _downloadsDone(self, error):
+        if error is not None:
+            self.download_log.addStderr(error + "\n")
+            self.download_log.finish()
+            self.step_status.setText(["download failed"])
+            return BuildStep.finished(self, FAILURE)
+
+        self.download_log.finish()
+
+        text = ["downloaded %d" % (len(self.downloads) - len(self.skipped))]
+
+        if self.skipped:
+            text.append("skipped %d" % len(self.skipped))
+
+        self.step_status.setText(text)
+
+        return BuildStep.finished(self, SUCCESS)
+
+    def getBytesTransferred(self):
+        return self.bytes_downloaded
+
+
+class VirtualEnv(TimedStepMixin, ShellCommand):
     """
     Sets up a virtualenv install.
     """
@@ -161,125 +481,677 @@ class VirtualEnv(ShellCommand):
     haltOnFailure = True
     description = "Setting up virtualenv"
     descriptionDone = "virtualenv set up"
+    resource_class = "io-heavy"
 
     def __init__(self, python, *args, **kwargs):
         ShellCommand.__init__(self, *args, **kwargs)
         self.command = [python, "../../virtualenv", "--no-site-packages", "./"]
 
 
-class EasyInstall(ShellCommand):
+class PinObserver(LogLineObserver):
+    """
+    Collects the "<name>==<version>" lines printed by SLAVE_RESOLVE_SCRIPT.
+    """
+    def __init__(self):
+        LogLineObserver.__init__(self)
+        self.pins = []
+
+    def outLineReceived(self, line):
+        if "==" in line:
+            self.pins.append(line.strip())
+
+
+class EasyInstall(TimedStepMixin, ChunkedLogMixin, ShellCommand):
     """
     Installs one or more packages using easy_install.
+
+    If lock_dir is set to a directory on the master, builds with a
+    snapshot property (set by the nightly schedulers, and passed on to the
+    builds they trigger) share a pinned set of dependencies for each set of
+    packages, find_links, combination, pyver and snapshot (see deplock).
+    The first step to start resolves and upgrades the packages as usual
+    and stores the versions it got. Steps starting while it does wait for
+    it, and then install exactly those versions, without upgrading or
+    resolving dependencies, as do the rest. The pinned set is stored in the
+    egg_lock property either way.
+
+    Waiting steps give up their locks until the pins are ready, so they
+    don't hold an io-heavy slot that the step they wait for may need.
     """
     name = "easy_install"
     haltOnFailure = True
     description = "installing eggs"
     descriptionDone = "eggs installed"
+    resource_class = "io-heavy"
 
     # Override to specify a custom URL and hosts pattern
     pypi_url = None
     allow_hosts_pattern = None
 
-    def __init__(self, packages, find_links=[], *args, **kwargs):
+    def __init__(self, packages, find_links=[], lock_dir=None, pyver=None,
+                 combination=None, *args, **kwargs):
         ShellCommand.__init__(self, *args, **kwargs)
-        self.command = ["easy_install", "--upgrade", "--prefix", "."]
+        self.addFactoryArguments(packages=packages,
+                                 find_links=find_links,
+                                 lock_dir=lock_dir,
+                                 pyver=pyver,
+                                 combination=combination)
+        self.packages = packages
+        self.find_links = find_links
+        self.lock_dir = lock_dir
+        self.pyver = pyver
+        self.combination = combination
+        self.lock_key = None
+        self.pins = None
+        self.claimed = False
+        self.pin_wait = None
+        self.locks_released = False
+        self.interrupt_reason = None
+        self.command = self.getInstallCommand(["--upgrade"], set(packages))
+        self.addChunkedLogObservers()
+
+    def getInstallCommand(self, options, requirements):
+        command = ["easy_install"] + options + ["--prefix", "."]
 
         if self.pypi_url:
-            self.command.extend(["-i", self.pypi_url])
+            command.extend(["-i", self.pypi_url])
 
         if self.allow_hosts_pattern:
-            self.command.extend(["-H", self.allow_hosts_pattern])
+            command.extend(["-H", self.allow_hosts_pattern])
+
+        for link in self.find_links:
+            command.extend(["--find-links", link])
+
+        command.extend(requirements)
+
+        return command
+
+    def start(self):
+        props = self.build.getProperties()
+        snapshot = props.getProperty("snapshot")
+
+        if self.lock_dir and snapshot:
+            self.lock_key = get_lock_key(self.packages, self.pyver, snapshot,
+                                         props.render(self.find_links),
+                                         self.combination)
+            self._startLocked()
+        else:
+            ShellCommand.start(self)
+
+    def _startLocked(self):
+        store = get_dependency_lock_store(self.lock_dir)
+        self.pins = store.get(self.lock_key)
+
+        if not self.pins:
+            d = store.claim(self.lock_key)
+
+            if d is not None:
+                # Another step is resolving these packages. Wait for it
+                # without holding our locks, and use its pins (or resolve
+                # them ourselves if it failed).
+                self.step_status.setText(["waiting for", "egg_lock"])
+                self.pin_wait = d
+                self.releaseLocks()
+                self.locks_released = True
+                d.addCallback(self._pinsReleased)
+                d.addErrback(self.failed)
+                return
+
+            self.claimed = True
+        else:
+            # The pins cover every dependency, so there's nothing left to
+            # resolve.
+            self.command = self.getInstallCommand(["--no-deps"], self.pins)
+            self.setProperty("egg_lock", " ".join(self.pins))
+
+        try:
+            ShellCommand.start(self)
+        except:
+            self._releaseLockKey(None)
+            raise
+
+    def _pinsReleased(self, res):
+        self.pin_wait = None
+        d = self.acquireLocks()
+        d.addCallback(self._locksReacquired)
+
+        return d
+
+    def _locksReacquired(self, res):
+        self.locks_released = False
+
+        if self.interrupt_reason is not None:
+            self._finishInterrupted()
+        else:
+            self._startLocked()
+
+    def releaseLocks(self):
+        if not self.locks_released:
+            ShellCommand.releaseLocks(self)
+
+    def interrupt(self, reason):
+        if not self.locks_released:
+            return ShellCommand.interrupt(self, reason)
+
+        # Waiting for another step's pins, with no command running.
+        self.interrupt_reason = reason
+
+        if self.pin_wait is not None:
+            get_dependency_lock_store(self.lock_dir).cancel(self.lock_key,
+                                                            self.pin_wait)
+            self.pin_wait = None
+            self._finishInterrupted()
+
+    def _finishInterrupted(self):
+        self.addCompleteLog("interrupt", str(self.interrupt_reason))
+        self.step_status.setText(self.describe(False) + ["interrupted"])
+        self.finished(EXCEPTION)
+
+    def runCommand(self, cmd):
+        d = ShellCommand.runCommand(self, cmd)
+
+        if self.claimed:
+            d.addCallback(self._storePins, cmd)
+            d.addBoth(self._releaseLockKey)
+
+        return d
+
+    def _releaseLockKey(self, res):
+        if self.claimed:
+            self.claimed = False
+            get_dependency_lock_store(self.lock_dir).release(self.lock_key)
+
+        return res
+
+    def _storePins(self, res, install_cmd):
+        if install_cmd.rc != 0:
+            return res
+
+        observer = PinObserver()
+        self.addLogObserver("egg_lock", observer)
+
+        properties = self.build.getProperties()
+        kwargs = properties.render(self.remote_kwargs)
+        kwargs['command'] = (["python", "-c", SLAVE_RESOLVE_SCRIPT] +
+                             sorted(set(self.packages)))
+
+        cmd = RemoteShellCommand(**kwargs)
+        self.setupEnvironment(cmd)
+        cmd.useLog(self.addLog("egg_lock"), True, "stdio")
+
+        def _gotPins(cmd_res):
+            if cmd.rc == 0 and observer.pins:
+                self.pins = get_dependency_lock_store(self.lock_dir).put(
+                    self.lock_key, observer.pins)
+                self.setProperty("egg_lock", " ".join(self.pins))
+
+            return res
+
+        d = ShellCommand.runCommand(self, cmd)
+        d.addCallback(_gotPins)
+
+        return d
+
+
+class ParallelCommands(TimedStepMixin, ShellCommand):
+    """
+    Runs a group of commands at the same time on the slave, finishing once
+    all of them have.
+
+    commands is a list of (name, command) pairs. Each command's output is
+    streamed into a log with its name, and the step fails if any of the
+    commands fail. A slave builder only runs one remote command at a time,
+    so the group runs as a single command that starts the others.
+
+    A member may also be a (name, command, resource_class) triple. The
+    resource class only matters to BuildManager, which gives the group
+    that class's locks.
+    """
+    name = "parallel"
+    description = ["running"]
+    descriptionDone = ["ran"]
+    logdir = ".buildbatter-parallel"
+
+    _exit_re = re.compile(r'^(\S+) exited with (-?\d+)$')
+
+    def __init__(self, commands, **kwargs):
+        factory_commands = commands
+        commands = [(member[0], member[1]) for member in commands]
+        logfiles = dict(kwargs.pop("logfiles", {}))
+
+        for name, member_command in commands:
+            logfiles[name] = "%s/%s.log" % (self.logdir, name)
+
+        kwargs.setdefault("description", self.description +
+                          [name for name, member_command in commands])
+        kwargs.setdefault("descriptionDone", self.descriptionDone +
+                          [name for name, member_command in commands])
+
+        ShellCommand.__init__(self, command=self.getParallelCommand(commands),
+                              logfiles=logfiles, **kwargs)
+        self.addFactoryArguments(commands=factory_commands)
+        self.commands = commands
+        self.failed_commands = []
+
+        self.addLogObserver("stdio", StepLineObserver())
+
+    def getParallelCommand(self, commands):
+        command = ["python", "-c", SLAVE_PARALLEL_SCRIPT, self.logdir]
+
+        for name, member_command in commands:
+            command += [name, str(len(member_command))] + list(member_command)
+
+        return command
+
+    def outputLineReceived(self, line):
+        m = self._exit_re.search(line.strip())
+
+        if m and int(m.group(2)) != 0:
+            self.failed_commands.append(m.group(1))
+
+    def getText(self, cmd, results):
+        if self.failed_commands:
+            return ["failed"] + self.failed_commands
+
+        return ShellCommand.getText(self, cmd, results)
+
+
+class BuildEggs(ParallelCommands):
+    """
+    Builds an egg for each of several Python versions at once, from one
+    checkout.
+
+    Each version's setup.py runs with its own build and egg-info
+    directories under build/py<pyver>, so the runs don't trip over each
+    other, and writes its egg to dist. The egg filenames are set in the
+    egg_filename_py<pyver> properties (such as egg_filename_py25) and,
+    together, in the egg_filenames property.
+
+    python_format is the interpreter to run for each version, with %s
+    standing for the version.
+    """
+    name = "build-eggs"
+    description = ["building", "eggs"]
+    descriptionDone = ["built", "eggs"]
+    resource_class = "cpu-heavy"
+    haltOnFailure = True
+
+    _egg_re = re.compile(r"creating 'dist/([A-Za-z0-9_.-]+-py(\d+)\.(\d+)"
+                         r"\.egg)'")
+
+    def __init__(self, pyvers, python_format="python%s", **kwargs):
+        self.python_format = python_format
+        ParallelCommands.__init__(self, self.getEggCommands(pyvers, "-Dr"),
+                                  **kwargs)
+        self.addFactoryArguments(pyvers=pyvers, python_format=python_format)
+        self.pyvers = pyvers
+        self.filenames = []
+
+        for name, command in self.commands:
+            self.addLogObserver(name, StepLineObserver())
+
+    def getEggCommands(self, pyvers, tag_option):
+        commands = []
+
+        for pyver in pyvers:
+            build_dir = "build/py%s" % pyver
+            commands.append(("py%s" % pyver, [
+                self.python_format % pyver, "setup.py",
+                "egg_info", tag_option, "--egg-base", build_dir,
+                "build", "--build-base", build_dir,
+                "bdist_egg", "--bdist-dir", build_dir + "/bdist",
+                "--dist-dir", "dist",
+            ]))
+
+        return commands
+
+    def start(self):
+        props = self.build.getProperties()
+
+        if str(props.getProperty("nightly")) == "True":
+            tag_option = "-dR"
+        else:
+            tag_option = "-Dr"
+
+        self.command = self.getParallelCommand(
+            self.getEggCommands(self.pyvers, tag_option))
+
+        ParallelCommands.start(self)
+
+    def outputLineReceived(self, line):
+        m = self._egg_re.search(line)
+
+        if m:
+            filename, major, minor = m.groups()
+            self.filenames.append(filename)
+            self.setProperty("egg_filename_py%s%s" % (major, minor), filename,
+                             self.__class__.__name__)
+            self.setProperty("egg_filenames", " ".join(self.filenames),
+                             self.__class__.__name__)
+        else:
+            ParallelCommands.outputLineReceived(self, line)
+
+    def evaluateCommand(self, cmd):
+        if (cmd.rc != 0 or self.failed_commands or
+            len(self.filenames) < len(self.pyvers)):
+            return FAILURE
+
+        return SUCCESS
 
-        for link in find_links:
-            self.command.extend(["--find-links", link])
+    def getText(self, cmd, results):
+        if self.filenames:
+            return ["built"] + self.filenames
+
+        return ParallelCommands.getText(self, cmd, results)
+
+
+class LocalCommandProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, step):
+        self.step = step
+
+    def outReceived(self, data):
+        self.step.addOutput("stdout", data)
+
+    def errReceived(self, data):
+        self.step.addOutput("stderr", data)
 
-        self.command.extend(set(packages))
+    def processEnded(self, reason):
+        # exitCode is None when the process was killed by a signal.
+        self.step.processEnded(reason.value.exitCode,
+                               getattr(reason.value, "signal", None))
 
 
-class LocalCommand(ShellCommand):
+class LocalCommand(TimedStepMixin, ChunkedLogMixin, ShellCommand):
     """
     Runs a local command on the master.
+
+    The command runs without blocking the master, and its output is
+    streamed into "stdout" and "stderr" logs as it arrives.
     """
     name = "local-shell"
     haltOnFailure = True
+    chunked_logs = ("stdout", "stderr")
 
     def __init__(self, env=None, *args, **kwargs):
         ShellCommand.__init__(self, *args, **kwargs)
         self.env = env
+        self.addChunkedLogObservers()
 
     def start(self):
         properties = self.build.getProperties()
-        kwargs = properties.render(self.remote_kwargs)
-        kwargs['command'] = properties.render(self.command)
-        kwargs['logfiles'] = self.logfiles
+        self.local_command = properties.render(self.command)
+        self.local_logs = {}
 
         self.step_status.setColor("yellow")
         self.step_status.setText(self.describe(False))
 
-        p = subprocess.Popen(kwargs['command'],
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             shell=False,
-                             close_fds=True,
-                             universal_newlines=True,
-                             env=self.env)
+        env = self.env
+
+        if env is None:
+            env = os.environ
 
-        rc = p.wait()
+        reactor.spawnProcess(LocalCommandProcessProtocol(self),
+                             self.local_command[0], self.local_command,
+                             env=env)
 
-        stdout_data = p.stdout.read()
-        stderr_data = p.stderr.read()
+    def addOutput(self, logname, data):
+        if logname not in self.local_logs:
+            self.local_logs[logname] = self.addLog(logname)
 
-        if stdout_data:
-            self.addCompleteLog('stdout', stdout_data)
+        self.local_logs[logname].addStdout(data)
 
-        if stderr_data:
-            self.addCompleteLog('stderr', stderr_data)
+    def processEnded(self, rc, signal=None):
+        if rc is None:
+            self.addOutput("stderr", "\nkilled by signal %s\n" % signal)
 
-        if rc:
+        for loog in self.local_logs.values():
+            loog.finish()
+
+        if rc is None or rc:
             result = FAILURE
         else:
             result = SUCCESS
 
-        self.setStatus(kwargs['command'], result)
+        self.setStatus(self.local_command, result)
         self.finished(result)
 
 
-class UploadDist(FileUpload):
+class _ChecksumFileWriter(pb.Referenceable):
+    """
+    Receives an uploaded file into a hidden temporary file in an artifact
+    store, computing its checksum as the data arrives.
     """
-    Uploads a dist to a remote server.
+    def __init__(self, store, name, mode):
+        self.partfile = store.get_path(".%s.part" % name)
+        self.checksum = sha1()
+        self.size = 0
+        self.fp = open(self.partfile, "wb")
+
+        if mode is not None:
+            os.chmod(self.partfile, mode)
+
+    def remote_write(self, data):
+        self.fp.write(data)
+        self.checksum.update(data)
+        self.size += len(data)
+
+    def remote_close(self):
+        self.fp.close()
+        self.fp = None
+
+    def getChecksum(self):
+        return self.checksum.hexdigest()
+
+    def discard(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+
+        if os.path.exists(self.partfile):
+            os.unlink(self.partfile)
+
+    def __del__(self):
+        # An interrupted upload leaves a truncated file behind.
+        if getattr(self, "fp", None):
+            self.discard()
+
+
+class UploadDist(TimedStepMixin, SlaveChecksumMixin, FileUpload):
+    """
+    Uploads one or more dists into the artifact store at the upload path.
+
+    Each dist is given as a (slavesrc, dest_filename) pair in files, or
+    through the slavesrc and dest_filename arguments for a single dist.
+    All dists are uploaded by the one step, one after another.
+
+    If verify is set, the dists are checksummed on the slave first. Dists
+    whose contents are already in the store aren't transferred at all,
+    and every upload is checked against its checksum. Uploads are only
+    added to the store once complete, and failed uploads are retried up to
+    retries times.
     """
     name = "upload-dist"
     haltOnFailure = True
+    resource_class = "transfer"
 
-    def __init__(self, default_upload_path, dest_filename, *args, **kwargs):
-        FileUpload.__init__(self, masterdest="", *args, **kwargs)
+    def __init__(self, default_upload_path, dest_filename=None, files=[],
+                 blocksize=DEFAULT_UPLOAD_BLOCKSIZE, verify=True, retries=2,
+                 *args, **kwargs):
+        kwargs.setdefault("slavesrc", None)
+        FileUpload.__init__(self, masterdest="", blocksize=blocksize,
+                            *args, **kwargs)
+        self.addFactoryArguments(default_upload_path=default_upload_path,
+                                 dest_filename=dest_filename,
+                                 files=files,
+                                 verify=verify,
+                                 retries=retries)
         self.default_upload_path = default_upload_path
         self.dest_filename = dest_filename
+        self.verify = verify
+        self.retries = retries
+        self.files = list(files)
+
+        if dest_filename is not None:
+            self.files.insert(0, (self.slavesrc, dest_filename))
+
+        self.bytes_uploaded = 0
 
     def start(self):
+        if not self.slaveVersion("uploadFile"):
+            raise BuildSlaveTooOldError("slave is too old, does not know "
+                                        "about uploadFile")
+
         props = self.build.getProperties()
         upload_path = props.getProperty("upload_path")
 
         if not upload_path:
             upload_path = self.default_upload_path
 
-        self.masterdest = upload_path + "/" + self.dest_filename
+        self.store = get_artifact_store(upload_path)
+        self.uploads = []
+
+        for slavesrc, dest_filename in self.files:
+            self.uploads.append((props.render(slavesrc),
+                                 props.render(dest_filename)))
+
+        self.upload_log = self.addLog("uploads")
+        self.uploaded = []
+        self.skipped = []
+        self.errors = []
+
+        self.step_status.setText(["uploading"] +
+                                 [os.path.basename(slavesrc)
+                                  for slavesrc, name in self.uploads])
+
+        if self.verify:
+            d = self.getSlaveChecksums([slavesrc
+                                        for slavesrc, name in self.uploads])
+        else:
+            d = defer.succeed({})
+
+        d.addCallback(self._uploadFiles)
+        d.addCallbacks(self._uploadsDone, self.failed)
+
+    def _uploadFiles(self, checksums):
+        d = defer.succeed(None)
+
+        for slavesrc, name in self.uploads:
+            d.addCallback(self._uploadFile, slavesrc, name,
+                          checksums.get(slavesrc), self.retries)
+
+        return d
+
+    def _uploadFile(self, res, slavesrc, name, checksum, retries):
+        if checksum and self.store.has_blob(checksum):
+            entry = self.store.get(name)
+
+            if entry and entry.checksum == checksum:
+                self.skipped.append(name)
+                self.upload_log.addStdout("%s is already uploaded as %s\n" %
+                                          (slavesrc, name))
+
+                return None
+
+            # Changing the store can wait on another master's lock.
+            d = threads.deferToThread(self.store.link, checksum, name)
+            d.addCallback(self._linkFinished, slavesrc, name)
+
+            return d
+
+        return self._startUpload(slavesrc, name, checksum, retries)
+
+    def _linkFinished(self, res, slavesrc, name):
+        self.uploaded.append(name)
+        self.upload_log.addStdout("%s is identical to an earlier upload, "
+                                  "stored as %s\n" % (slavesrc, name))
 
-        FileUpload.start(self)
+    def _startUpload(self, slavesrc, name, checksum, retries):
+        self.upload_log.addStdout("uploading %s as %s\n" % (slavesrc, name))
 
+        writer = _ChecksumFileWriter(self.store, name, self.mode)
+        self.cmd = StatusRemoteCommand("uploadFile", {
+            'slavesrc': slavesrc,
+            'workdir': self._getWorkdir(),
+            'writer': writer,
+            'maxsize': self.maxsize,
+            'blocksize': self.blocksize,
+        })
 
-class RotateFiles(LocalCommand):
+        d = self.runCommand(self.cmd)
+        d.addCallback(self._uploadFinished, self.cmd, writer, slavesrc,
+                      name, checksum, retries)
+
+        return d
+
+    def _uploadFinished(self, res, cmd, writer, slavesrc, name, checksum,
+                        retries):
+        self.bytes_uploaded += writer.size
+
+        if cmd.rc not in (None, 0):
+            error = cmd.stderr.strip() or "upload failed"
+        elif checksum and writer.getChecksum() != checksum:
+            error = "checksum mismatch (expected %s, got %s)" % \
+                    (checksum, writer.getChecksum())
+        else:
+            d = threads.deferToThread(self.store.add, writer.partfile, name,
+                                      writer.getChecksum())
+            d.addCallback(lambda res: self.uploaded.append(name))
+
+            return d
+
+        writer.discard()
+        self.upload_log.addStderr("%s: %s\n" % (slavesrc, error))
+
+        if retries > 0:
+            return self._startUpload(slavesrc, name, checksum, retries - 1)
+
+        self.errors.append(slavesrc)
+
+        return None
+
+    def _uploadsDone(self, res):
+        self.upload_log.finish()
+
+        if self.errors:
+            self.step_status.setText(["upload failed"] + self.errors)
+            return BuildStep.finished(self, FAILURE)
+
+        text = ["uploaded %d" % len(self.uploaded)]
+
+        if self.skipped:
+            text.append("skipped %d" % len(self.skipped))
+
+        self.step_status.setText(text)
+
+        return BuildStep.finished(self, SUCCESS)
+
+    def getBytesTransferred(self):
+        return self.bytes_uploaded
+
+
+class RotateFiles(TimedStepMixin, BuildStep):
     """
-    Rotates files in a directory so the directory doesn't fill up.
+    Rotates files in an artifact store so it doesn't fill up.
+
+    Only the newest max_files entries matching each pattern are kept.
+
+    This used to run a local command, so it still accepts (and ignores)
+    env and the other LocalCommand arguments that existing configs pass.
     """
     name = "rotate-files"
     description = "Rotating downloadables"
     descriptionDone = "Rotated downloadables"
+    haltOnFailure = True
+    parms = BuildStep.parms + ['description', 'descriptionDone']
 
-    def __init__(self, default_directory, patterns, max_files=5,
+    def __init__(self, default_directory, patterns, max_files=5, env=None,
                  *args, **kwargs):
-        LocalCommand.__init__(self, *args, **kwargs)
+        kwargs = dict([(key, value) for key, value in kwargs.items()
+                       if key in self.parms])
+        BuildStep.__init__(self, **kwargs)
+        self.addFactoryArguments(default_directory=default_directory,
+                                 patterns=patterns,
+                                 max_files=max_files)
         self.default_directory = default_directory
         self.patterns = patterns
         self.max_files = max_files
@@ -292,20 +1164,351 @@ class RotateFiles(LocalCommand):
             directory = self.default_directory
 
         patterns = [props.render(pattern) for pattern in self.patterns]
-        self.command = ["./scripts/rotate-files.py",
-                        directory, "'%s'" % ",".join(patterns),
-                        str(self.max_files)]
 
-        LocalCommand.start(self)
+        # Changing the store can wait on another master's lock.
+        d = threads.deferToThread(get_artifact_store(directory).rotate,
+                                  patterns, self.max_files)
+        d.addCallbacks(self._rotated, self.failed)
+
+    def _rotated(self, removed):
+        if removed:
+            self.addCompleteLog("removed", "\n".join(removed) + "\n")
+
+        self.step_status.setText([self.descriptionDone])
+        self.finished(SUCCESS)
+
+
+class CleanSlave(TimedStepMixin, ShellCommand):
+    """
+    Frees disk space on a slave.
+
+    builddirs are the builddirs of the builders configured for the slave,
+    which get marked as builddirs. Builders also mark their own builddirs
+    on every build, with MarkBuilddir. Any other marked builddir that
+    hasn't been used for orphan_age seconds is removed, while directories
+    that were never marked, such as those the slave's admin put there, are
+    left alone. Unmarked directories whose names match one of the
+    shell-style adopt patterns are treated as marked, which picks up
+    builddirs from before builders marked them. Then, while the slave's base directory takes up more than
+    budget bytes, the virtualenvs and dist and build outputs of the
+    remaining builddirs are removed, least recently used first. They're
+    recreated by the next build. Directories holding the paths in protect
+    (such as the mirror directory) are never touched.
+
+    This runs in the slave's base directory, so builds on the slave must
+    not run at the same time. BuildManager gives its maintenance builders
+    an exclusive lock for that.
+    """
+    name = "clean-slave"
+    description = ["cleaning", "slave"]
+    descriptionDone = ["cleaned", "slave"]
+    resource_class = "io-heavy"
+
+    _removed_re = re.compile(r'^removed (.+) \((.+), (\d+) bytes\)$')
+
+    def __init__(self, builddirs, budget, orphan_age=24*60*60, protect=[],
+                 adopt=[], **kwargs):
+        kwargs.setdefault("workdir", "..")
+        command = (["python", "-c", SLAVE_GC_SCRIPT, str(budget),
+                    str(orphan_age)] +
+                   sorted(set(builddirs)) + sorted(set(protect)) +
+                   ["--adopt=%s" % pattern for pattern in adopt])
+
+        ShellCommand.__init__(self, command=command, **kwargs)
+        self.addFactoryArguments(builddirs=builddirs, budget=budget,
+                                 orphan_age=orphan_age, protect=protect,
+                                 adopt=adopt)
+        self.bytes_freed = 0
+        self.removed = []
+
+        self.addLogObserver("stdio", StepLineObserver())
+
+    def outputLineReceived(self, line):
+        m = self._removed_re.search(line.strip())
+
+        if m:
+            path, reason, size = m.groups()
+            self.removed.append(path)
+            self.bytes_freed += int(size)
+
+    def evaluateCommand(self, cmd):
+        self.step_status.setStatistic("bytes-freed", self.bytes_freed)
+        registry.counter(
+            "buildbatter_slave_bytes_freed_total",
+            "Bytes of disk space freed on slaves.").inc(
+                self.bytes_freed, slave=self.getSlaveName())
+
+        return ShellCommand.evaluateCommand(self, cmd)
+
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+
+        if self.removed:
+            text = text + ["freed %d MB" % (self.bytes_freed / (1024 * 1024))]
+
+        return text
+
+
+class MarkBuilddir(ShellCommand):
+    """
+    Marks the builder's builddir as one that CleanSlave may remove once no
+    builder uses it, and records when it was last used.
+    """
+    name = "mark-builddir"
+    description = ["marking", "builddir"]
+    descriptionDone = ["marked", "builddir"]
+    flunkOnFailure = False
+    warnOnFailure = True
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("workdir", ".")
+        ShellCommand.__init__(self,
+                              command=["python", "-c",
+                                       SLAVE_MARK_BUILDDIR_SCRIPT],
+                              **kwargs)
+
+
+_test_method_re = re.compile(r'^(\w+) \(([\w.]+)\.(\w+)\)$')
+_test_function_re = re.compile(r'^([\w.]+)\.(\w+)(\(.*\))?$')
+
+
+def get_test_address(testname):
+    """
+    Returns the nose address ("module:Class.method" or "module:function")
+    of a test from the name nose -v prints for it, or None if the test
+    can't be addressed (such as tests described by their docstrings).
+    """
+    m = _test_method_re.search(testname)
+
+    if m:
+        method, module, cls = m.groups()
+        return "%s:%s.%s" % (module, cls, method)
+
+    m = _test_function_re.search(testname)
 
+    if m:
+        return "%s:%s" % m.groups()[:2]
 
-class NoseTests(Test):
+    return None
+
+
+class NoseTests(TimedStepMixin, ChunkedLogMixin, Test):
+    """
+    Runs nosetests -v, counting test results and code coverage.
+
+    If rerun_failures is set, tests that fail are rerun on their own up to
+    that many times, as long as no more than rerun_max_tests of them
+    failed. Tests that pass on a rerun are counted as flaky and passed
+    rather than failed. Failures nose can't address, such as import
+    errors, are never rerun.
+
+    The addresses of the tests that still failed are stored in the
+    failed_tests build property. If the retry_failed property is "True",
+    only the tests that failed in the builder's last finished build are
+    run (see RetryFailedTestsResource).
+
+    If test_timeout is set, nose is run under a watchdog on the slave that
+    kills it once a test has been running for that many seconds, after
+    dumping the stack of the stuck test to the log. Setting up before the
+    first test and reporting after the last don't count against it. The
+    stuck test counts as failed and is named in the step's text.
+    test_total_timeout limits the whole run in the same way. A run that
+    was killed fails the step, and its failures are never rerun, since the
+    tests after the stuck one never ran. Should the watchdog itself stop
+    responding, the command is interrupted from the master hang_grace
+    seconds after the overall limit.
+
+    If result_cache is set to a directory on the master, the inputs of the
+    run (the trees in cache_paths, relative to the workdir, the
+    distributions the step's Python can import, and the Python version)
+    are fingerprinted on the slave first. If the same inputs and command
+    have passed before, the stored results are replayed instead of
+    running nose. See resultcache.
+    """
     flunkOnWarnings = True
+    resource_class = "test-heavy"
+    hang_grace = 60
+
+    # The exit status of SLAVE_TEST_WATCHDOG_SCRIPT when it kills a run.
+    timeout_rc = 124
 
     _test_re = re.compile(r'^(.+) \.\.\. (\w+)$')
+    _timeout_re = re.compile(
+        r'^Test (?:run )?timed out after \d+ seconds: (.+)$')
     _coverage_re = re.compile(
         r'^([A-Za-z0-9_.]+)\s+(\d+)\s+(\d+)\s+(\d+)%\s+([\d, -]+)$')
 
+    def __init__(self, rerun_failures=0, rerun_max_tests=20,
+                 test_timeout=None, test_total_timeout=None,
+                 result_cache=None, cache_paths=["."], *args, **kwargs):
+        Test.__init__(self, *args, **kwargs)
+        self.addFactoryArguments(rerun_failures=rerun_failures,
+                                 rerun_max_tests=rerun_max_tests,
+                                 test_timeout=test_timeout,
+                                 test_total_timeout=test_total_timeout,
+                                 result_cache=result_cache,
+                                 cache_paths=cache_paths)
+        self.rerun_failures = rerun_failures
+        self.rerun_max_tests = rerun_max_tests
+        self.test_timeout = test_timeout
+        self.test_total_timeout = test_total_timeout
+        self.result_cache = result_cache
+        self.cache_paths = cache_paths
+        self.fingerprint = None
+        self.test_command = self.command
+        self.hung_tests = []
+        self.timed_out = False
+        self.hang_timer = None
+        self.tests_total = 0
+        self.tests_passed = 0
+        self.tests_failed = 0
+        self.tests_flaky = 0
+        self.total_statements = 0
+        self.exec_statements = 0
+
+        # Failure counts of the addressable tests that failed in the last
+        # run, and the results of the tests being rerun.
+        self.failed_tests = {}
+        self.rerun_results = None
+        self.rerun_rc = None
+        self.num_reruns = 0
+
+        self.addLogObserver("stdio", StepLineObserver())
+        self.addChunkedLogObservers()
+
+    def start(self):
+        props = self.build.getProperties()
+        self.test_command = props.render(self.command)
+        command = self.test_command
+
+        if str(props.getProperty("retry_failed")) == "True":
+            tests = self.getPreviousFailedTests()
+
+            if tests:
+                command = self.getTestCommand(command, tests)
+
+        self.command = self.getWatchdogCommand(command)
+
+        if self.result_cache and command == self.test_command:
+            d = self.getInputFingerprint()
+            d.addCallback(self._checkResultCache)
+            d.addErrback(self.failed)
+        else:
+            Test.start(self)
+
+    def getInputFingerprint(self):
+        """
+        Fingerprints the inputs of the test run on the slave, returning a
+        Deferred firing with the fingerprint.
+        """
+        observer = ChecksumObserver()
+        self.addLogObserver("fingerprint", observer)
+
+        properties = self.build.getProperties()
+        kwargs = properties.render(self.remote_kwargs)
+        kwargs['command'] = (["python", "-c", SLAVE_FINGERPRINT_SCRIPT] +
+                             list(self.cache_paths))
+
+        cmd = RemoteShellCommand(**kwargs)
+        self.setupEnvironment(cmd)
+        cmd.useLog(self.addLog("fingerprint"), True, "stdio")
+
+        def _gotChecksums(res):
+            checksum = sha1(repr(self.test_command))
+
+            for name in sorted(observer.checksums.keys()):
+                checksum.update("%s %s\n" % (observer.checksums[name], name))
+
+            return checksum.hexdigest()
+
+        d = Test.runCommand(self, cmd)
+        d.addCallback(_gotChecksums)
+
+        return d
+
+    def _checkResultCache(self, fingerprint):
+        self.fingerprint = fingerprint
+        result_cache = get_result_cache(self.result_cache)
+        results = result_cache.get(fingerprint)
+
+        if results is not None:
+            try:
+                counts = dict([(name, int(results[name])) for name in
+                               ("tests-total", "tests-passed",
+                                "total-statements", "exec-statements")])
+            except (KeyError, ValueError):
+                # Run the tests again rather than replay a damaged entry.
+                result_cache.remove(fingerprint)
+                results = None
+
+        if results is None:
+            Test.start(self)
+            return
+
+        self.setTestResults(total=counts["tests-total"],
+                            failed=0,
+                            passed=counts["tests-passed"],
+                            total_statements=counts["total-statements"],
+                            exec_statements=counts["exec-statements"])
+        self.step_status.setStatistic("tests-cached", 1)
+        self.setProperty("failed_tests", "")
+        self.addCompleteLog("cached",
+                            "Replayed the results of %s build %s, which had "
+                            "the same inputs (%s).\n" %
+                            (results.get("builder"), results.get("build"),
+                             fingerprint))
+
+        self.step_status.setText(self.describe(True) + ["(cached)"])
+        self.finished(SUCCESS)
+
+    def getPreviousFailedTests(self):
+        """
+        Returns the addresses of the tests that failed in the builder's
+        last finished build.
+        """
+        build_status = \
+            self.build.builder.builder_status.getLastFinishedBuild()
+
+        if build_status is None:
+            return []
+
+        failed_tests = build_status.getProperties().getProperty(
+            "failed_tests", "")
+
+        return str(failed_tests).split()
+
+    def getTestCommand(self, command, tests):
+        """
+        Returns the test command, limited to running some tests.
+        """
+        if isinstance(command, str):
+            return " ".join([command] + tests)
+
+        return list(command) + tests
+
+    def getWatchdogCommand(self, command):
+        """
+        Returns the test command, wrapped in the slave watchdog if there's
+        a time limit.
+        """
+        if not self.test_timeout and not self.test_total_timeout:
+            return command
+
+        if isinstance(command, str):
+            command = ["/bin/sh", "-c", command]
+
+        return (["python", "-c", SLAVE_TEST_WATCHDOG_SCRIPT,
+                 str(self.test_timeout or 0),
+                 str(self.test_total_timeout or 0),
+                 SLAVE_STACK_DUMP_SCRIPT] +
+                list(command))
+
+    def runCommand(self, cmd):
+        d = self._runTestCommand(cmd)
+        d.addCallback(self._rerunFailedTests)
+
+        return d
+
     def setTestResults(self, total, failed, passed, total_statements,
                        exec_statements):
         Test.setTestResults(self, total=total, failed=failed, passed=passed)
@@ -320,6 +1523,17 @@ class NoseTests(Test):
         description = Test.describe(self, done)
 
         if done:
+            flaky = self.step_status.getStatistic("tests-flaky", 0)
+
+            if flaky:
+                description.append('%d flaky' % flaky)
+
+            if self.hung_tests:
+                description.append('timed out: %s' %
+                                   ', '.join(self.hung_tests))
+            elif self.timed_out:
+                description.append('timed out')
+
             if self.step_status.hasStatistic("total-statements"):
                 total_statements = self.step_status.getStatistic("total-statements")
                 exec_statements = self.step_status.getStatistic("exec-statements")
@@ -333,43 +1547,210 @@ class NoseTests(Test):
 
         return description
 
-    def evaluateCommand(self, cmd):
-        total = 0
-        passed = 0
-        failed = 0
-        rc = cmd.rc
+    def outputLineReceived(self, line):
+        line = line.strip()
 
-        total_statements = 0
-        total_exec_statements = 0
+        m = self._timeout_re.search(line)
 
-        for line in self.getLog("stdio").getText().split("\n"):
-            line = line.strip()
+        if m:
+            # Count the stuck test as a failure.
+            self.hung_tests.append(m.group(1))
+            line = "%s ... TIMEOUT" % m.group(1)
 
-            m = self._test_re.search(line)
+        m = self._test_re.search(line)
 
-            if m:
-                testname, result = m.groups()
-                total += 1
+        if m:
+            testname, result = m.groups()
+            address = get_test_address(testname)
+
+            if self.rerun_results is not None:
+                if address in self.rerun_results:
+                    self.rerun_results[address] = \
+                        self.rerun_results[address] is not False and \
+                        result == "ok"
 
-                if result == "ok":
-                    passed += 1
-                else:
-                    failed += 1
+                return
+
+            self.tests_total += 1
+
+            if result == "ok":
+                self.tests_passed += 1
             else:
-                m = self._coverage_re.search(line)
+                self.tests_failed += 1
+
+                if address:
+                    self.failed_tests[address] = \
+                        self.failed_tests.get(address, 0) + 1
+        elif self.rerun_results is None:
+            m = self._coverage_re.search(line)
+
+            if m:
+                package, statements, exec_statements, coverage, missing = \
+                    m.groups()
 
-                if m:
-                    package, statements, exec_statements, coverage, missing = \
-                        m.groups()
+                self.total_statements += int(statements)
+                self.exec_statements += int(exec_statements)
 
-                    total_statements += int(statements)
-                    total_exec_statements += int(exec_statements)
+    def evaluateCommand(self, cmd):
+        rc = cmd.rc
+
+        if self.rerun_rc is not None and not self.tests_failed:
+            # Everything that failed passed on a rerun.
+            rc = self.rerun_rc
+
+        self.setTestResults(total=self.tests_total, failed=self.tests_failed,
+                            passed=self.tests_passed,
+                            total_statements=self.total_statements,
+                            exec_statements=self.exec_statements)
+
+        if self.tests_flaky:
+            self.step_status.setStatistic("tests-flaky", self.tests_flaky)
+
+        if self.hung_tests:
+            self.step_status.setStatistic("tests-timed-out",
+                                          len(self.hung_tests))
 
-        self.setTestResults(total=total, failed=failed, passed=passed,
-                            total_statements=total_statements,
-                            exec_statements=total_exec_statements)
+        self.setProperty("failed_tests",
+                         " ".join(sorted(self.failed_tests.keys())))
 
-        if failed:
+        if self.tests_failed or rc != SUCCESS:
+            # Runs killed by the watchdog exit with timeout_rc, which isn't
+            # a buildbot result, and may not have failed any test.
             rc = FAILURE
+        elif (self.fingerprint and rc == SUCCESS and not self.tests_flaky and
+              not self.hung_tests):
+            get_result_cache(self.result_cache).put(self.fingerprint, {
+                "tests-total": self.tests_total,
+                "tests-passed": self.tests_passed,
+                "total-statements": self.total_statements,
+                "exec-statements": self.exec_statements,
+                "builder": self.build.builder.name,
+                "build": self.build.build_status.getNumber(),
+            })
 
         return rc
+
+    def _rerunFailedTests(self, res):
+        if self.rerun_results is not None:
+            self._countRerunResults()
+
+        if self.cmd.rc == self.timeout_rc:
+            self.timed_out = True
+
+        # A run that was killed never ran the tests after the stuck one,
+        # so passing reruns can't make it pass.
+        if (not self.failed_tests or self.hung_tests or self.timed_out or
+            self.num_reruns >= self.rerun_failures or
+            len(self.failed_tests) > self.rerun_max_tests):
+            return res
+
+        self.num_reruns += 1
+        tests = sorted(self.failed_tests.keys())
+        self.rerun_results = dict([(address, None) for address in tests])
+
+        properties = self.build.getProperties()
+        kwargs = properties.render(self.remote_kwargs)
+        kwargs['command'] = self.getWatchdogCommand(
+            self.getTestCommand(self.test_command, tests))
+
+        logname = "rerun-%d" % self.num_reruns
+        self.addLogObserver(logname, StepLineObserver())
+
+        cmd = RemoteShellCommand(**kwargs)
+        self.setupEnvironment(cmd)
+        cmd.useLog(self.addLog(logname), True, "stdio")
+        self.cmd = cmd
+
+        d = self._runTestCommand(cmd)
+        d.addCallback(lambda res: self._setRerunRC(cmd))
+        d.addCallback(self._rerunFailedTests)
+
+        return d
+
+    def _runTestCommand(self, cmd):
+        if self.test_total_timeout:
+            self.hang_timer = reactor.callLater(
+                self.test_total_timeout + self.hang_grace, self._hangTimedOut)
+
+        d = Test.runCommand(self, cmd)
+        d.addBoth(self._cancelHangTimer)
+
+        return d
+
+    def _cancelHangTimer(self, res):
+        if self.hang_timer and self.hang_timer.active():
+            self.hang_timer.cancel()
+
+        self.hang_timer = None
+
+        return res
+
+    def _hangTimedOut(self):
+        self.hang_timer = None
+        self.interrupt("tests still running after %d seconds" %
+                       (self.test_total_timeout + self.hang_grace))
+
+    def _setRerunRC(self, cmd):
+        self.rerun_rc = cmd.rc
+
+    def _countRerunResults(self):
+        for address, passed in self.rerun_results.items():
+            if passed:
+                count = self.failed_tests.pop(address)
+                self.tests_failed -= count
+                self.tests_passed += count
+                self.tests_flaky += count
+
+                registry.counter(
+                    "buildbatter_flaky_tests_total",
+                    "Failed tests that passed when rerun.").inc(
+                        count, builder=self.build.builder.name)
+
+        self.rerun_results = None
+
+
+class RetryFailedTestsResource(resource.Resource):
+    """
+    Forces a build that only runs the tests that failed in a builder's
+    last finished build, on the same source.
+
+    Add it to the WebStatus in master.cfg:
+
+        web.putChild("retry-failed", RetryFailedTestsResource())
+
+    and force a retry with a POST to /retry-failed/<builder name>. Like
+    the force build form, this needs a WebStatus with allowForce set, and
+    a username and passwd in the form if it authenticates users.
+    """
+    isLeaf = True
+
+    def render_POST(self, request):
+        path = [part for part in request.postpath if part]
+        control = get_web_control(request)
+        status = request.site.buildbot_service.getStatus()
+
+        if control is None:
+            request.setResponseCode(403)
+            return "Forcing builds is not allowed"
+
+        if len(path) != 1 or path[0] not in status.getBuilderNames():
+            request.setResponseCode(404)
+            return "Not found"
+
+        build_status = status.getBuilder(path[0]).getLastFinishedBuild()
+
+        if build_status is None:
+            request.setResponseCode(404)
+            return "No finished builds"
+
+        reason = "Retrying the failed tests of build %d" % \
+                 build_status.getNumber()
+        build_request = BuildRequest(reason,
+                                     build_status.getSourceStamp(True),
+                                     path[0],
+                                     Properties(retry_failed="True"))
+        control.getBuilder(path[0]).requestBuild(build_request)
+
+        request.redirect("../builders/%s" % urllib.quote(path[0], safe=""))
+
+        return ""
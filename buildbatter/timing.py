@@ -0,0 +1,241 @@
+"""
+Per-step timing reports and critical paths of triggered builds.
+
+TimingReport aggregates the statistics recorded by buildbatter steps over
+each builder's recent builds. To see the report on the web, add a
+TimingResource to the WebStatus in master.cfg, with the builders and
+schedulers generated by BuildManager:
+
+    web.putChild("timings", TimingResource(c['builders'], c['schedulers']))
+
+The report is then served as plain text at /timings, or for a single
+builder at /timings/<builder name>, over the last ?builds=N builds.
+"""
+
+from buildbot.scheduler import Triggerable
+from buildbot.steps.trigger import Trigger
+from twisted.web import resource
+
+
+STEP_STATISTICS = ("wall-time", "queue-wait", "bytes-transferred")
+
+
+def get_percentile(values, percent):
+    """
+    Returns the given percentile of a list of values, using the nearest
+    rank, or None if the list is empty.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    rank = int(round(percent / 100.0 * (len(values) - 1)))
+
+    return values[rank]
+
+
+def get_trigger_graph(builders, schedulers):
+    """
+    Returns a dictionary mapping each builder name to the names of the
+    builders its trigger steps start.
+    """
+    triggerables = {}
+
+    for scheduler in schedulers:
+        if isinstance(scheduler, Triggerable):
+            triggerables.setdefault(scheduler.name, []).extend(
+                scheduler.builderNames)
+
+    graph = {}
+
+    for builder in builders:
+        triggered = []
+
+        for step_class, kwargs in builder['factory'].steps:
+            if issubclass(step_class, Trigger):
+                for scheduler_name in kwargs.get('schedulerNames', []):
+                    for name in triggerables.get(scheduler_name, []):
+                        if name not in triggered:
+                            triggered.append(name)
+
+        graph[builder['name']] = triggered
+
+    return graph
+
+
+class TimingReport(object):
+    """
+    Aggregates the step statistics recorded by buildbatter steps over the
+    last num_builds finished builds of each builder.
+
+    builders and schedulers are the lists generated by BuildManager, used
+    to follow trigger chains when computing critical paths.
+    """
+    def __init__(self, status, builders, schedulers, num_builds=20):
+        self.status = status
+        self.builder_names = [builder['name'] for builder in builders]
+        self.trigger_graph = get_trigger_graph(builders, schedulers)
+        self.num_builds = num_builds
+        self._durations = {}
+
+    def get_step_timings(self, builder_name):
+        """
+        Returns a list of (step name, {statistic: (p50, p95)}) tuples for a
+        builder, in step order.
+        """
+        step_names = []
+        values = {}
+
+        for build in self._get_builds(builder_name):
+            for step in build.getSteps():
+                name = step.getName()
+
+                if name not in values:
+                    step_names.append(name)
+                    values[name] = {}
+
+                for key in STEP_STATISTICS:
+                    value = step.getStatistic(key)
+
+                    if value is not None:
+                        values[name].setdefault(key, []).append(value)
+
+        timings = []
+
+        for name in step_names:
+            stats = {}
+
+            for key, key_values in values[name].items():
+                stats[key] = (get_percentile(key_values, 50),
+                              get_percentile(key_values, 95))
+
+            timings.append((name, stats))
+
+        return timings
+
+    def get_build_duration(self, builder_name):
+        """
+        Returns the median duration of a builder's recent builds, or 0 if
+        there are none.
+        """
+        if builder_name not in self._durations:
+            durations = []
+
+            for build in self._get_builds(builder_name):
+                start, end = build.getTimes()
+
+                if start is not None and end is not None:
+                    durations.append(end - start)
+
+            self._durations[builder_name] = \
+                get_percentile(durations, 50) or 0
+
+        return self._durations[builder_name]
+
+    def get_critical_path(self, builder_name, visited=()):
+        """
+        Returns the longest chain of triggered builds starting at a builder,
+        as a (median duration, [builder names]) tuple.
+        """
+        visited = visited + (builder_name,)
+        best = (0, [])
+
+        for name in self.trigger_graph.get(builder_name, []):
+            if name not in visited:
+                path = self.get_critical_path(name, visited)
+
+                if path[0] > best[0]:
+                    best = path
+
+        return (self.get_build_duration(builder_name) + best[0],
+                [builder_name] + best[1])
+
+    def format(self, builder_names=None):
+        """
+        Returns the report as plain text, for the given builders or for all
+        of them.
+        """
+        lines = []
+
+        for builder_name in builder_names or self.builder_names:
+            timings = self.get_step_timings(builder_name)
+
+            if not timings:
+                continue
+
+            lines.append(builder_name)
+            lines.append("  %-24s %10s %10s %10s %12s" %
+                         ("step", "p50 (s)", "p95 (s)", "wait p50",
+                          "bytes p50"))
+
+            for name, stats in timings:
+                wall_time = stats.get("wall-time", (0, 0))
+                queue_wait = stats.get("queue-wait", (0, 0))
+                transferred = stats.get("bytes-transferred", (0, 0))
+                lines.append("  %-24s %10.1f %10.1f %10.1f %12d" %
+                             (name, wall_time[0], wall_time[1],
+                              queue_wait[0], transferred[0]))
+
+            duration, path = self.get_critical_path(builder_name)
+
+            if len(path) > 1:
+                lines.append("  critical path (%.1fs): %s" %
+                             (duration, " -> ".join(path)))
+
+            lines.append("")
+
+        return "\n".join(lines)
+
+    def _get_builds(self, builder_name):
+        try:
+            builder_status = self.status.getBuilder(builder_name)
+        except KeyError:
+            return []
+
+        return list(builder_status.generateFinishedBuilds(
+            num_builds=self.num_builds))
+
+
+class TimingResource(resource.Resource):
+    """
+    Serves a TimingReport of the current status as plain text.
+
+    A GET to /timings reports every builder, and /timings/<builder name>
+    a single one. The number of recent builds aggregated can be set with
+    ?builds=N.
+    """
+    isLeaf = True
+
+    def __init__(self, builders, schedulers, num_builds=20):
+        resource.Resource.__init__(self)
+        self.builders = builders
+        self.schedulers = schedulers
+        self.num_builds = num_builds
+
+    def render_GET(self, request):
+        path = [part for part in request.postpath if part]
+        status = request.site.buildbot_service.getStatus()
+
+        request.setHeader("content-type", "text/plain")
+
+        try:
+            num_builds = int(request.args.get("builds",
+                                              [self.num_builds])[0])
+        except ValueError:
+            num_builds = 0
+
+        if num_builds <= 0:
+            request.setResponseCode(400)
+            return "builds must be a positive number\n"
+
+        report = TimingReport(status, self.builders, self.schedulers,
+                              num_builds)
+
+        if not path:
+            return report.format()
+
+        if len(path) != 1 or path[0] not in report.builder_names:
+            request.setResponseCode(404)
+            return "Not found\n"
+
+        return report.format(path)
@@ -1,35 +1,747 @@
+import math
+import os
+import sys
+
+from buildbot import locks
 from buildbot.buildslave import BuildSlave
 
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 
-def create_slave_list():
+
+_locks = {}
+_lock_generation = 0
+
+# Computes the SHA-1 checksums of files on a slave. This runs under
+# whatever Python the slave has, so it sticks to what 2.4 supports.
+SLAVE_CHECKSUM_SCRIPT = """
+import os, sys
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+for filename in sys.argv[1:]:
+    if os.path.isfile(filename):
+        checksum = sha1()
+        f = open(filename, 'rb')
+        data = f.read(65536)
+        while data:
+            checksum.update(data)
+            data = f.read(65536)
+        f.close()
+        sys.stdout.write('%s %s\\n' % (checksum.hexdigest(), filename))
+"""
+
+# Runs several commands at once on a slave, each writing to its own log
+# file, and waits for all of them. Arguments are the log directory followed
+# by a "<name> <argc> <args...>" group for each command.
+SLAVE_PARALLEL_SCRIPT = """
+import os, subprocess, sys
+logdir = sys.argv[1]
+args = sys.argv[2:]
+if not os.path.exists(logdir):
+    os.makedirs(logdir)
+procs = []
+failed = 0
+while args:
+    name = args[0]
+    argc = int(args[1])
+    command = args[2:2 + argc]
+    args = args[2 + argc:]
+    logfile = open(os.path.join(logdir, name + '.log'), 'w')
+    sys.stdout.write('starting %s: %s\\n' % (name, ' '.join(command)))
+    sys.stdout.flush()
+    try:
+        procs.append((name, subprocess.Popen(command, stdout=logfile,
+                                             stderr=subprocess.STDOUT),
+                      logfile))
+    except OSError:
+        logfile.write('%s\\n' % sys.exc_info()[1])
+        logfile.close()
+        sys.stdout.write('%s exited with 127\\n' % name)
+        failed = 1
+for name, proc, logfile in procs:
+    rc = proc.wait()
+    logfile.close()
+    sys.stdout.write('%s exited with %d\\n' % (name, rc))
+    sys.stdout.flush()
+    if rc:
+        failed = 1
+sys.exit(failed)
+"""
+
+# Fingerprints the inputs of a test run on a slave: the contents of the
+# source trees given as arguments (leaving out build output, bytecode and
+# version control files), the distributions the slave's Python can import,
+# and the Python version. Distributions installed in develop mode (such as
+# with "setup.py develop" or from version control) can change without a
+# new version, so the contents of their trees are included as well. Prints
+# a "<checksum> <input>" line for each.
+SLAVE_FINGERPRINT_SCRIPT = """
+import os, sys
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+def add_tree(checksum, path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted([name for name in dirnames
+                              if not name.startswith('.') and
+                                 not name.endswith('.egg-info') and
+                                 name not in ('build', 'dist')])
+        for name in sorted(filenames):
+            if (name.startswith('.') or name.endswith('.pyc') or
+                name.endswith('.pyo')):
+                continue
+            filename = os.path.join(dirpath, name)
+            checksum.update(filename + '\\0')
+            f = open(filename, 'rb')
+            data = f.read(65536)
+            while data:
+                checksum.update(data)
+                data = f.read(65536)
+            f.close()
+checksum = sha1()
+for path in sys.argv[1:]:
+    add_tree(checksum, path)
+sys.stdout.write('%s sources\\n' % checksum.hexdigest())
+dists = []
+try:
+    import pkg_resources
+    develop_dist = getattr(pkg_resources, 'DEVELOP_DIST', None)
+    for dist in pkg_resources.working_set:
+        name = '%s==%s' % (dist.project_name, dist.version)
+        if (develop_dist is not None and dist.precedence == develop_dist and
+            dist.location and os.path.isdir(dist.location)):
+            tree_checksum = sha1()
+            add_tree(tree_checksum, dist.location)
+            name += ' %s' % tree_checksum.hexdigest()
+        dists.append(name)
+except ImportError:
+    pass
+for entry in sys.path:
+    if os.path.isdir(entry):
+        for name in os.listdir(entry):
+            if name.endswith('.egg') or name.endswith('.egg-info'):
+                dists.append(name)
+dists.sort()
+sys.stdout.write('%s dependencies\\n' % sha1('\\n'.join(dists)).hexdigest())
+sys.stdout.write('%s python\\n' % sha1(sys.version).hexdigest())
+"""
+
+# Prints a "<name>==<version>" line for each distribution needed by the
+# requirements given as arguments, as installed on a slave.
+SLAVE_RESOLVE_SCRIPT = """
+import sys
+import pkg_resources
+for dist in pkg_resources.require(sys.argv[1:]):
+    sys.stdout.write('%s==%s\\n' % (dist.project_name, dist.version))
+"""
+
+# Installed as sitecustomize.py for the Python processes started by
+# SLAVE_TEST_WATCHDOG_SCRIPT. It dumps the stack of every thread to stderr
+# on SIGUSR1, and the first process to start writes its pid to the file
+# named by BUILDBATTER_PIDFILE. It then runs the sitecustomize it shadows,
+# if there is one.
+SLAVE_STACK_DUMP_SCRIPT = """
+import os, signal, sys, traceback
+def _buildbatter_dump_stacks(signum, frame):
+    out = sys.__stderr__
+    if hasattr(sys, '_current_frames'):
+        frames = sys._current_frames().items()
+    else:
+        frames = [('main', frame)]
+    for thread_id, thread_frame in frames:
+        out.write('\\nStack of thread %s:\\n' % thread_id)
+        traceback.print_stack(thread_frame, file=out)
+    out.flush()
+if hasattr(signal, 'SIGUSR1'):
+    signal.signal(signal.SIGUSR1, _buildbatter_dump_stacks)
+if os.environ.get('BUILDBATTER_PIDFILE'):
+    try:
+        fd = os.open(os.environ['BUILDBATTER_PIDFILE'],
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        os.write(fd, str(os.getpid()))
+        os.close(fd)
+    except OSError:
+        pass
+def _buildbatter_run_original():
+    import imp
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = [p for p in sys.path if os.path.abspath(p or '.') != here]
+    try:
+        f, filename, description = imp.find_module('sitecustomize', path)
+    except ImportError:
+        return
+    try:
+        imp.load_module('_buildbatter_original_sitecustomize', f, filename,
+                        description)
+    finally:
+        if f:
+            f.close()
+_buildbatter_run_original()
+"""
+
+# Runs a nose command, passing its output through, and kills it if a test
+# runs for longer than a time limit, or the whole command runs for longer
+# than an overall limit. Only the time between a test's "<test> ... " line
+# and its result counts against the test's limit. The stack of the stuck
+# process is dumped before it's killed. Arguments are the time limits per
+# test and overall in seconds (0 for no limit), the stack dump script and
+# the command.
+SLAVE_TEST_WATCHDOG_SCRIPT = """
+import os, re, select, shutil, signal, subprocess, sys, tempfile, time
+timeout = float(sys.argv[1])
+total_timeout = float(sys.argv[2])
+command = sys.argv[4:]
+tmpdir = tempfile.mkdtemp()
+f = open(os.path.join(tmpdir, 'sitecustomize.py'), 'w')
+f.write(sys.argv[3])
+f.close()
+pidfile = os.path.join(tmpdir, 'pid')
+env = os.environ.copy()
+env['PYTHONPATH'] = os.pathsep.join([tmpdir] +
+                                    [p for p in [env.get('PYTHONPATH')] if p])
+env['BUILDBATTER_PIDFILE'] = pidfile
+proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                        stderr=subprocess.STDOUT, env=env)
+fd = proc.stdout.fileno()
+result_re = re.compile(r' \\.\\.\\. \\w+$')
+def read_output(wait):
+    if not select.select([fd], [], [], wait)[0]:
+        return None
+    data = os.read(fd, 65536)
+    sys.stdout.write(data)
+    sys.stdout.flush()
+    return data
+partial = ''
+current = None
+test_started = None
+started = time.time()
+timed_out = False
+while 1:
+    data = read_output(1)
+    if data == '':
+        break
+    if data:
+        lines = (partial + data).split('\\n')
+        partial = lines.pop()
+        for line in lines + [partial]:
+            if line.endswith(' ... '):
+                if line[:-5] != current:
+                    current = line[:-5]
+                    test_started = time.time()
+            elif result_re.search(line):
+                current = None
+    now = time.time()
+    if timeout and current is not None and now - test_started > timeout:
+        timed_out = True
+        sys.stdout.write('\\nTest timed out after %d seconds: %s\\n' %
+                         (timeout, current))
+        break
+    if total_timeout and now - started > total_timeout:
+        timed_out = True
+        if current is not None:
+            sys.stdout.write('\\nTest run timed out after %d seconds: %s\\n'
+                             % (total_timeout, current))
+        else:
+            sys.stdout.write('\\nTest run timed out after %d seconds\\n' %
+                             total_timeout)
+        break
+if timed_out:
+    sys.stdout.flush()
+    pid = None
+    try:
+        pid = int(open(pidfile).read())
+        os.kill(pid, signal.SIGUSR1)
+    except (IOError, OSError, ValueError):
+        pass
+    deadline = time.time() + 10
+    while time.time() < deadline and read_output(1):
+        pass
+    for p in (pid, proc.pid):
+        if p:
+            try:
+                os.kill(p, signal.SIGKILL)
+            except OSError:
+                pass
+rc = proc.wait()
+shutil.rmtree(tmpdir, True)
+if timed_out:
+    rc = 124
+elif rc < 0:
+    rc = 128 - rc
+sys.exit(rc)
+"""
+
+# Marks the working directory as a builddir for SLAVE_GC_SCRIPT, and
+# records when it was last used.
+SLAVE_MARK_BUILDDIR_SCRIPT = """
+import os
+open('.buildbatter-builddir', 'a').close()
+os.utime('.buildbatter-builddir', None)
+"""
+
+# Frees disk space in a slave's base directory, which is the working
+# directory. Builddirs are marked with a .buildbatter-builddir file by
+# SLAVE_MARK_BUILDDIR_SCRIPT, and kept builddirs are marked here too.
+# Marked builddirs that are no longer kept and haven't been used for a
+# while are removed, and then the virtualenvs and build outputs of kept
+# builddirs are removed, least recently used first, until the base
+# directory fits the budget. Unmarked directories are never removed,
+# unless their names match an "--adopt=<pattern>" argument. Other
+# arguments are the budget in bytes, the minimum age in seconds of removed
+# builddirs, and the names of the builddirs to keep. Absolute paths may
+# also be given, and whatever holds them is left alone. Prints a
+# "removed <path> (<reason>, <size> bytes)" line for each removal.
+SLAVE_GC_SCRIPT = """
+import fnmatch, os, shutil, sys, time
+budget = int(sys.argv[1])
+orphan_age = float(sys.argv[2])
+basedir = os.getcwd()
+marker = '.buildbatter-builddir'
+keep = {}
+protected = {'info': 1}
+adopt = []
+for name in sys.argv[3:]:
+    if name.startswith('--adopt='):
+        adopt.append(name[len('--adopt='):])
+        continue
+    if not os.path.isabs(name):
+        keep[name] = 1
+        continue
+    name = os.path.normpath(name)
+    if name.startswith(basedir + os.sep):
+        protected[name[len(basedir) + 1:].split(os.sep)[0]] = 1
+def get_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames + dirnames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+def get_last_used(path, depth=2):
+    latest = os.lstat(path).st_mtime
+    if depth and os.path.isdir(path) and not os.path.islink(path):
+        for name in os.listdir(path):
+            try:
+                used = get_last_used(os.path.join(path, name), depth - 1)
+            except OSError:
+                continue
+            if used > latest:
+                latest = used
+    return latest
+def is_dir(path):
+    return os.path.isdir(path) and not os.path.islink(path)
+def remove(path, reason):
+    size = get_size(path)
+    shutil.rmtree(path, True)
+    sys.stdout.write('removed %s (%s, %d bytes)\\n' % (path, reason, size))
+    sys.stdout.flush()
+    return size
+now = time.time()
+candidates = []
+for name in os.listdir(basedir):
+    path = os.path.join(basedir, name)
+    if name in protected or name.startswith('.') or not is_dir(path):
+        continue
+    marked = os.path.exists(os.path.join(path, marker))
+    last_used = get_last_used(path)
+    if name not in keep:
+        if not marked:
+            for pattern in adopt:
+                if fnmatch.fnmatch(name, pattern):
+                    marked = True
+        if marked and now - last_used >= orphan_age:
+            remove(path, 'orphaned builddir')
+        continue
+    if not marked:
+        open(os.path.join(path, marker), 'w').close()
+    for subname in os.listdir(path):
+        subpath = os.path.join(path, subname)
+        if not is_dir(subpath):
+            continue
+        if os.path.exists(os.path.join(subpath, 'bin', 'activate')):
+            candidates.append((last_used, subpath, 'stale virtualenv'))
+            continue
+        for output in ('dist', 'build'):
+            if is_dir(os.path.join(subpath, output)):
+                candidates.append((last_used, os.path.join(subpath, output),
+                                   'stale %s output' % output))
+usage = get_size(basedir)
+candidates.sort()
+for last_used, path, reason in candidates:
+    if usage <= budget:
+        break
+    usage -= remove(path, reason)
+sys.stdout.write('using %d of %d bytes\\n' % (usage, budget))
+"""
+
+
+def get_lock(lock_class, name, maxCount=1, maxCountForSlave={}):
     """
-    Creates a list of all configures slaves from a slaves.cfg file.
+    Returns the shared lock with the given name.
+
+    Buildbot requires every use of a lock name to refer to the same lock
+    object, so each lock is created once and reused. Asking for an existing
+    name with different settings raises a ValueError. Lock settings can
+    only change on reconfig if master.cfg calls reset_locks() before
+    creating any locks.
     """
-    slaves = []
-    info = {}
+    key = (lock_class, name)
+    settings = (maxCount, tuple(sorted(maxCountForSlave.items())))
 
-    fp = open("slaves.cfg", "r")
+    if key in _locks:
+        lock, lock_settings = _locks[key]
 
-    for line in fp.xreadlines():
-        line = line.rstrip("\n")
+        if lock_settings != settings:
+            raise ValueError("lock %s was already created with different "
+                             "settings" % name)
 
-        if line.startswith("#") or line == "":
-            continue
+        return lock
+
+    if lock_class is locks.SlaveLock:
+        lock = lock_class(name, maxCount=maxCount,
+                          maxCountForSlave=maxCountForSlave)
+    else:
+        lock = lock_class(name, maxCount=maxCount)
+
+    _locks[key] = (lock, settings)
+
+    return lock
+
+
+def reset_locks():
+    """
+    Forgets the locks created by get_lock, so a new config can create them
+    with new settings.
+    """
+    global _lock_generation
+
+    _locks.clear()
+    _lock_generation += 1
+
+
+def get_lock_generation():
+    """
+    Returns the number of times reset_locks() has been called. Config
+    pieces made under an older generation hold lock objects that buildbot
+    won't accept alongside the new ones.
+    """
+    return _lock_generation
+
+
+def get_file_checksum(filename, blocksize=65536):
+    """
+    Returns the SHA-1 checksum of a file, as a hex string.
+    """
+    checksum = sha1()
+    f = open(filename, "rb")
+
+    try:
+        data = f.read(blocksize)
+
+        while data:
+            checksum.update(data)
+            data = f.read(blocksize)
+    finally:
+        f.close()
+
+    return checksum.hexdigest()
+
+
+def get_shard(key, num_shards):
+    """
+    Returns the shard, from 0 to num_shards - 1, that a key belongs to.
+
+    This uses rendezvous hashing: the key goes to the shard with the
+    highest hash of the key and shard together. When shards are added or
+    removed, only the keys whose winning shard changed move.
+    """
+    best_shard = 0
+    best_hash = None
+
+    for shard in range(num_shards):
+        shard_hash = sha1("%s:%d" % (key, shard)).hexdigest()
+
+        if best_hash is None or shard_hash > best_hash:
+            best_shard = shard
+            best_hash = shard_hash
+
+    return best_shard
+
+
+def get_web_control(request):
+    """
+    Returns the buildbot control for a request to a WebStatus resource, or
+    None if the WebStatus doesn't allow forcing builds or the request
+    isn't authenticated. This is the check buildbot's force build form
+    makes.
+    """
+    service = request.site.buildbot_service
+    control = service.getControl()
+
+    if control is None:
+        return None
+
+    # Only buildbot 0.7.11 and later can authenticate web users.
+    if (hasattr(service, "isUsingUserPasswd") and
+        service.isUsingUserPasswd(request) and
+        not service.authUser(request)):
+        return None
+
+    return control
+
+
+class SlaveInfo(object):
+    """
+    Information on a slave listed in slaves.cfg.
+    """
+    def __init__(self, name, password, pyvers=[], capacity=None, tags=[],
+                 weight=1):
+        self.name = name
+        self.password = password
+        self.pyvers = pyvers
+        self.capacity = capacity
+        self.tags = tags
+        self.weight = weight
+
+
+class SlaveRegistry(object):
+    """
+    A registry of slaves, indexed for constant-time lookups by name, Python
+    version and tag.
+
+    Slaves for a Python version or tag are listed by descending weight, so
+    the first slave is the preferred one.
+    """
+    def __init__(self, slaves=[]):
+        self.slaves = []
+        self._by_name = {}
+        self._by_pyver = {}
+        self._by_tag = {}
 
-        try:
-            name, pyver, password = line.split("\t", 3)
-        except ValueError:
-            name, password = line.split("\t", 2)
-            pyver = None
+        for slave in slaves:
+            self.add(slave)
 
-        slaves.append(BuildSlave(name, password))
+    def add(self, slave):
+        if slave.name in self._by_name:
+            raise ValueError("Duplicate slave '%s'" % slave.name)
 
-        if pyver:
-            if pyver not in info:
-                info[pyver] = []
+        self.slaves.append(slave)
+        self._by_name[slave.name] = slave
 
-            info[pyver].append(name)
+        for pyver in slave.pyvers:
+            self._add_to_index(self._by_pyver, pyver, slave)
 
-    fp.close()
+        for tag in slave.tags:
+            self._add_to_index(self._by_tag, tag, slave)
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def get_slave_names(self, pyver=None, tag=None):
+        """
+        Returns the names of slaves with the given Python version and/or
+        tag, best first.
+        """
+        if pyver is not None:
+            names = self._by_pyver.get(pyver, [])
+
+            if tag is not None:
+                tagged = self._by_tag.get(tag, [])
+                names = [name for name in names if name in tagged]
+        elif tag is not None:
+            names = self._by_tag.get(tag, [])
+        else:
+            names = [slave.name for slave in self.slaves]
+
+        return list(names)
+
+    def get_pyver_map(self):
+        """
+        Returns a dictionary mapping each Python version to the names of
+        the slaves providing it, best first.
+        """
+        pyver_map = {}
+
+        for pyver, names in self._by_pyver.items():
+            pyver_map[pyver] = list(names)
+
+        return pyver_map
+
+    def pick_slave(self, names, key):
+        """
+        Returns one of the named slaves for a key, such as a builder name.
+
+        This uses weighted rendezvous hashing: each slave's chance of being
+        picked is proportional to its weight times its capacity, and a key
+        only moves when the slave it was on is removed or another slave
+        outscores it.
+        """
+        best_name = None
+        best_score = None
+
+        for name in names:
+            slave = self._by_name[name]
+            share = slave.weight * (slave.capacity or 1)
+            h = int(sha1("%s:%s" % (key, name)).hexdigest()[:13], 16)
+            score = -share / math.log((h + 1.0) / (2 ** 52 + 1))
+
+            if best_score is None or score > best_score:
+                best_name = name
+                best_score = score
+
+        return best_name
+
+    def get_build_slaves(self, names=None):
+        """
+        Returns a BuildSlave for each slave, or for each of the named
+        slaves if names is given.
+        """
+        slaves = []
+
+        for slave in self.slaves:
+            if names is not None and slave.name not in names:
+                continue
+
+            slaves.append(BuildSlave(slave.name, slave.password,
+                                     max_builds=slave.capacity))
+
+        return slaves
+
+    def _add_to_index(self, index, key, slave):
+        names = index.setdefault(key, [])
+        names.append(slave.name)
+        names.sort(key=lambda name: -self._by_name[name].weight)
+
+
+def parse_slaves_file(filename):
+    """
+    Parses a slaves.cfg file into a SlaveRegistry.
+
+    Each line contains whitespace-separated fields in one of these forms:
+
+        name password
+        name pyvers password [option=value ...]
+
+    If a line contains tabs, its name, pyvers and password are separated by
+    tabs instead, so passwords may contain spaces. Options may follow the
+    password, after a tab or spaces.
+
+    pyvers is a comma-separated list of Python versions, or "-" for none.
+    The supported options are capacity, weight and tags (comma-separated).
+    Blank lines and lines starting with "#" are ignored.
+    """
+    registry = SlaveRegistry()
+
+    fp = open(filename, "r")
+
+    try:
+        for linenum, line in enumerate(fp):
+            line = line.rstrip("\r\n")
+
+            if line.startswith("#") or line.strip() == "":
+                continue
+
+            try:
+                registry.add(_parse_slave_line(line))
+            except ValueError:
+                raise ValueError("%s:%d: %s" % (filename, linenum + 1,
+                                                sys.exc_info()[1]))
+    finally:
+        fp.close()
+
+    return registry
+
+
+_SLAVE_OPTIONS = ("capacity", "tags", "weight")
+
+
+def _parse_slave_line(line):
+    if "\t" in line:
+        # Tab-separated lines may have spaces in their passwords, so only
+        # trailing option=value fields are split off the password.
+        fields = [field.strip() for field in line.split("\t")]
+        options = " ".join(fields[3:]).split()
+
+        if len(fields) >= 3:
+            password = fields[2]
+
+            while True:
+                parts = password.rsplit(None, 1)
+
+                if (len(parts) < 2 or "=" not in parts[1] or
+                    parts[1].split("=", 1)[0] not in _SLAVE_OPTIONS):
+                    break
+
+                password = parts[0]
+                options.insert(0, parts[1])
+
+            fields[2:] = [password] + options
+    else:
+        fields = line.split()
+
+    if len(fields) == 2:
+        return SlaveInfo(fields[0], fields[1])
+    elif len(fields) < 2:
+        raise ValueError("Expected a slave name and password")
+
+    name, pyvers, password = fields[:3]
+    options = {}
+
+    if pyvers == "-":
+        pyvers = []
+    else:
+        pyvers = pyvers.split(",")
+
+    for field in fields[3:]:
+        if "=" not in field:
+            raise ValueError("Expected option=value, got '%s'" % field)
+
+        key, value = field.split("=", 1)
+
+        if key == "tags":
+            options["tags"] = value.split(",")
+        elif key in ("capacity", "weight"):
+            try:
+                options[key] = int(value)
+            except ValueError:
+                raise ValueError("Invalid %s '%s'" % (key, value))
+        else:
+            raise ValueError("Unknown option '%s'" % key)
+
+    return SlaveInfo(name, password, pyvers, **options)
+
+
+_slave_registries = {}
+
+
+def load_slave_registry(filename="slaves.cfg"):
+    """
+    Returns the SlaveRegistry for a slaves.cfg file.
+
+    The file is only parsed again if its modification time has changed
+    since the last load.
+    """
+    mtime = os.stat(filename).st_mtime
+    cached = _slave_registries.get(filename)
+
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, parse_slaves_file(filename))
+        _slave_registries[filename] = cached
+
+    return cached[1]
+
+
+def create_slave_list():
+    """
+    Creates a list of all configures slaves from a slaves.cfg file.
+    """
+    registry = load_slave_registry()
 
-    return slaves, info
+    return registry.get_build_slaves(), registry.get_pyver_map()
@@ -0,0 +1,254 @@
+"""
+Stall detection and sampling profiles for the master's reactor.
+
+Anything that blocks the reactor thread (a synchronous subprocess, a large
+log parse, a slow reconfig) freezes the whole master. ReactorWatchdog
+measures how late the reactor runs a frequent heartbeat and reports the lag
+to the metrics registry. A separate thread watches the heartbeat, and when
+it stops for longer than a threshold, logs the stack the reactor thread is
+stuck in, while it's still stuck there.
+
+ProfileResource samples the reactor thread's stack for a number of seconds
+and writes the samples out as a profile, one "frame;frame;... count" line
+per distinct stack (the collapsed format flame graph tools read).
+
+Add both to master.cfg:
+
+    c['status'].append(ReactorWatchdog(threshold=2))
+    web.putChild("profile", ProfileResource("profiles"))
+
+and profile the master for 30 seconds with a POST to /profile?seconds=30.
+"""
+import os
+import sys
+import threading
+import time
+import traceback
+
+from thread import get_ident
+
+from buildbot.status.base import StatusReceiverMultiService
+from twisted.internet import task
+from twisted.python import log
+from twisted.web import resource
+
+from metrics import registry
+from util import get_web_control
+
+
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60)
+
+MAX_PROFILE_SECONDS = 600
+
+
+def format_thread_stack(thread_id):
+    """
+    Returns the current stack of a thread, formatted like a traceback, or
+    None if the thread isn't running.
+    """
+    frame = sys._current_frames().get(thread_id)
+
+    if frame is None:
+        return None
+
+    return "".join(traceback.format_stack(frame))
+
+
+class ReactorWatchdog(StatusReceiverMultiService):
+    """
+    Measures reactor lag and logs the reactor thread's stack on stalls.
+
+    The reactor runs a heartbeat every interval seconds, and the time by
+    which each one runs late is recorded in the
+    buildbatter_reactor_lag_seconds histogram. If no heartbeat has run for
+    threshold seconds, the stack of the reactor thread is logged once for
+    that stall, and the stall is counted in buildbatter_reactor_stalls_total
+    when the reactor gets going again.
+    """
+    compare_attrs = ["interval", "threshold"]
+
+    def __init__(self, interval=0.5, threshold=2):
+        StatusReceiverMultiService.__init__(self)
+        self.interval = interval
+        self.threshold = threshold
+        self.reactor_thread_id = None
+        self.last_beat = None
+        self.reported_beat = None
+        self.heartbeat = task.LoopingCall(self._beat)
+        self.thread = None
+        self.stopping = False
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+
+        # Services are started from the reactor thread.
+        self.reactor_thread_id = get_ident()
+        self.last_beat = time.time()
+        self.stopping = False
+        self.heartbeat.start(self.interval, now=False)
+
+        self.thread = threading.Thread(target=self._watch,
+                                       name="buildbatter-reactor-watchdog")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stopService(self):
+        self.stopping = True
+
+        if self.heartbeat.running:
+            self.heartbeat.stop()
+
+        return StatusReceiverMultiService.stopService(self)
+
+    def _beat(self):
+        now = time.time()
+        lag = max(0, now - self.last_beat - self.interval)
+        self.last_beat = now
+
+        registry.histogram(
+            "buildbatter_reactor_lag_seconds",
+            "How late the reactor ran the watchdog's heartbeat.",
+            LAG_BUCKETS).observe(lag)
+
+        if lag >= self.threshold:
+            registry.counter(
+                "buildbatter_reactor_stalls_total",
+                "Times the reactor was blocked for longer than the "
+                "watchdog's threshold.").inc()
+            log.msg("reactor was blocked for %.2f seconds" % lag)
+
+    def _watch(self):
+        while not self.stopping:
+            time.sleep(self.interval)
+            last_beat = self.last_beat
+            stalled = time.time() - last_beat - self.interval
+
+            if stalled < self.threshold or self.reported_beat == last_beat:
+                continue
+
+            self.reported_beat = last_beat
+            stack = format_thread_stack(self.reactor_thread_id)
+
+            if stack is not None:
+                log.msg("reactor blocked for %.2f seconds so far, in:\n%s" %
+                        (stalled, stack))
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a thread from another thread, and writes out how
+    many samples landed in each distinct stack.
+    """
+    def __init__(self, thread_id, filename, seconds, interval=0.005):
+        self.thread_id = thread_id
+        self.filename = filename
+        self.seconds = seconds
+        self.interval = interval
+        self.counts = {}
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run,
+                                       name="buildbatter-profiler")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.isAlive()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, code.co_filename,
+                                         frame.f_lineno))
+            frame = frame.f_back
+
+        if stack:
+            stack.reverse()
+            key = ";".join([entry.replace(";", ":") for entry in stack])
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self):
+        tmp_path = "%s.tmp" % self.filename
+        f = open(tmp_path, "w")
+
+        try:
+            for stack, count in sorted(self.counts.items()):
+                f.write("%s %d\n" % (stack, count))
+        finally:
+            f.close()
+
+        os.rename(tmp_path, self.filename)
+
+    def _run(self):
+        deadline = time.time() + self.seconds
+
+        try:
+            while time.time() < deadline:
+                self.sample()
+                time.sleep(self.interval)
+
+            self.write()
+            log.msg("wrote a %g second reactor profile to %s" %
+                    (self.seconds, self.filename))
+        except Exception:
+            log.err(None, "reactor profile failed")
+
+
+class ProfileResource(resource.Resource):
+    """
+    Starts a sampling profile of the reactor thread, which is written to a
+    file in profile_dir when it finishes.
+
+    A POST to /profile?seconds=<N> starts a profile lasting N seconds (10
+    by default) and returns the name of the file it will be written to.
+    Only one profile runs at a time. Like forcing builds, this needs a
+    WebStatus with allowForce set, and a username and passwd if it
+    authenticates users.
+    """
+    isLeaf = True
+
+    def __init__(self, profile_dir, default_seconds=10):
+        resource.Resource.__init__(self)
+        self.profile_dir = os.path.abspath(profile_dir)
+        self.default_seconds = default_seconds
+        self.profiler = None
+
+    def render_POST(self, request):
+        request.setHeader("content-type", "text/plain")
+
+        if get_web_control(request) is None:
+            request.setResponseCode(403)
+            return "Profiling is not allowed\n"
+
+        if self.profiler is not None and self.profiler.is_running():
+            request.setResponseCode(409)
+            return "A profile is already running: %s\n" % \
+                   self.profiler.filename
+
+        try:
+            seconds = float(request.args.get("seconds",
+                                             [self.default_seconds])[0])
+        except ValueError:
+            seconds = 0
+
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            request.setResponseCode(400)
+            return "seconds must be between 0 and %d\n" % MAX_PROFILE_SECONDS
+
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+        filename = os.path.join(
+            self.profile_dir,
+            "reactor-%s.prof" % time.strftime("%Y%m%d-%H%M%S"))
+
+        # Requests are rendered in the reactor thread.
+        self.profiler = SamplingProfiler(get_ident(), filename, seconds)
+        self.profiler.start()
+
+        return "Profiling the reactor for %g seconds into %s\n" % (seconds,
+                                                                  filename)